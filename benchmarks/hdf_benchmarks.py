@@ -0,0 +1,107 @@
+"""Write/read throughput and file size of TimeSeries.to_hdf storage options.
+
+Saves a random ``(frequency, channels, events, time)`` power array with
+different chunking, compression and downcasting options and reports:
+
+* write throughput
+* throughput of reading the whole array back
+* time to read all time points of a few (channel, event) pairs (the
+  typical access pattern when computing features per event)
+* size of the file on disk
+
+Usage::
+
+    python benchmarks/hdf_benchmarks.py [--shape 8 64 200 500] [--repeat 3]
+
+"""
+
+import argparse
+import os
+import os.path as osp
+import shutil
+from tempfile import mkdtemp
+import time
+
+import numpy as np
+
+from ptsa.data.timeseries import TimeSeries
+
+CONFIGS = [
+    ('h5py chunks', {}),
+    ('chunk_by', {'chunk_by': ('channels', 'events')}),
+    ('chunk_by + lzf', {'chunk_by': ('channels', 'events'),
+                        'compression': 'lzf'}),
+    ('chunk_by + gzip1', {'chunk_by': ('channels', 'events'),
+                          'compression': 'gzip1'}),
+    ('chunk_by + gzip4', {'chunk_by': ('channels', 'events'),
+                          'compression': 'gzip'}),
+    ('chunk_by + float32 + lzf', {'chunk_by': ('channels', 'events'),
+                                  'compression': 'lzf', 'dtype': 'float32'}),
+    ('chunk_by + float16 + lzf', {'chunk_by': ('channels', 'events'),
+                                  'compression': 'lzf', 'dtype': 'float16'}),
+]
+
+
+def make_power(shape, seed=0):
+    """Smooth, positive random data resembling wavelet power."""
+    rng = np.random.RandomState(seed)
+    data = np.cumsum(rng.standard_normal(shape), axis=-1)
+    data = np.exp(data / np.sqrt(shape[-1]))
+    dims = ('frequency', 'channels', 'events', 'time')
+    coords = {
+        'frequency': np.logspace(np.log10(3), np.log10(180), shape[0]),
+        'channels': np.array(['CH{}'.format(i) for i in range(shape[1])]),
+        'time': np.arange(shape[3]) / 500.,
+    }
+    return TimeSeries.create(data, 500., coords=coords, dims=dims)
+
+
+def best_of(repeat, fcn):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fcn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def run(shape, repeat=3, num_pairs=20):
+    ts = make_power(shape)
+    nbytes = ts.data.nbytes
+    rng = np.random.RandomState(1)
+    pairs = list(zip(rng.choice(ts.channels.values, num_pairs),
+                     rng.randint(0, shape[2], num_pairs)))
+
+    tempdir = mkdtemp()
+    try:
+        print('{} float64 array: {:.1f} MB'.format(shape, nbytes / 1e6))
+        print('{:28s} {:>10s} {:>10s} {:>14s} {:>10s}'.format(
+            'config', 'write MB/s', 'read MB/s', 'pairs ms', 'size MB'))
+
+        for name, kwargs in CONFIGS:
+            filename = osp.join(tempdir, 'power.h5')
+
+            write_time = best_of(repeat, lambda: ts.to_hdf(filename, **kwargs))
+            read_time = best_of(repeat, lambda: TimeSeries.from_hdf(filename))
+
+            def read_pairs():
+                loaded = TimeSeries.from_hdf(filename, lazy=True)
+                for channel, event in pairs:
+                    loaded.sel(channels=channel)[:, event].values
+
+            pairs_time = best_of(repeat, read_pairs)
+
+            print('{:28s} {:10.1f} {:10.1f} {:14.1f} {:10.1f}'.format(
+                name, nbytes / write_time / 1e6, nbytes / read_time / 1e6,
+                pairs_time * 1e3, os.stat(filename).st_size / 1e6))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shape', type=int, nargs=4, default=[8, 32, 100, 500],
+                        metavar=('FREQUENCY', 'CHANNELS', 'EVENTS', 'TIME'))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(tuple(args.shape), repeat=args.repeat)
@@ -2,3 +2,4 @@ __author__ = 'm'
 
 from .path_utils import *
 from .axis_utils import *
+from .parallel_utils import *
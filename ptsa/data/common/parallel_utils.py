@@ -0,0 +1,98 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+__all__ = ['parallel_map', 'shared_memory_map']
+
+
+def parallel_map(fcn, items, workers=1, executor=None):
+    """
+    Applies fcn to every element of items, optionally in parallel, and returns the results in the order of items.
+
+    :param fcn: callable taking a single argument. Must be picklable when executor is a process pool
+    :param items: iterable of arguments
+    :param workers: {int} number of threads to use when executor is not given. 1 (or less) runs serially
+    :param executor: {concurrent.futures.Executor} executor to submit the calls to. It is not shut down afterwards
+    :return: {list} results of fcn
+    """
+    if executor is not None:
+        return list(executor.map(fcn, items))
+
+    if workers is None or workers <= 1:
+        return [fcn(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fcn, items))
+
+
+def _call_shared(fcn, item):
+    """Runs fcn in a worker, exchanging TimeSeries with the parent through shared memory"""
+    from ptsa.data.common.shared_memory_utils import SharedMemoryHandle
+    from ptsa.data.timeseries import TimeSeries
+
+    if isinstance(item, SharedMemoryHandle):
+        item = TimeSeries.from_shared_memory(item)
+    result = fcn(item)
+    if isinstance(result, TimeSeries):
+        return result.to_shared_memory()
+    return result
+
+
+def shared_memory_map(fcn, items, workers=None, executor=None):
+    """
+    Applies fcn to every element of items in a process pool, passing TimeSeries arguments and results through shared
+    memory instead of pickling them.
+
+    Every TimeSeries in items is copied once into shared memory, where workers use it without copying it. TimeSeries
+    returned by fcn are placed in shared memory by the workers and returned as views of it, so they are not copied
+    either. Other arguments and results are pickled as usual. Requires Python 3.8 or later.
+
+    :param fcn: picklable callable taking a single argument
+    :param items: iterable of arguments
+    :param workers: {int} number of processes when executor is not given. None uses the number of CPUs
+    :param executor: {concurrent.futures.ProcessPoolExecutor} executor to submit the calls to. It is not shut down
+        afterwards
+    :return: {list} results of fcn
+    """
+    from ptsa.data.common.shared_memory_utils import SharedMemoryHandle
+    from ptsa.data.timeseries import TimeSeries
+
+    def run(pool):
+        futures = [pool.submit(_call_shared, fcn, argument) for argument in arguments]
+        results = []
+        error = None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BaseException as e:
+                error = error or e
+                results.append(None)
+        if error is not None:
+            for result in results:
+                if isinstance(result, SharedMemoryHandle):
+                    result.unlink()
+            raise error
+        return results
+
+    handles = []
+    arguments = []
+    try:
+        for item in items:
+            if isinstance(item, TimeSeries):
+                item = item.to_shared_memory()
+                handles.append(item)
+            arguments.append(item)
+
+        if executor is None:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = run(pool)
+        else:
+            results = run(executor)
+    finally:
+        for handle in handles:
+            handle.unlink()
+
+    for i, result in enumerate(results):
+        if isinstance(result, SharedMemoryHandle):
+            # the block is only needed until it is mapped here
+            results[i] = TimeSeries.from_shared_memory(result)
+            result.unlink()
+    return results
@@ -0,0 +1,99 @@
+from collections import namedtuple
+from multiprocessing import shared_memory
+import pickle
+import struct
+
+import numpy as np
+
+__all__ = ['SharedMemoryHandle', 'write_shared_block', 'read_shared_block']
+
+# blocks start with the length of the header as a little-endian uint64
+_HEADER_LENGTH = struct.Struct('<Q')
+
+# data buffers start at a multiple of this many bytes (cache line / SIMD friendly)
+_ALIGNMENT = 64
+
+
+class SharedMemoryHandle(namedtuple('SharedMemoryHandle', ['name', 'size'])):
+    """
+    Picklable reference to a shared memory block holding an array and its metadata.
+
+    Blocks persist until unlink() is called, normally by the process that requested them once every process that
+    needs the data has attached to it. Attached arrays stay valid after the block is unlinked.
+    """
+    __slots__ = ()
+
+    def unlink(self):
+        """Removes the block. Does nothing if it has already been removed."""
+        try:
+            block = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        block.close()
+        block.unlink()
+
+
+class _SharedBuffer(object):
+    """Exposes an array stored in a shared memory block and keeps the block mapped for as long as it is referenced"""
+
+    def __init__(self, block, offset, shape, dtype):
+        self.block = block
+        view = np.frombuffer(block.buf, dtype=np.uint8, count=0, offset=offset)
+        address = view.__array_interface__['data'][0]
+        # release the export of the block's buffer, which would otherwise prevent closing the block
+        del view
+        self.__array_interface__ = {
+            'version': 3,
+            'shape': tuple(shape),
+            'typestr': dtype.str,
+            'descr': dtype.descr,
+            'data': (address, False),
+        }
+
+
+def _data_offset(header_length):
+    return -(-(_HEADER_LENGTH.size + header_length) // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_shared_block(array, metadata=None):
+    """
+    Copies an array into a new shared memory block, preceded by a pickled header holding its dtype, shape and
+    metadata
+
+    :param array: {np.ndarray} array of a fixed-size dtype
+    :param metadata: picklable object stored with the array
+    :return: {SharedMemoryHandle}
+    """
+    array = np.asarray(array)
+    if array.dtype.hasobject:
+        raise TypeError('Arrays of objects cannot be placed in shared memory')
+
+    header = pickle.dumps((array.dtype, array.shape, metadata), protocol=pickle.HIGHEST_PROTOCOL)
+    offset = _data_offset(len(header))
+    size = offset + array.nbytes
+    block = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        block.buf[:_HEADER_LENGTH.size] = _HEADER_LENGTH.pack(len(header))
+        block.buf[_HEADER_LENGTH.size:_HEADER_LENGTH.size + len(header)] = header
+        np.copyto(np.asarray(_SharedBuffer(block, offset, array.shape, array.dtype)), array, casting='no')
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    handle = SharedMemoryHandle(block.name, size)
+    block.close()
+    return handle
+
+
+def read_shared_block(handle):
+    """
+    Attaches to a block written by write_shared_block without copying its array
+
+    :param handle: {SharedMemoryHandle}
+    :return: {tuple} writable array backed by the block and the metadata stored with it
+    """
+    block = shared_memory.SharedMemory(name=handle.name)
+    header_length, = _HEADER_LENGTH.unpack(bytes(block.buf[:_HEADER_LENGTH.size]))
+    dtype, shape, metadata = pickle.loads(block.buf[_HEADER_LENGTH.size:_HEADER_LENGTH.size + header_length])
+    array = np.asarray(_SharedBuffer(block, _data_offset(header_length), shape, dtype))
+    return array, metadata
@@ -1,6 +1,10 @@
 from .base import BaseFilter
 from .butterworth import ButterworthFilter
 from .data_chopper import DataChopper
+from .line_noise import LineNoiseFilter
 from .monopolar_to_bipolar_mapper import MonopolarToBipolarMapper
 from .morlet import MorletWaveletFilter
 from .resample import ResampleFilter
+from .rereference import RereferenceFilter
+from .pipeline import Pipeline
+from .streaming import StreamingFilter
@@ -1,5 +1,6 @@
 import numpy as np
 import traits.api
+from xarray import DataArray
 
 from ptsa.data.timeseries import TimeSeries
 
@@ -16,20 +17,55 @@ class BaseFilter(traits.api.HasTraits):
     dtype : str or np.dtype or None
         When given, coerce the input to a valid numpy dtype. When ``None``,
         leave as the original dtype. Default: coerce to ``np.float64``.
+        The input itself is never modified: when it already has this dtype
+        its data is used as is, otherwise ``timeseries`` refers to a
+        converted copy.
+    out : np.ndarray or TimeSeries or None
+        Array to write the filtered data to, e.g. a buffer reused across
+        batches. It must have the shape of the output. The returned
+        :class:`TimeSeries` shares its memory.
+    inplace : bool
+        Write the filtered data over the data of the input, for filters whose
+        output has the shape of their input. The input is only overwritten
+        when it already has ``dtype``. Default: False
 
     """
     timeseries = traits.api.Instance(TimeSeries)
 
-    def __init__(self, timeseries, dtype=np.float64):
+    def __init__(self, timeseries, dtype=np.float64, out=None, inplace=False):
         super(BaseFilter, self).__init__()
 
+        if dtype is not None and timeseries.data.dtype != np.dtype(dtype):
+            timeseries = timeseries.copy(data=timeseries.data.astype(dtype))
         self.timeseries = timeseries
 
-        if dtype is not None:
-            self.timeseries.data = timeseries.data.astype(dtype)
+        if out is not None and inplace:
+            raise ValueError("out and inplace cannot be used together")
+        self.out = out
+        self.inplace = inplace
 
         self.nontime_dims = tuple([d for d in self.timeseries.dims if d != 'time'])
         self.nontime_sizes = tuple([len(self.timeseries[d]) for d in self.nontime_dims])
 
+    def output_buffer(self, shape, dtype=np.float64):
+        """
+        :param shape: {tuple} shape of the filtered data
+        :param dtype: type of the filtered data
+        :return: {np.ndarray} out, the data of the input when filtering in place, or a new array
+        """
+        if self.inplace:
+            buffer = self.timeseries.data
+        elif self.out is not None:
+            buffer = self.out.data if isinstance(self.out, DataArray) else self.out
+        else:
+            return np.empty(shape, dtype=dtype)
+
+        if not isinstance(buffer, np.ndarray) or buffer.shape != tuple(shape):
+            raise ValueError("Filtered data of shape %s cannot be written to %s" % (
+                tuple(shape), "the input" if self.inplace else "out"))
+        if not np.can_cast(dtype, buffer.dtype, casting='same_kind'):
+            raise TypeError("Cannot write %s data to an array of %s" % (np.dtype(dtype), buffer.dtype))
+        return buffer
+
     def filter(self):
         raise NotImplementedError
@@ -1,11 +1,44 @@
+import numpy as np
 from xarray import DataArray
-from ptsa.filt import buttfilt
+from ptsa.filt import butter_sos, sosfiltfilt_bank
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.common import get_axis_index
 from ptsa.data.filters import BaseFilter
 import traits.api
 
-__all__ = ['ButterworthFilter']
+__all__ = ['ButterworthFilter', 'band_records', 'butterworth_array']
+
+
+def band_records(freq_range):
+    """
+    :param freq_range: {array-like} list of [min_freq, max_freq] ranges
+    :return: {np.recarray} the ranges as records with low and high fields
+    """
+    bands = np.asarray(freq_range, dtype=float)
+    return np.rec.fromarrays([bands[:, 0], bands[:, 1]], names='low,high')
+
+
+def butterworth_array(data, samplerate, freq_range, order=4, filt_type='stop',
+                      axis=-1, cpus=1, out=None):
+    """
+    :param data: {np.ndarray} data to filter
+    :param samplerate: {float} sample rate of the data
+    :param freq_range: {array-like} [min_freq, max_freq], or a list of such ranges to filter with each of them
+    :param order: {int} Butterworth filter order
+    :param filt_type: {str} 'stop', 'pass', 'low' or 'high'
+    :param axis: {int} time axis of data
+    :param cpus: {int} number of threads filtering chunks of the data in parallel
+    :param out: {np.ndarray} array to write the filtered data to, e.g. data itself to filter in place
+    :return: {np.ndarray} filtered data, with a leading band axis when freq_range is a list of ranges
+    """
+    is_bank = np.ndim(freq_range) == 2
+    bands = freq_range if is_bank else [freq_range]
+    sos_list = [butter_sos(order, band, samplerate, filt_type)
+                for band in bands]
+    if out is not None and not is_bank:
+        out = out[None]
+    filtered = sosfiltfilt_bank(sos_list, data, axis=axis, cpus=cpus, out=out)
+    return filtered if is_bank else filtered[0]
 
 
 class ButterworthFilter(BaseFilter):
@@ -19,7 +52,22 @@ class ButterworthFilter(BaseFilter):
     order
          Butterworth filter order
     freq_range: list-like
-       Array [min_freq, max_freq] describing the filter range
+       Array [min_freq, max_freq] describing the filter range, or a list of
+       such ranges to filter the time series with each of them. The output
+       then has a leading ``band`` dimension whose coordinate is a record
+       array with ``low`` and ``high`` fields.
+    filt_type: str
+       'stop' (default), 'pass', 'low' or 'high'
+    cpus: int
+       Number of threads filtering chunks of the non-time dimensions (and
+       bands) in parallel
+    out: np.ndarray or TimeSeries
+       Array to write the filtered data to, with the shape of the output
+    inplace: bool
+       Filter the data of the input in place (single frequency range only)
+
+    The filter is applied forward and backward (zero phase) as second-order
+    sections. Designs are cached, see :func:`ptsa.filt.butter_sos`.
 
     .. versionchanged:: 2.0
 
@@ -27,15 +75,29 @@ class ButterworthFilter(BaseFilter):
 
     """
     order = traits.api.Int
-    freq_range = traits.api.CList(maxlen=2)
+    freq_range = traits.api.CList
     filt_type = traits.api.Str
+    cpus = traits.api.Int
 
-    def __init__(self, timeseries, freq_range, order=4, filt_type='stop'):
-        super(ButterworthFilter, self).__init__(timeseries)
+    def __init__(self, timeseries, freq_range, order=4, filt_type='stop',
+                 cpus=1, out=None, inplace=False):
+        super(ButterworthFilter, self).__init__(timeseries, out=out,
+                                                inplace=inplace)
 
-        self.freq_range = freq_range
+        shape = np.shape(freq_range)
+        if len(shape) > 2 or shape[-1:] > (2,) or (len(shape) == 2 and
+                                                   shape[1] != 2):
+            raise ValueError("freq_range must be [min_freq, max_freq] or a "
+                             "list of such ranges")
+        self.freq_range = list(np.atleast_1d(freq_range))
         self.order = order
         self.filt_type = filt_type
+        self.cpus = cpus
+
+    @property
+    def is_bank(self):
+        """True when filtering with several frequency ranges."""
+        return np.ndim(self.freq_range) == 2
 
     def filter(self):
         """
@@ -48,13 +110,21 @@ class ButterworthFilter(BaseFilter):
 
         """
         time_axis_index = get_axis_index(self.timeseries, axis_name='time')
-        filtered_array = buttfilt(self.timeseries,
-                                  self.freq_range, float(self.timeseries['samplerate']), self.filt_type,
-                                  self.order, axis=time_axis_index)
+        data = self.timeseries.data
+        dtype = np.result_type(data.dtype, np.float64)
+        shape = ((len(self.freq_range),) if self.is_bank else ()) + data.shape
+        filtered_array = butterworth_array(
+            data, float(self.timeseries['samplerate']), self.freq_range,
+            order=self.order, filt_type=self.filt_type, axis=time_axis_index,
+            cpus=self.cpus, out=self.output_buffer(shape, dtype))
 
         coords_dict = {coord_name: DataArray(coord.copy()) for coord_name, coord in list(self.timeseries.coords.items())}
         coords_dict['samplerate'] = self.timeseries['samplerate']
         dims = [dim_name for dim_name in self.timeseries.dims]
+        if self.is_bank:
+            coords_dict['band'] = band_records(self.freq_range)
+            dims = ['band'] + dims
+
         filtered_timeseries = TimeSeries(
             filtered_array,
             dims=dims,
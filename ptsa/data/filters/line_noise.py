@@ -0,0 +1,152 @@
+import numpy as np
+import traits.api
+
+from ptsa.data.common import get_axis_index
+from ptsa.data.filters import BaseFilter
+from ptsa.data.timeseries import TimeSeries
+from ptsa.filt import butter_sos, sosfiltfilt_bank
+
+__all__ = ['LineNoiseFilter', 'line_noise_array', 'line_noise_bands',
+           'line_noise_sos']
+
+
+def line_noise_bands(samplerate, freq=60., harmonics=2, bandwidth=4.):
+    """
+    :param samplerate: {float} sample rate of the data
+    :param freq: {float} line frequency in Hz
+    :param harmonics: {int} number of harmonics in addition to the fundamental
+    :param bandwidth: {float} width in Hz of each stop band
+    :return: {list} [low, high] stop band of the fundamental and each harmonic below the Nyquist frequency
+    """
+    centers = freq * np.arange(1, harmonics + 2)
+    half_width = bandwidth / 2.
+    return [[center - half_width, center + half_width]
+            for center in centers if center + half_width < samplerate / 2.]
+
+
+def line_noise_sos(samplerate, freq=60., harmonics=2, bandwidth=4., order=4):
+    """
+    :param samplerate: {float} sample rate of the data
+    :param freq: {float} line frequency in Hz
+    :param harmonics: {int} number of harmonics in addition to the fundamental
+    :param bandwidth: {float} width in Hz of each stop band
+    :param order: {int} Butterworth order of each band-stop filter
+    :return: {np.ndarray} second-order sections of the cascaded band-stop filters
+    """
+    bands = line_noise_bands(samplerate, freq, harmonics, bandwidth)
+    if not bands:
+        raise ValueError("No stop band below the Nyquist frequency")
+    return np.vstack([butter_sos(order, band, samplerate, 'stop')
+                      for band in bands])
+
+
+def line_noise_array(data, samplerate, freq=60., harmonics=2, bandwidth=4.,
+                     order=4, axis=-1, cpus=1, out=None):
+    """
+    :param data: {np.ndarray} data to filter
+    :param samplerate: {float} sample rate of the data
+    :param freq: {float} line frequency in Hz
+    :param harmonics: {int} number of harmonics in addition to the fundamental
+    :param bandwidth: {float} width in Hz of each stop band
+    :param order: {int} Butterworth order of each band-stop filter
+    :param axis: {int} time axis of data
+    :param cpus: {int} number of threads filtering chunks of the data in parallel
+    :param out: {np.ndarray} array to write the filtered data to, e.g. data itself to filter in place
+    :return: {np.ndarray} filtered data
+    """
+    sos = line_noise_sos(samplerate, freq, harmonics, bandwidth, order)
+    return sosfiltfilt_bank([sos], data, axis=axis, cpus=cpus,
+                            out=None if out is None else out[None])[0]
+
+
+class LineNoiseFilter(BaseFilter):
+    """Removes line noise and its harmonics in a single pass.
+
+    A Butterworth band-stop filter is designed around the fundamental and
+    each harmonic below the Nyquist frequency, exactly as chained
+    :class:`ButterworthFilter` calls with ``filt_type='stop'`` would, and the
+    second-order sections of all of them are cascaded into one filter. The
+    data is then filtered forward and backward once, so the stop-band
+    attenuation is the same as with chained filters while the data is only
+    traversed (and copied) once.
+
+    Keyword Arguments
+    -----------------
+    timeseries
+        TimeSeries object
+    freq: float
+        Line frequency in Hz. Default: 60
+    harmonics: int
+        Number of harmonics to remove in addition to the fundamental, e.g. 2
+        removes 60, 120 and 180 Hz. Harmonics at or above the Nyquist
+        frequency are skipped. Default: 2
+    bandwidth: float
+        Width in Hz of each stop band. Default: 4, i.e. [58, 62] around 60 Hz
+    order: int
+        Butterworth order of each band-stop filter. Default: 4
+    cpus: int
+        Number of threads filtering chunks of channels in parallel
+    out: np.ndarray or TimeSeries
+        Array to write the filtered data to, with the shape of the input
+    inplace: bool
+        Filter the data of the input in place
+
+    """
+    freq = traits.api.CFloat
+    harmonics = traits.api.Int
+    bandwidth = traits.api.CFloat
+    order = traits.api.Int
+    cpus = traits.api.Int
+
+    def __init__(self, timeseries, freq=60., harmonics=2, bandwidth=4.,
+                 order=4, cpus=1, out=None, inplace=False):
+        super(LineNoiseFilter, self).__init__(timeseries, out=out,
+                                              inplace=inplace)
+        self.freq = freq
+        self.harmonics = harmonics
+        self.bandwidth = bandwidth
+        self.order = order
+        self.cpus = cpus
+
+    def stop_bands(self, samplerate):
+        """
+        :param samplerate: {float} sample rate of the data
+        :return: {list} [low, high] stop band of the fundamental and each harmonic below the Nyquist frequency
+        """
+        return line_noise_bands(samplerate, self.freq, self.harmonics,
+                                self.bandwidth)
+
+    def design(self, samplerate):
+        """
+        :param samplerate: {float} sample rate of the data
+        :return: {np.ndarray} second-order sections of the cascaded band-stop filters
+        """
+        return line_noise_sos(samplerate, self.freq, self.harmonics,
+                              self.bandwidth, self.order)
+
+    def filter(self):
+        """
+        Removes line noise from the time series
+
+        Returns
+        -------
+        filtered: TimeSeries
+            The filtered time series
+
+        """
+        time_axis_index = get_axis_index(self.timeseries, axis_name='time')
+        data = self.timeseries.data
+        dtype = np.result_type(data.dtype, np.float64)
+        filtered_array = line_noise_array(
+            data, float(self.timeseries['samplerate']), self.freq,
+            self.harmonics, self.bandwidth, self.order, axis=time_axis_index,
+            cpus=self.cpus, out=self.output_buffer(data.shape, dtype))
+
+        filtered_timeseries = TimeSeries(
+            filtered_array,
+            dims=self.timeseries.dims,
+            coords=self.timeseries.coords,
+            name=self.timeseries.name,
+            attrs=self.timeseries.attrs.copy()
+        )
+        return filtered_timeseries
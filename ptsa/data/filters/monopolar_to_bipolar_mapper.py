@@ -1,6 +1,7 @@
 __author__ = 'm'
 
 import numpy as np
+import pandas as pd
 from ptsa.data.timeseries import TimeSeries
 # from memory_profiler import profile
 import time
@@ -9,6 +10,36 @@ from ptsa.data.filters import BaseFilter
 import traits.api
 
 
+def bipolar_array(data, channels, bipolar_pairs, axis=0,
+                  chan_names=('ch0', 'ch1'), dtype=None, out=None):
+    """
+    :param data: {np.ndarray} monopolar data
+    :param channels: {array-like} labels of the channels along axis
+    :param bipolar_pairs: {np.recarray} pairs with chan_names fields holding channel labels
+    :param axis: {int} channels axis of data
+    :param chan_names: names of the fields holding the two channels of a pair
+    :param dtype: type of the result when out is not given. Defaults to the type of data
+    :param out: {np.ndarray} array to write the result to, with one entry per pair along axis
+    :return: {np.ndarray} difference between the data of the two channels of every pair
+    """
+    labels = pd.Index(channels)
+    indices = []
+    for name in chan_names:
+        index = labels.get_indexer(bipolar_pairs[name])
+        if (index < 0).any():
+            raise KeyError('Channel[s] %s not in channels' % (
+                list(np.asarray(bipolar_pairs[name])[index < 0]),))
+        indices.append(index)
+
+    first = np.take(data, indices[0], axis=axis)
+    if out is None:
+        out = first.astype(dtype or data.dtype, copy=False)
+    else:
+        out[...] = first
+    out -= np.take(data, indices[1], axis=axis)
+    return out
+
+
 class MonopolarToBipolarMapper(BaseFilter):
     """Object that takes as an input time series for monopolar electrodes
     and an array of bipolar pairs and outputs a TimeSeries object
@@ -33,6 +64,9 @@ class MonopolarToBipolarMapper(BaseFilter):
     chan_names: container, optional
         container with two elements corresponding to the names of the
         two channels in the bipolar pair
+    out: np.ndarray or TimeSeries, optional
+        Array to write the bipolar data to, with one entry per pair along
+        channels_dim
 
     .. versionchanged:: 2.0
     Parameter "time_series" was renamed to "timeseries".
@@ -43,8 +77,8 @@ class MonopolarToBipolarMapper(BaseFilter):
     # bipolar_pairs = traits.api.Array(dtype=[('ch0', '|S3'), ('ch1', '|S3')])
 
     def __init__(self, timeseries, bipolar_pairs, channels_dim='channels',
-                 chan_names=['ch0', 'ch1']):
-        super(MonopolarToBipolarMapper, self).__init__(timeseries)
+                 chan_names=['ch0', 'ch1'], out=None):
+        super(MonopolarToBipolarMapper, self).__init__(timeseries, out=out)
         if (len(np.shape(bipolar_pairs)) == 2):
             if np.shape(bipolar_pairs)[0] == 2:
                 self.bipolar_pairs = np.core.records.fromarrays(
@@ -70,16 +104,16 @@ class MonopolarToBipolarMapper(BaseFilter):
         A TimeSeries object.
 
         """
-        channel_axis = self.timeseries[self.channels_dim]
-
-        ch0 = self.bipolar_pairs[self.chan_names[0]]
-        ch1 = self.bipolar_pairs[self.chan_names[1]]
-
-        sel0 = channel_axis.loc[ch0]
-        sel1 = channel_axis.loc[ch1]
-
-        ts0 = self.timeseries.loc[{self.channels_dim: sel0}]
-        ts1 = self.timeseries.loc[{self.channels_dim: sel1}]
+        axis = self.timeseries.get_axis_num(self.channels_dim)
+        out = None
+        if self.out is not None:
+            shape = list(self.timeseries.shape)
+            shape[axis] = len(self.bipolar_pairs)
+            out = self.output_buffer(shape, self.timeseries.dtype)
+        data = bipolar_array(self.timeseries.data,
+                             self.timeseries[self.channels_dim].values,
+                             self.bipolar_pairs, axis=axis,
+                             chan_names=self.chan_names, out=out)
 
         dims_bp = list(self.timeseries.dims)
 
@@ -88,7 +122,7 @@ class MonopolarToBipolarMapper(BaseFilter):
                              self.timeseries.coords.items())}
         coords_bp[self.channels_dim] = self.bipolar_pairs
 
-        ts = TimeSeries(data=ts0.values - ts1.values, dims=dims_bp,
+        ts = TimeSeries(data=data, dims=dims_bp,
                         coords=coords_bp)
         ts['samplerate'] = self.timeseries['samplerate']
 
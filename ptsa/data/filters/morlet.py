@@ -2,11 +2,113 @@ import time
 
 import numpy as np
 import traits.api
+from xarray import DataArray
 
+from ptsa.data.common import get_axis_index
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import BaseFilter
 from ptsa.extensions import morlet
 
+__all__ = ['MorletWaveletFilter', 'morlet_outputs', 'morlet_transform']
+
+MORLET_OUTPUTS = ('power', 'phase', 'complex')
+
+
+def morlet_outputs(output):
+    """
+    :param output: {str or list} power, phase and/or complex
+    :return: {list} the requested outputs in the order power, phase, complex
+    """
+    if isinstance(output, str):
+        output = [output]
+
+    for el in output:
+        if el not in MORLET_OUTPUTS:
+            raise RuntimeError("invalid output option: {}".format(el))
+
+    # TODO: update extension module to allow for this scenario
+    if 'complex' in output and len(output) > 1:
+        raise RuntimeError("complex output requires not also requesting power/phase")
+
+    return [name for name in MORLET_OUTPUTS if name in output]
+
+
+def morlet_transform(data, samplerate, freqs, width=5, output=('power', 'phase'),
+                     axis=-1, cpus=1, complete=True, out=None):
+    """
+    :param data: {np.ndarray} signal to transform
+    :param samplerate: {float} sample rate of the signal
+    :param freqs: {array-like} frequencies of the wavelets
+    :param width: {int} width of the wavelets
+    :param output: {str or list} power, phase and/or complex
+    :param axis: {int} time axis of data
+    :param cpus: {int} number of threads computing the transform
+    :param complete: {bool} use complete Morlet wavelets, see :class:`MorletWaveletFilter`
+    :param out: {np.ndarray} array of the shape of the result to write it to. The transform is computed in it
+        directly when its memory layout and type are those of the computed output, and copied to it otherwise
+    :return: {np.ndarray} transform of shape (output, frequency, non-time dims..., time), without the leading output
+        axis when a single output is requested
+    """
+    outputs = morlet_outputs(output)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+    signal = np.moveaxis(data, axis, -1)
+    nontime_sizes = signal.shape[:-1]
+    num_times = signal.shape[-1]
+    signal = np.ascontiguousarray(signal.reshape(-1, num_times), dtype=np.float64)
+    rows_shape = (len(signal) * len(freqs), num_times)
+    dtype = np.complex128 if outputs == ['complex'] else np.float64
+
+    # the extension computes (non-time dims x frequency, time) rows for every output
+    shape = (len(outputs), len(freqs)) + nontime_sizes + (num_times,)
+    if out is None:
+        # power and phase are computed into one buffer, avoiding the copy of joining them
+        buffer = np.empty((len(outputs),) + rows_shape, dtype=dtype)
+        rows = list(buffer)
+        targets = [None] * len(outputs)
+    else:
+        target = out if len(outputs) > 1 else out[None]
+        if target.shape != shape:
+            raise ValueError('out must have shape %s' % (shape[len(outputs) == 1:],))
+        targets = list(np.moveaxis(target, 1, -2))
+        rows = []
+        for native in targets:
+            reshaped = native.reshape(rows_shape)
+            if not (reshaped.dtype == dtype and reshaped.flags.c_contiguous
+                    and np.may_share_memory(reshaped, native)):
+                reshaped = np.empty(rows_shape, dtype=dtype)
+            rows.append(reshaped)
+    arrays = dict(zip(outputs, rows))
+    empty = np.empty((1, 0))
+
+    mt = morlet.MorletWaveletTransformMP(cpus)
+    if outputs == ['power']:
+        mt.set_output_type(morlet.POWER)
+    elif outputs == ['phase']:
+        mt.set_output_type(morlet.PHASE)
+    elif outputs == ['complex']:
+        mt.set_output_type(morlet.COMPLEX)
+    else:
+        mt.set_output_type(morlet.BOTH)
+    mt.set_signal_array(signal)
+    mt.set_wavelet_pow_array(arrays.get('power', empty))
+    mt.set_wavelet_phase_array(arrays.get('phase', empty))
+    mt.set_wavelet_complex_array(arrays.get('complex', empty.astype(np.complex128)))
+    mt.initialize_signal_props(float(samplerate))
+    mt.initialize_wavelet_props(width, freqs, complete)
+    mt.prepare_run()
+    mt.compute_wavelets_threads()
+
+    if out is not None:
+        for native, computed in zip(targets, rows):
+            if not np.may_share_memory(computed, native):
+                native[...] = computed.reshape(native.shape)
+        return out
+
+    # (outputs, non-time dims..., frequency, time) -> (outputs, frequency, non-time dims..., time)
+    transformed = np.moveaxis(buffer.reshape((len(outputs),) + nontime_sizes + (len(freqs), num_times)), -2, 1)
+    return transformed if len(outputs) > 1 else transformed[0]
+
 
 class MorletWaveletFilter(BaseFilter):
     """Applies a Morlet wavelet transform to a time series, returning the power
@@ -42,6 +144,12 @@ class MorletWaveletFilter(BaseFilter):
         Use complete Morlet wavelets with a zero mean, which is required for
         power and phase accuracy with small wavelet widths.  The frequency is
         kept consistent with standard Morlet wavelets.  (default: True)
+    out: np.ndarray or TimeSeries
+        Array to write the transform to, with the shape of the output, e.g.
+        the data returned by a previous call with data of the same shape.
+        The transform is computed in it directly when its memory layout and
+        type are those of the output of this filter, and copied to it
+        otherwise.
 
     """
     freqs = traits.api.CArray
@@ -51,26 +159,13 @@ class MorletWaveletFilter(BaseFilter):
 
     def __init__(self, timeseries, freqs, width=5,
                  output=('power', 'phase'), verbose=True, cpus=1,
-                 output_dim='output', complete=True):
-        super(MorletWaveletFilter, self).__init__(timeseries)
+                 output_dim='output', complete=True, out=None):
+        super(MorletWaveletFilter, self).__init__(timeseries, out=out)
         self.freqs = freqs
         self.width = width
         self.complete = complete
 
-        output_opts = ('power', 'phase', 'complex')
-
-        if isinstance(output, str):
-            output = [output]
-
-        for el in output:
-            if el not in output_opts:
-                raise RuntimeError("invalid output option: {}".format(el))
-
-        # TODO: update extension module to allow for this scenario
-        if 'complex' in output and len(output) > 1:
-            raise RuntimeError("complex output requires not also requesting power/phase")
-
-        self.output = output
+        self.output = morlet_outputs(output)
 
         self.verbose = verbose
         self.cpus = cpus
@@ -81,112 +176,30 @@ class MorletWaveletFilter(BaseFilter):
 
     def filter(self):
         """Apply the constructed filter."""
-        time_axis = self.timeseries['time']
-
-        wavelet_dims = self.nontime_sizes + (self.freqs.shape[0],)
-
-        powers_reshaped = np.array([[]], dtype=np.float)
-        phases_reshaped = np.array([[]], dtype=np.float)
-        wavelets_complex_reshaped = np.array([[]], dtype=np.complex)
-
-        if 'power' in self.output:
-            powers_reshaped = np.empty(
-                shape=(np.prod(wavelet_dims),
-                       len(self.timeseries['time'])), dtype=np.float)
-        if 'phase' in self.output:
-            phases_reshaped = np.empty(
-                shape=(np.prod(wavelet_dims),
-                       len(self.timeseries['time'])), dtype=np.float)
-        if 'complex' in self.output:
-            wavelets_complex_reshaped = np.empty(
-                shape=(np.prod(wavelet_dims), len(self.timeseries['time'])),
-                dtype=np.complex)
-
-        mt = morlet.MorletWaveletTransformMP(self.cpus)
-
-        timeseries_reshaped = np.ascontiguousarray(
-            self.timeseries.data.reshape(
-                np.prod(self.nontime_sizes, dtype=int),
-                len(self.timeseries['time'])), self.timeseries.data.dtype)
-
-        if self.output == ['power']:
-            mt.set_output_type(morlet.POWER)
-        if self.output == ['phase']:
-            mt.set_output_type(morlet.PHASE)
-        if 'power' in self.output and 'phase' in self.output:
-            mt.set_output_type(morlet.BOTH)
-
-        # TODO: update to allow outputing complex as well as power/phase
-        if self.output == ['complex']:
-            mt.set_output_type(morlet.COMPLEX)
-
-        mt.set_signal_array(timeseries_reshaped)
-        mt.set_wavelet_pow_array(powers_reshaped)
-        mt.set_wavelet_phase_array(phases_reshaped)
-        mt.set_wavelet_complex_array(wavelets_complex_reshaped)
-
-        mt.initialize_signal_props(float(self.timeseries['samplerate']))
-        mt.initialize_wavelet_props(self.width, self.freqs, self.complete)
-        mt.prepare_run()
-
-        s = time.time()
-        mt.compute_wavelets_threads()
-
-        powers_final = None
-        phases_final = None
-        wavelet_complex_final = None
-
-        if 'power' in self.output:
-            powers_final = powers_reshaped.reshape(wavelet_dims + (len(self.timeseries['time']),))
-        if 'phase' in self.output:
-            phases_final = phases_reshaped.reshape(wavelet_dims + (len(self.timeseries['time']),))
-        if 'complex' in self.output:
-            wavelet_complex_final = wavelets_complex_reshaped.reshape(wavelet_dims + (len(self.timeseries['time']),))
+        time_axis_index = get_axis_index(self.timeseries, axis_name='time')
 
+        dims = ('frequency',) + self.nontime_dims + ('time',)
         coords = {k: v for k, v in list(self.timeseries.coords.items())}
         coords['frequency'] = self.freqs
+        if len(self.output) > 1:
+            dims = (self.output_dim,) + dims
+            coords[self.output_dim] = self.output
 
-        powers_ts = None
-        phases_ts = None
-        wavelet_complex_ts = None
-
-        if powers_final is not None:
-            powers_ts = TimeSeries(powers_final,
-                                   dims=self.nontime_dims + ('frequency', 'time'),
-                                   coords=coords)
-            final_dims = (powers_ts.dims[-2],) + powers_ts.dims[:-2] + (powers_ts.dims[-1],)
+        out = None
+        if self.out is not None:
+            shape = ((len(self.output),) if len(self.output) > 1 else ()) + (
+                (len(self.freqs),) + self.nontime_sizes + (len(self.timeseries['time']),))
+            dtype = np.complex128 if self.output == ['complex'] else np.float64
+            out = self.output_buffer(shape, dtype)
 
-            powers_ts = powers_ts.transpose(*final_dims)
-
-        if phases_final is not None:
-            phases_ts = TimeSeries(phases_final,
-                                   dims=self.nontime_dims + ('frequency', 'time'),
-                                   coords=coords)
-
-            final_dims = (phases_ts.dims[-2],) + phases_ts.dims[:-2] + (phases_ts.dims[-1],)
-
-            phases_ts = phases_ts.transpose(*final_dims)
-
-        if wavelet_complex_final is not None:
-            wavelet_complex_ts = TimeSeries(wavelet_complex_final,
-                                            dims=self.nontime_dims + (
-                                             'frequency', 'time',),
-                                            coords=coords)
-
-            final_dims = (wavelet_complex_ts.dims[-2],) + wavelet_complex_ts.dims[:-2] + (wavelet_complex_ts.dims[-1],)
-
-            wavelet_complex_ts = wavelet_complex_ts.transpose(*final_dims)
+        s = time.time()
+        transformed = morlet_transform(
+            self.timeseries.data, float(self.timeseries['samplerate']),
+            self.freqs, width=self.width, output=self.output,
+            axis=time_axis_index, cpus=self.cpus, complete=self.complete,
+            out=out)
 
         if self.verbose:
             print('CPP total time wavelet loop: ', time.time() - s)
 
-        if wavelet_complex_ts is not None:
-            return wavelet_complex_ts
-        else:
-            if powers_ts is None:
-                return phases_ts
-            elif phases_ts is None:
-                return powers_ts
-            else:
-                return powers_ts.append(phases_ts, dim=self.output_dim).assign_coords(
-                    output=['power', 'phase'])
+        return TimeSeries(transformed, dims=dims, coords=coords)
@@ -0,0 +1,333 @@
+"""Fused filter pipelines.
+
+Chaining filters (e.g. bipolar referencing, Butterworth filtering,
+resampling and a wavelet transform) builds a complete :class:`TimeSeries`
+after every step: the array is copied, every coordinate (including events
+record arrays) is rebuilt and the data may be cast again. A
+:class:`Pipeline` runs the same steps on the raw array instead, filtering in
+place whenever a step does not change the shape of the data, and builds the
+output :class:`TimeSeries` once at the end.
+
+Example::
+
+    pipeline = Pipeline([
+        (MonopolarToBipolarMapper, {'bipolar_pairs': pairs}),
+        (ButterworthFilter, {'freq_range': [58., 62.]}),
+        (ResampleFilter, {'resamplerate': 250.}),
+        (MorletWaveletFilter, {'freqs': freqs, 'output': 'power'}),
+        ('remove_buffer', {'duration': 1.}),
+    ])
+    pow_wavelet = pipeline.run(eeg)
+    print(pipeline.format_report())
+
+"""
+
+from collections import namedtuple
+import inspect
+import time
+import tracemalloc
+
+import numpy as np
+import traits.api
+
+from ptsa.data.filters.butterworth import ButterworthFilter, band_records, butterworth_array
+from ptsa.data.filters.line_noise import LineNoiseFilter, line_noise_array
+from ptsa.data.filters.monopolar_to_bipolar_mapper import MonopolarToBipolarMapper, bipolar_array
+from ptsa.data.filters.morlet import MorletWaveletFilter, morlet_outputs, morlet_transform
+from ptsa.data.filters.resample import (ResampleFilter, resample_array, resampled_length,
+                                        resampled_time_axis)
+from ptsa.data.filters.rereference import RereferenceFilter, bipolar_pairs_array, montage_matrix, rereference_array
+from ptsa.data.timeseries import TimeSeries
+
+__all__ = ['Pipeline', 'StageReport']
+
+StageReport = namedtuple('StageReport', ['name', 'seconds', 'peak_bytes', 'shape'])
+StageReport.__doc__ = """Time taken by a pipeline stage, memory it allocated at its peak (in bytes, above what was
+allocated when it started; None when memory is not tracked) and shape of its output"""
+
+
+class _Frame(object):
+    """Array flowing through a pipeline, with its dims and the coords that differ from those of the input"""
+
+    def __init__(self, timeseries, dtype):
+        self.timeseries = timeseries
+        self.data = timeseries.data
+        self.dims = list(timeseries.dims)
+        self.samplerate = float(timeseries['samplerate'])
+        self.dtype = dtype
+        # replaced or new dimension coords
+        self.coords = {}
+        # True once data was allocated by the pipeline and may be overwritten
+        self.owned = False
+
+    def axis(self, dim):
+        if dim not in self.dims:
+            raise ValueError("No dimension named %s" % dim)
+        return self.dims.index(dim)
+
+    def coord(self, dim):
+        if dim in self.coords:
+            return self.coords[dim]
+        return self.timeseries.coords[dim].values
+
+    def float_dtype(self):
+        if self.dtype is not None:
+            return np.dtype(self.dtype)
+        if self.data.dtype.kind in 'fc':
+            return self.data.dtype
+        return np.dtype(np.float64)
+
+    def writable(self):
+        """Data that may be overwritten, copied (and cast) first unless the pipeline allocated it"""
+        if not self.owned or self.data.dtype != self.float_dtype():
+            self.data = self.data.astype(self.float_dtype())
+            self.owned = True
+        return self.data
+
+    def replace(self, data, dims=None, **coords):
+        self.data = data
+        self.owned = True
+        if dims is not None:
+            self.dims = list(dims)
+        self.coords.update(coords)
+
+    def to_timeseries(self):
+        coords = {}
+        for name, coord in self.timeseries.coords.items():
+            if name in self.coords:
+                continue
+            # coords along dims that were replaced or removed no longer apply
+            if any(dim in self.coords or dim not in self.dims for dim in coord.dims):
+                continue
+            coords[name] = coord.variable
+        coords.update({dim: coord for dim, coord in self.coords.items() if dim in self.dims})
+        coords['samplerate'] = self.samplerate
+        return TimeSeries(self.data, coords=coords, dims=self.dims,
+                          name=self.timeseries.name,
+                          attrs=self.timeseries.attrs.copy())
+
+
+def _bipolar(frame, bipolar_pairs, channels_dim='channels', chan_names=('ch0', 'ch1')):
+    """Stage equivalent to :class:`MonopolarToBipolarMapper`"""
+    bipolar_pairs = bipolar_pairs_array(bipolar_pairs, chan_names)
+    data = bipolar_array(frame.data, frame.coord(channels_dim), bipolar_pairs, axis=frame.axis(channels_dim),
+                         chan_names=chan_names, dtype=frame.float_dtype())
+    frame.replace(data, **{channels_dim: bipolar_pairs})
+
+
+def _rereference(frame, montage='average', bipolar_pairs=None, neighbors=None, weights=None, out_channels=None,
+                 channels_dim='channels', chan_names=('ch0', 'ch1'), chunk_dim='events', chunk_size=0):
+    """Stage equivalent to :class:`RereferenceFilter`"""
+    channels = frame.coord(channels_dim)
+    if montage == 'custom':
+        matrix = weights
+        out_labels = np.asarray(out_channels)
+    else:
+        out_labels = channels
+        if montage == 'bipolar':
+            bipolar_pairs = out_labels = bipolar_pairs_array(bipolar_pairs, chan_names)
+        elif montage == 'laplacian':
+            out_labels = np.array(list(neighbors))
+        matrix = montage_matrix(montage, channels, bipolar_pairs=bipolar_pairs, neighbors=neighbors,
+                                chan_names=chan_names)
+
+    axis = frame.axis(channels_dim)
+    chunk_axis = frame.dims.index(chunk_dim) if chunk_dim in frame.dims and chunk_dim != channels_dim else None
+    shape = list(frame.data.shape)
+    shape[axis] = matrix.shape[0]
+    rereferenced = rereference_array(matrix, frame.data, axis=axis, chunk_axis=chunk_axis, chunk_size=chunk_size,
+                                     out=np.empty(shape, dtype=frame.float_dtype()))
+    frame.replace(rereferenced, **{channels_dim: out_labels})
+
+
+def _butterworth(frame, freq_range, order=4, filt_type='stop', cpus=1):
+    """Stage equivalent to :class:`ButterworthFilter`"""
+    if np.ndim(freq_range) == 2:
+        filtered = butterworth_array(frame.data, frame.samplerate, freq_range, order=order, filt_type=filt_type,
+                                     axis=frame.axis('time'), cpus=cpus)
+        frame.replace(filtered, dims=['band'] + frame.dims, band=band_records(freq_range))
+    else:
+        data = frame.writable()
+        butterworth_array(data, frame.samplerate, freq_range, order=order, filt_type=filt_type,
+                          axis=frame.axis('time'), cpus=cpus, out=data)
+
+
+def _line_noise(frame, freq=60., harmonics=2, bandwidth=4., order=4, cpus=1):
+    """Stage equivalent to :class:`LineNoiseFilter`"""
+    data = frame.writable()
+    line_noise_array(data, frame.samplerate, freq, harmonics, bandwidth, order, axis=frame.axis('time'), cpus=cpus,
+                     out=data)
+
+
+def _resample(frame, resamplerate, round_to_original_timepoints=False, time_axis_name='time', method='fft',
+              chunk_size=0):
+    """Stage equivalent to :class:`ResampleFilter`"""
+    time_axis = frame.coord(time_axis_name)
+    resampled = resample_array(frame.data, frame.samplerate, resamplerate, axis=frame.axis(time_axis_name),
+                               method=method, chunk_size=chunk_size)
+    new_time_axis = resampled_time_axis(time_axis, resampled_length(len(time_axis), frame.samplerate, resamplerate),
+                                        time_axis_name, round_to_original_timepoints)
+    frame.replace(resampled, **{time_axis_name: new_time_axis})
+    frame.samplerate = float(resamplerate)
+
+
+def _morlet(frame, freqs, width=5, output=('power', 'phase'), cpus=1, output_dim='output', complete=True):
+    """Stage equivalent to :class:`MorletWaveletFilter`"""
+    outputs = morlet_outputs(output)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    axis = frame.axis('time')
+    transformed = morlet_transform(frame.data, frame.samplerate, freqs, width=width, output=outputs, axis=axis,
+                                   cpus=cpus, complete=complete)
+    dims = ['frequency'] + frame.dims[:axis] + frame.dims[axis + 1:] + ['time']
+    coords = {'frequency': freqs}
+    if len(outputs) > 1:
+        dims = [output_dim] + dims
+        coords[output_dim] = np.array(outputs)
+    frame.replace(transformed, dims=dims, **coords)
+
+
+def _remove_buffer(frame, duration):
+    """Stage equivalent to :meth:`TimeSeries.remove_buffer`"""
+    samples = int(np.ceil(frame.samplerate * duration))
+    time_axis = frame.coord('time')
+    if samples > len(time_axis):
+        raise ValueError("Requested removal time is longer than the data")
+    if samples > 0:
+        index = [slice(None)] * frame.data.ndim
+        index[frame.axis('time')] = slice(samples, -samples)
+        # a view: the pipeline keeps ownership of the buffer
+        frame.data = frame.data[tuple(index)]
+        frame.coords['time'] = time_axis[samples:-samples]
+
+
+_STAGES = {
+    'bipolar': _bipolar,
+    'rereference': _rereference,
+    'butterworth': _butterworth,
+    'line_noise': _line_noise,
+    'resample': _resample,
+    'morlet': _morlet,
+    'remove_buffer': _remove_buffer,
+}
+
+_FILTER_STAGES = {
+    MonopolarToBipolarMapper: 'bipolar',
+    RereferenceFilter: 'rereference',
+    ButterworthFilter: 'butterworth',
+    LineNoiseFilter: 'line_noise',
+    ResampleFilter: 'resample',
+    MorletWaveletFilter: 'morlet',
+}
+
+
+class Pipeline(traits.api.HasTraits):
+    """Runs a sequence of filters on a time series without constructing intermediate :class:`TimeSeries`.
+
+    Axes are resolved by name once per stage, stages that keep the shape of the data (Butterworth and line noise
+    filtering) overwrite the pipeline's own buffer instead of allocating a new one, and the coords of the output are
+    built once, reusing those of the input along the dims that are left unchanged. The output has the same data, dims
+    and coords as chaining the filters, and keeps the name and attrs of the input.
+
+    Parameters
+    ----------
+    stages: list
+        ``(stage, kwargs)`` pairs, where stage is one of the filter classes
+        :class:`MonopolarToBipolarMapper`, :class:`ButterworthFilter`,
+        :class:`LineNoiseFilter`, :class:`RereferenceFilter`,
+        :class:`ResampleFilter` and :class:`MorletWaveletFilter`, or one of the
+        names ``'bipolar'``, ``'butterworth'``, ``'line_noise'``,
+        ``'rereference'``, ``'resample'``, ``'morlet'`` and
+        ``'remove_buffer'``, and kwargs are the arguments of the filter
+        (besides the time series) or of :meth:`TimeSeries.remove_buffer`.
+
+    Keyword Arguments
+    -----------------
+    dtype: str or np.dtype or None
+        Floating point type of the filtered data. The input is cast once, when
+        first copied. ``None`` keeps floating point data in its type.
+        Default: ``np.float64``, like the filters
+    track_memory: bool
+        Report the memory allocated by each stage, using :mod:`tracemalloc`
+        (which slows down Python allocations while tracing). Memory allocated
+        outside numpy (e.g. by the wavelet extension) is not included.
+        Requires Python 3.9 or later; peaks are reported as None otherwise.
+        Default: True
+
+    After :meth:`run`, ``report`` holds a :class:`StageReport` per stage.
+
+    """
+    stages = traits.api.List
+    track_memory = traits.api.Bool
+
+    def __init__(self, stages, dtype=np.float64, track_memory=True):
+        super(Pipeline, self).__init__()
+        self.stages = [self._resolve(stage) for stage in stages]
+        self.dtype = dtype
+        self.track_memory = track_memory
+        self.report = []
+
+    @staticmethod
+    def _resolve(stage):
+        if isinstance(stage, (tuple, list)):
+            stage, kwargs = stage
+        else:
+            kwargs = {}
+        name = _FILTER_STAGES.get(stage, stage)
+        if name not in _STAGES:
+            raise ValueError('Unknown pipeline stage %r' % (stage,))
+        # report wrong arguments when the pipeline is created rather than when it runs
+        inspect.signature(_STAGES[name]).bind(None, **kwargs)
+        return name, dict(kwargs)
+
+    def run(self, timeseries):
+        """Applies the stages to a time series.
+
+        Parameters
+        ----------
+        timeseries: TimeSeries
+            The time series to filter. It is not modified.
+
+        Returns
+        -------
+        filtered: TimeSeries
+
+        """
+        tracing = self._tracks_memory() and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        self.report = []
+        try:
+            frame = _Frame(timeseries, self.dtype)
+            for name, kwargs in self.stages:
+                self._run_stage(name, lambda: _STAGES[name](frame, **kwargs), frame)
+            filtered = []
+            self._run_stage('coords', lambda: filtered.append(frame.to_timeseries()), frame)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        return filtered[0]
+
+    def _tracks_memory(self):
+        # peaks of individual stages can only be measured once the peak can be reset (Python 3.9+)
+        return self.track_memory and hasattr(tracemalloc, 'reset_peak')
+
+    def _run_stage(self, name, fcn, frame):
+        tracking = self._tracks_memory()
+        if tracking:
+            start_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        fcn()
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes if tracking else None
+        self.report.append(StageReport(name, seconds, peak_bytes, frame.data.shape))
+
+    def format_report(self):
+        """
+        :return: {str} table of the time, peak memory and output shape of every stage of the last run
+        """
+        lines = ['{:16s} {:>10s} {:>12s}  {}'.format('stage', 'time (s)', 'peak (MB)', 'shape')]
+        for stage in self.report:
+            peak = '{:12.1f}'.format(stage.peak_bytes / 1e6) if stage.peak_bytes is not None else '{:>12s}'.format('-')
+            lines.append('{:16s} {:10.4f} {}  {}'.format(stage.name, stage.seconds, peak, stage.shape))
+        return '\n'.join(lines)
@@ -0,0 +1,324 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import traits.api
+
+from ptsa.data.filters import BaseFilter
+from ptsa.data.timeseries import TimeSeries
+
+__all__ = [
+    'RereferenceFilter',
+    'MONTAGES',
+    'bipolar_pairs_array',
+    'montage_matrix',
+    'rereference_array',
+]
+
+MONTAGES = ('bipolar', 'average', 'laplacian', 'custom')
+
+# matrices with a larger fraction of non-zero weights are applied as dense
+# arrays (a BLAS matrix product) rather than as sparse matrices
+DENSE_FRACTION = 0.25
+
+
+def _label(channel):
+    return channel.decode() if isinstance(channel, bytes) else channel
+
+
+def _channel_indices(channels, labels):
+    """
+    :param channels: labels of the input channels
+    :param labels: labels to look up
+    :return: {np.ndarray} positions of labels in channels
+    :raises: KeyError when a label is not one of the channels
+    """
+    indices = pd.Index(channels).get_indexer(list(labels))
+    if (indices < 0).any():
+        raise KeyError('Channel[s] %s not in recording' % [labels[i] for i in np.flatnonzero(indices < 0)])
+    return indices
+
+
+def bipolar_pairs_array(bipolar_pairs, chan_names=('ch0', 'ch1')):
+    """
+    :param bipolar_pairs: 1-D structured array with chan_names fields or 2-D container of shape (2, number of pairs)
+    :param chan_names: names of the fields holding the two channels of a pair
+    :return: {np.recarray} pairs as a record array with chan_names fields
+    """
+    if np.ndim(bipolar_pairs) == 2:
+        if np.shape(bipolar_pairs)[0] != 2:
+            raise ValueError('2-D bipolar_pairs must have two rows, got shape %s' % (np.shape(bipolar_pairs),))
+        return np.core.records.fromarrays(bipolar_pairs, names=list(chan_names))
+    return bipolar_pairs
+
+
+@lru_cache(maxsize=64)
+def _montage_matrix(montage, channels, spec):
+    n = len(channels)
+    if montage == 'average':
+        weights = np.full((n, n), -1. / n)
+        weights[np.diag_indices(n)] += 1.
+        return scipy.sparse.csr_matrix(weights)
+
+    if montage == 'bipolar':
+        ch0 = _channel_indices(channels, [pair[0] for pair in spec])
+        ch1 = _channel_indices(channels, [pair[1] for pair in spec])
+        rows = np.repeat(np.arange(len(spec)), 2)
+        cols = np.column_stack([ch0, ch1]).ravel()
+        values = np.tile([1., -1.], len(spec))
+        return scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(spec), n))
+
+    if montage == 'laplacian':
+        rows, cols, values = [], [], []
+        for row, (channel, neighbors) in enumerate(spec):
+            if not len(neighbors):
+                raise ValueError('Channel %s has no neighbors' % (channel,))
+            rows.extend([row] * (len(neighbors) + 1))
+            cols.extend(_channel_indices(channels, [channel] + list(neighbors)))
+            values.extend([1.] + [-1. / len(neighbors)] * len(neighbors))
+        return scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(spec), n))
+
+    raise ValueError('montage must be one of %s' % (MONTAGES[:3],))
+
+
+def montage_matrix(montage, channels, bipolar_pairs=None, neighbors=None, chan_names=('ch0', 'ch1')):
+    """Sparse (output channels x input channels) re-referencing weights.
+
+    Matrices are memoized by montage and channels, so re-referencing many
+    batches of events with the same montage builds the matrix once.
+
+    Parameters
+    ----------
+    montage : str
+        'bipolar' (differences between the channels of each pair),
+        'average' (common average reference) or 'laplacian' (each channel
+        minus the mean of its neighbors)
+    channels : array-like
+        Labels of the input channels
+    bipolar_pairs : array-like
+        Pairs for the bipolar montage, see :func:`bipolar_pairs_array`
+    neighbors : dict
+        Neighbor labels of each output channel of the Laplacian montage
+    chan_names : container
+        Names of the fields holding the two channels of a bipolar pair
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+
+    """
+    channels = tuple(_label(c) for c in np.asarray(channels).tolist())
+    if montage == 'bipolar':
+        pairs = bipolar_pairs_array(bipolar_pairs, chan_names)
+        spec = tuple((_label(a), _label(b))
+                     for a, b in zip(np.asarray(pairs[chan_names[0]]).tolist(),
+                                     np.asarray(pairs[chan_names[1]]).tolist()))
+    elif montage == 'laplacian':
+        spec = tuple((_label(channel), tuple(_label(n) for n in neighbors[channel])) for channel in neighbors)
+    else:
+        spec = None
+    # copy so that callers cannot modify the cached matrix
+    return _montage_matrix(montage, channels, spec).copy()
+
+
+def _apply_rows(weights, rows, result):
+    """Computes result = weights @ rows, writing to result without temporaries of its size"""
+    if not scipy.sparse.issparse(weights):
+        np.matmul(weights, rows, out=result)
+        return
+
+    scratch = None
+    for i in range(weights.shape[0]):
+        start, stop = weights.indptr[i], weights.indptr[i + 1]
+        if start == stop:
+            result[i] = 0
+            continue
+        for k in range(start, stop):
+            channel, weight = rows[weights.indices[k]], weights.data[k]
+            if k == start:
+                np.multiply(channel, weight, out=result[i], casting='unsafe')
+            elif weight == 1:
+                np.add(result[i], channel, out=result[i], casting='unsafe')
+            elif weight == -1:
+                np.subtract(result[i], channel, out=result[i], casting='unsafe')
+            else:
+                if scratch is None:
+                    scratch = np.empty(rows.shape[1], dtype=result.dtype)
+                np.multiply(channel, weight, out=scratch, casting='unsafe')
+                result[i] += scratch
+
+
+def rereference_array(weights, data, axis=0, chunk_axis=None, chunk_size=0, out=None):
+    """Applies re-referencing weights along the channel axis of an array.
+
+    The non-channel axes are flattened so that each chunk is re-referenced
+    with a single product: a BLAS matrix product for dense weights, or
+    accumulation of the weighted input channels of every output channel for
+    sparse weights (e.g. bipolar and Laplacian montages).
+
+    :param weights: {scipy.sparse.spmatrix or np.ndarray} (output channels x input channels) weights
+    :param data: {np.ndarray} data with the input channels along axis
+    :param axis: {int} channel axis
+    :param chunk_axis: {int} axis along which to process data in chunks (e.g. events). None processes all at once
+    :param chunk_size: {int} entries of chunk_axis per chunk. 0 processes all at once
+    :param out: {np.ndarray} array to write the result to
+    :return: {np.ndarray} data with the output channels along axis
+    """
+    axis = axis % data.ndim
+    shape = list(data.shape)
+    shape[axis] = weights.shape[0]
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(data.dtype, weights.dtype))
+    elif out.shape != tuple(shape):
+        raise ValueError('out must have shape %s' % (tuple(shape),))
+
+    if scipy.sparse.issparse(weights):
+        if weights.nnz > DENSE_FRACTION * np.prod(weights.shape):
+            weights = weights.toarray()
+        else:
+            weights = scipy.sparse.csr_matrix(weights)
+
+    if chunk_axis is None or chunk_size <= 0:
+        chunk_axis, chunk_size = axis, data.shape[axis]
+    index = [slice(None)] * data.ndim
+    for start in range(0, max(data.shape[chunk_axis], 1), max(chunk_size, 1)):
+        if chunk_axis != axis:
+            index[chunk_axis] = slice(start, start + chunk_size)
+        block = np.moveaxis(data[tuple(index)], axis, 0)
+        rows = block.reshape(block.shape[0], -1)
+        target = np.moveaxis(out[tuple(index)], axis, 0)
+        # write to out directly when its layout allows
+        result = target.reshape(target.shape[0], -1)
+        direct = np.may_share_memory(result, target)
+        if not direct:
+            result = np.empty(result.shape, dtype=out.dtype)
+        _apply_rows(weights, rows, result)
+        if not direct:
+            target[...] = result.reshape(target.shape)
+    return out
+
+
+class RereferenceFilter(BaseFilter):
+    """Re-references the channels of a time series.
+
+    The montage is expressed as a sparse (output channels x input channels)
+    weight matrix, cached per montage (see :func:`montage_matrix`), and
+    applied with one matrix product over all other dimensions, without
+    selecting copies of the channels. Large sets of events can be processed
+    in chunks to bound the working memory. The data is converted to
+    floating point one chunk at a time.
+
+    Parameters
+    ----------
+    timeseries: TimeSeries
+        The time series to re-reference
+
+    Keyword Arguments
+    -----------------
+    montage: str
+        'bipolar', 'average' (common average reference, default),
+        'laplacian' or 'custom'
+    bipolar_pairs: array-like
+        Pairs for the bipolar montage, as accepted by
+        :class:`MonopolarToBipolarMapper`. They become the coordinate of the
+        channels dimension, as with the mapper.
+    neighbors: dict
+        Neighbor labels of each channel for the Laplacian montage. The
+        output has one channel per key.
+    weights: np.ndarray or scipy.sparse.spmatrix
+        (output channels x input channels) weights for the custom montage,
+        with columns in the order of the channels of the time series
+    out_channels: array-like
+        Labels of the output channels of the custom montage
+    channels_dim: str
+        Name of the channels dimension
+    chan_names: container
+        Names of the fields holding the two channels of a bipolar pair
+    chunk_dim: str
+        Dimension along which to process the data in chunks. Default:
+        ``'events'``, or the first other dimension if there is none
+    chunk_size: int
+        Entries of chunk_dim per chunk. 0 (default) processes all at once
+    out: np.ndarray or TimeSeries
+        Array to write the re-referenced data to
+
+    """
+    montage = traits.api.Enum(*MONTAGES)
+    chunk_size = traits.api.Int
+
+    def __init__(self, timeseries, montage='average', bipolar_pairs=None, neighbors=None, weights=None,
+                 out_channels=None, channels_dim='channels', chan_names=('ch0', 'ch1'), chunk_dim='events',
+                 chunk_size=0, out=None):
+        super(RereferenceFilter, self).__init__(timeseries, dtype=None, out=out)
+        self.montage = montage
+        self.channels_dim = channels_dim
+        self.chan_names = chan_names
+        self.chunk_dim = chunk_dim
+        self.chunk_size = chunk_size
+        self.bipolar_pairs = None
+        self.neighbors = neighbors
+        self.weights = weights
+        self.out_channels = out_channels
+
+        if montage == 'bipolar':
+            if bipolar_pairs is None:
+                raise ValueError('The bipolar montage requires bipolar_pairs')
+            self.bipolar_pairs = bipolar_pairs_array(bipolar_pairs, chan_names)
+        elif montage == 'laplacian' and not neighbors:
+            raise ValueError('The Laplacian montage requires neighbors')
+        elif montage == 'custom':
+            if weights is None or out_channels is None:
+                raise ValueError('The custom montage requires weights and out_channels')
+            if np.shape(weights) != (len(out_channels), len(self.timeseries[channels_dim])):
+                raise ValueError('weights must have shape (len(out_channels), number of channels)')
+
+    def matrix(self):
+        """
+        :return: {scipy.sparse.csr_matrix} (output channels x input channels) weights of the montage
+        """
+        if self.montage == 'custom':
+            return scipy.sparse.csr_matrix(self.weights, dtype=np.float64)
+        return montage_matrix(self.montage, self.timeseries[self.channels_dim].values,
+                              bipolar_pairs=self.bipolar_pairs, neighbors=self.neighbors,
+                              chan_names=self.chan_names)
+
+    def output_channels(self):
+        """
+        :return: coordinate of the channels dimension of the output
+        """
+        if self.montage == 'bipolar':
+            return self.bipolar_pairs
+        if self.montage == 'laplacian':
+            return np.array(list(self.neighbors))
+        if self.montage == 'custom':
+            return np.asarray(self.out_channels)
+        return self.timeseries[self.channels_dim].values
+
+    def filter(self):
+        """Apply the montage.
+
+        Returns
+        -------
+        A TimeSeries object.
+
+        """
+        weights = self.matrix()
+        dims = self.timeseries.dims
+        axis = self.timeseries.get_axis_num(self.channels_dim)
+        other_dims = [dim for dim in dims if dim != self.channels_dim]
+        chunk_dim = self.chunk_dim if self.chunk_dim in other_dims else (other_dims[:1] or [None])[0]
+        chunk_axis = dims.index(chunk_dim) if chunk_dim is not None else None
+
+        data = self.timeseries.data
+        shape = list(data.shape)
+        shape[axis] = weights.shape[0]
+        rereferenced = rereference_array(
+            weights, data, axis=axis, chunk_axis=chunk_axis, chunk_size=self.chunk_size,
+            out=self.output_buffer(shape, np.result_type(data.dtype, weights.dtype)))
+
+        coords = {name: coord for name, coord in self.timeseries.coords.items()
+                  if self.channels_dim not in coord.dims}
+        coords[self.channels_dim] = self.output_channels()
+        return TimeSeries(rereferenced, dims=dims, coords=coords, name=self.timeseries.name,
+                          attrs=self.timeseries.attrs.copy())
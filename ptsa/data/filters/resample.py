@@ -1,10 +1,204 @@
+from fractions import Fraction
+from math import gcd
+
 import numpy as np
-from scipy.signal import resample
+from scipy.signal import resample, resample_poly
 
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import BaseFilter
 import traits.api
 
+__all__ = [
+    'ResampleFilter',
+    'RESAMPLE_METHODS',
+    'rational_ratio',
+    'resample_poly_chunks',
+    'resample_array',
+    'resampled_length',
+    'resampled_time',
+    'resampled_time_axis',
+]
+
+RESAMPLE_METHODS = ('fft', 'polyphase')
+
+# Default anti-aliasing window of scipy.signal.resample_poly
+POLYPHASE_WINDOW = ('kaiser', 5.0)
+
+
+def rational_ratio(samplerate, resamplerate, max_denominator=1000):
+    """
+    Expresses the ratio of two sample rates as a fraction of small integers, as needed for polyphase resampling
+
+    :param samplerate: {float} original sample rate
+    :param resamplerate: {float} new sample rate
+    :param max_denominator: {int} largest downsampling factor accepted
+    :return: {tuple} (up, down) with resamplerate / samplerate == up / down, or None if there is no such pair with
+        down <= max_denominator
+    """
+    ratio = Fraction(resamplerate / samplerate).limit_denominator(max_denominator)
+    if ratio == 0 or not np.isclose(float(ratio) * samplerate, resamplerate, rtol=1e-9, atol=0):
+        return None
+    return ratio.numerator, ratio.denominator
+
+
+def _take(x, start, stop, axis):
+    index = [slice(None)] * len(x.shape)
+    index[axis] = slice(start, stop)
+    return x[tuple(index)]
+
+
+def resample_poly_chunks(x, up, down, chunk_size, axis=-1, window=POLYPHASE_WINDOW):
+    """
+    Computes scipy.signal.resample_poly(x, up, down, axis=axis, window=window) in consecutive blocks from chunks of
+    roughly chunk_size input samples.
+
+    Every chunk is read together with enough neighbouring samples to cover the anti-aliasing filter, so the blocks
+    join into exactly the output of a single call while only a chunk of the input (and of the output) is held in
+    memory at a time. x can be any array supporting slicing (e.g. a np.memmap or an h5py dataset).
+
+    :param x: array to resample
+    :param up: {int} upsampling factor
+    :param down: {int} downsampling factor
+    :param chunk_size: {int} number of input samples per chunk
+    :param axis: {int} axis to resample
+    :param window: anti-aliasing window passed to resample_poly
+    :return: generator of consecutive output blocks
+    """
+    g = gcd(up, down)
+    up //= g
+    down //= g
+    axis = axis % len(x.shape)
+    n_in = x.shape[axis]
+    n_out = -(-n_in * up // down)
+
+    if isinstance(window, (list, np.ndarray)):
+        half_len = (len(window) - 1) // 2
+    else:
+        half_len = 10 * max(up, down)
+    # input samples on either side of an output sample that contribute to it
+    reach = -(-half_len // up) + 1
+
+    # blocks start at multiples of up outputs so that their first input sample is a multiple of down, where the
+    # filter phases line up with those of the whole signal
+    step = max(up, chunk_size * up // down // up * up)
+    for k0 in range(0, n_out, step):
+        k1 = min(k0 + step, n_out)
+        i0 = max(0, (k0 * down // up - reach) // down * down)
+        i1 = min(n_in, -(-k1 * down // up) + reach)
+        segment = np.asarray(_take(x, i0, i1, axis))
+        if segment.dtype.kind not in 'fc':
+            segment = segment.astype(np.float64)
+        resampled = resample_poly(segment, up, down, axis=axis, window=window)
+        j0 = k0 - i0 * up // down
+        yield _take(resampled, j0, j0 + k1 - k0, axis)
+
+
+def resample_array(x, samplerate, resamplerate, axis=-1, method='fft', chunk_size=0, window=None, out=None):
+    """
+    Resamples an array to round(n * resamplerate / samplerate) samples along axis
+
+    :param x: {np.ndarray} array to resample
+    :param samplerate: {float} sample rate of x
+    :param resamplerate: {float} new sample rate
+    :param axis: {int} time axis
+    :param method: {str} 'fft' for Fourier resampling (scipy.signal.resample), which assumes the signal is periodic,
+        or 'polyphase' for rational-ratio polyphase filtering (scipy.signal.resample_poly), which requires the ratio
+        of the rates to be a fraction with a denominator of at most 1000 and pads the edges with zeros
+    :param chunk_size: {int} when positive, polyphase resampling is done in chunks of this many input samples
+    :param window: spectral window for 'fft' (see scipy.signal.resample) or anti-aliasing window for 'polyphase'
+        (defaults to the one of scipy.signal.resample_poly)
+    :param out: {np.ndarray} array of the shape of the result to write it to. Chunked resampling writes the blocks
+        to it directly
+    :return: {np.ndarray} resampled array
+    """
+    if method not in RESAMPLE_METHODS:
+        raise ValueError('method must be one of %s' % (RESAMPLE_METHODS,))
+    axis = axis % x.ndim
+    new_length = resampled_length(x.shape[axis], samplerate, resamplerate)
+    shape = list(x.shape)
+    shape[axis] = new_length
+    if out is not None and out.shape != tuple(shape):
+        raise ValueError('out must have shape %s' % (tuple(shape),))
+
+    def result(resampled):
+        if out is None:
+            return resampled
+        out[...] = resampled
+        return out
+
+    if method == 'fft':
+        if chunk_size > 0:
+            raise ValueError('Chunked resampling requires method="polyphase"')
+        return result(resample(x, new_length, axis=axis, window=window))
+
+    ratio = rational_ratio(samplerate, resamplerate)
+    if ratio is None:
+        raise ValueError('Cannot resample from %s Hz to %s Hz with a polyphase filter: the ratio of the sample rates '
+                         'is not a simple fraction' % (samplerate, resamplerate))
+    up, down = ratio
+    if window is None:
+        window = POLYPHASE_WINDOW
+
+    if chunk_size <= 0:
+        if x.dtype.kind not in 'fc':
+            x = x.astype(np.float64)
+        return result(_take(resample_poly(x, up, down, axis=axis, window=window), 0, new_length, axis))
+
+    resampled = out
+    start = 0
+    for block in resample_poly_chunks(x, up, down, chunk_size, axis=axis, window=window):
+        if resampled is None:
+            resampled = np.empty(shape, dtype=block.dtype)
+        block = _take(block, 0, new_length - start, axis)
+        _take(resampled, start, start + block.shape[axis], axis)[...] = block
+        start += block.shape[axis]
+        if start == new_length:
+            break
+    return resampled
+
+
+def resampled_length(length, samplerate, resamplerate):
+    """
+    :param length: {int} number of samples
+    :param samplerate: {float} original sample rate
+    :param resamplerate: {float} new sample rate
+    :return: {int} number of samples after resampling
+    """
+    return int(np.round(length * resamplerate / float(samplerate)))
+
+
+def resampled_time(t, num):
+    """
+    Time points of a resampled time axis, computed as scipy.signal.resample does
+
+    :param t: {np.ndarray} original, equally spaced time points
+    :param num: {int} number of resampled points
+    :return: {np.ndarray}
+    """
+    t = np.asarray(t)
+    return np.arange(0, num) * (t[1] - t[0]) * len(t) / float(num) + t[0]
+
+
+def resampled_time_axis(time_axis, num, time_axis_name='time', round_to_original_timepoints=False):
+    """
+    Time axis of a resampled time series
+
+    :param time_axis: {np.ndarray} original time axis, either time points or a record array with a time_axis_name
+        field holding them
+    :param num: {int} number of resampled points
+    :param time_axis_name: {str} name of the field holding the time points of a record array time axis
+    :param round_to_original_timepoints: {bool} reuse the entries of the original time axis closest to the resampled
+        time points
+    :return: {np.ndarray}
+    """
+    time_axis = np.asarray(time_axis)
+    if round_to_original_timepoints:
+        return time_axis[np.rint(resampled_time(np.arange(len(time_axis)), num)).astype(int)]
+    # time axis can be recarray with one of the arrays being time
+    if time_axis.dtype.names is not None:
+        time_axis = time_axis[time_axis_name]
+    return resampled_time(time_axis, num)
+
 
 class ResampleFilter(BaseFilter):
     """Upsample or downsample a time series to a new sample rate.
@@ -26,18 +220,36 @@ class ResampleFilter(BaseFilter):
         should be reused after proper rounding. Defaults to False
     time_axis_name: str
         Name of the time axis.
+    method: str
+        ``'fft'`` (default) for Fourier resampling, which treats the signal as
+        periodic, or ``'polyphase'`` for rational-ratio polyphase filtering,
+        which is much faster for long or odd-length signals and does not wrap
+        signal around the edges. Polyphase resampling requires the ratio of
+        the sample rates to be a fraction with a denominator of at most 1000
+        (e.g. 1000 Hz to 256 Hz).
+    chunk_size: int
+        When positive, polyphase resampling is done in chunks of this many
+        samples so that the working memory stays bounded for session-length
+        data. The result is identical to resampling in one pass. Default: 0
+    out: np.ndarray or TimeSeries
+        Array to write the resampled data to, with the shape of the output
 
     """
 
     resamplerate = traits.api.CFloat
     round_to_original_timepoints = traits.api.Bool
+    method = traits.api.Enum(*RESAMPLE_METHODS)
+    chunk_size = traits.api.Int
 
     def __init__(self, timeseries, resamplerate,
-                 round_to_original_timepoints=False, time_axis_name='time'):
-        super(ResampleFilter, self).__init__(timeseries=timeseries)
+                 round_to_original_timepoints=False, time_axis_name='time',
+                 method='fft', chunk_size=0, out=None):
+        super(ResampleFilter, self).__init__(timeseries=timeseries, out=out)
         self.resamplerate = resamplerate
         self.round_to_original_timepoints = round_to_original_timepoints
         self.time_axis_name = time_axis_name
+        self.method = method
+        self.chunk_size = chunk_size
 
     def filter(self):
         """resamples time series
@@ -56,36 +268,22 @@ class ResampleFilter(BaseFilter):
         time_axis = self.timeseries.coords[
             self.timeseries.dims[self.time_axis_index]]
 
-        time_axis_length = len(time_axis)
-        new_length = int(np.round(
-            time_axis_length*self.resamplerate/samplerate))
-
-        try:
-            # time axis can be recarray with one of the arrays being time
-            time_axis_data = time_axis.data[self.time_axis_name]
-        except (KeyError, IndexError) as excp:
-            # if we get here then most likely time axis is ndarray of floats
-            time_axis_data = time_axis.data
-
-        time_idx_array = np.arange(len(time_axis))
-
-        if self.round_to_original_timepoints:
-            filtered_array, new_time_idx_array = resample(
-                self.timeseries.data, new_length, t=time_idx_array,
-                axis=self.time_axis_index)
-
-            # print new_time_axis
-
-            new_time_idx_array = np.rint(new_time_idx_array).astype(np.int)
+        new_length = resampled_length(len(time_axis), samplerate,
+                                      self.resamplerate)
 
-            new_time_axis = time_axis[new_time_idx_array]
+        out = None
+        if self.out is not None:
+            shape = list(self.timeseries.shape)
+            shape[self.time_axis_index] = new_length
+            out = self.output_buffer(shape, self.timeseries.dtype)
+        filtered_array = resample_array(
+            self.timeseries.data, samplerate, self.resamplerate,
+            axis=self.time_axis_index, method=self.method,
+            chunk_size=self.chunk_size, out=out)
 
-        else:
-            filtered_array, new_time_axis = \
-                resample(self.timeseries.data,
-                         new_length,
-                         t=time_axis_data,
-                         axis=self.time_axis_index)
+        new_time_axis = resampled_time_axis(
+            time_axis.values, new_length, self.time_axis_name,
+            self.round_to_original_timepoints)
 
         coords = {}
         for i, dim_name in enumerate(self.timeseries.dims):
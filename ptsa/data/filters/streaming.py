@@ -0,0 +1,126 @@
+from collections import deque
+from itertools import chain
+
+import numpy as np
+import traits.api
+
+from ptsa.filt import butter_sos, sosfilt_blocks, sosfiltfilt_blocks
+
+__all__ = ['StreamingFilter']
+
+
+class StreamingFilter(traits.api.HasTraits):
+    """Butterworth filtering of a session delivered as a sequence of
+    :class:`TimeSeries` chunks, in constant memory.
+
+    Unlike :class:`ButterworthFilter`, which needs the whole session in
+    memory, chunks are filtered as they arrive (e.g. from a reader reading a
+    session block by block) and filtered chunks are yielded in the same
+    order, with the same coords, dims and attrs.
+
+    Keyword Arguments
+    -----------------
+    freq_range: list-like
+        Array [min_freq, max_freq] describing the filter range
+    order: int
+        Butterworth filter order
+    filt_type: str
+        'stop' (default), 'pass', 'low' or 'high'
+    mode: str
+        'zero_phase' (default) to filter forward and backward like
+        :class:`ButterworthFilter`, using overlap-and-discard with ``padding``
+        seconds of context on each side of a chunk; or 'causal' to filter
+        forward only, carrying the filter state from chunk to chunk so that
+        the output is identical to filtering the whole session at once.
+    padding: float
+        Seconds of context for zero-phase filtering. 0 (default) uses the
+        length of the impulse response of the filter, which keeps the output
+        within about 1e-8 (relative) of filtering the whole session. Chunks
+        are yielded once this much of the following chunks has arrived.
+    sos: np.ndarray
+        Second-order sections to use instead of the Butterworth design
+    time_axis_name: str
+        Name of the time axis
+
+    Example
+    -------
+    >>> streaming = StreamingFilter([58., 62.])
+    >>> for filtered in streaming.filter(chunks):
+    ...     process(filtered)
+
+    """
+    freq_range = traits.api.CList(maxlen=2)
+    order = traits.api.Int
+    filt_type = traits.api.Str
+    mode = traits.api.Enum('zero_phase', 'causal')
+    padding = traits.api.CFloat
+
+    def __init__(self, freq_range=(), order=4, filt_type='stop',
+                 mode='zero_phase', padding=0., sos=None,
+                 time_axis_name='time'):
+        super(StreamingFilter, self).__init__()
+        self.freq_range = list(freq_range)
+        self.order = order
+        self.filt_type = filt_type
+        self.mode = mode
+        self.padding = padding
+        self.sos = sos
+        self.time_axis_name = time_axis_name
+
+    def design(self, samplerate):
+        """
+        :param samplerate: {float} sample rate of the session
+        :return: {np.ndarray} the filter as second-order sections
+        """
+        if self.sos is not None:
+            return np.asarray(self.sos)
+        return butter_sos(self.order, self.freq_range, samplerate,
+                          self.filt_type)
+
+    def filter(self, chunks):
+        """Filters consecutive chunks of a session.
+
+        Parameters
+        ----------
+        chunks: iterable of TimeSeries
+            Consecutive chunks of the session with the same dims, sample
+            rate and coords except along the time axis.
+
+        Yields
+        ------
+        filtered: TimeSeries
+            Filtered chunks, one per input chunk
+
+        """
+        chunks = iter(chunks)
+        try:
+            first = next(chunks)
+        except StopIteration:
+            return
+
+        samplerate = float(first['samplerate'])
+        sos = self.design(samplerate)
+        axis = first.get_axis_num(self.time_axis_name)
+
+        # input chunks whose filtered data has not been yielded yet
+        waiting = deque()
+
+        def arrays():
+            for chunk in chain([first], chunks):
+                if chunk.get_axis_num(self.time_axis_name) != axis:
+                    raise ValueError("All chunks must have the same dims")
+                waiting.append(chunk)
+                yield chunk.data
+
+        if self.mode == 'causal':
+            filtered_arrays = sosfilt_blocks(sos, arrays(), axis=axis)
+        else:
+            padding = (int(round(self.padding * samplerate))
+                       if self.padding > 0 else None)
+            filtered_arrays = sosfiltfilt_blocks(sos, arrays(),
+                                                 padding=padding, axis=axis)
+
+        for filtered in filtered_arrays:
+            chunk = waiting.popleft()
+            yield chunk.copy(data=filtered)
+
@@ -3,10 +3,15 @@ from .edf import EDFRawReader
 from .eeg import EEGReader
 from .events import *
 from .hdf5 import H5RawReader
+from .h5pool import H5FilePool, h5_file_pool
 from .index import JsonIndexReader
 from .netcdf import NetCDF4XrayReader
 from .params import ParamsReader
+from .cache import MetadataCache, metadata_cache
+from .read_cache import ReadCache
+from .planner import ReadPlan, plan_reads
 from ptsa.data.readers.base import BaseRawReader
 from .tal import *
 from .binary import BinaryRawReader
 from .localization import LocReader
+from .store import SessionStoreReader, transcode, verify_store
@@ -379,6 +379,11 @@ class BaseRawReader(BaseReader):
     * Set self.params_dict['gain'] and self.params_dict['samplerate'] as appropriate,
       either in self.read_file or in the constructor
     * Make sure that self.channel_name as appropriate for the referencing scheme used
+    * Allocate output arrays with :meth:`empty_eventdata` using :meth:`output_dtype`
+      and override :meth:`native_dtype` if samples are stored in a type other than float64
+    * Override :meth:`output_channels` if the channels of the output are only known once the file is opened
+    * Optionally keep files open between reads when :attr:`keep_open` is set and close them in :meth:`close`
+    * Optionally honor :attr:`read_strategy` and store the :class:`ReadPlan` of each channel file in :attr:`read_plan`
     """
 
     dataroot = traits.api.Str
@@ -386,10 +391,15 @@ class BaseRawReader(BaseReader):
     channel_labels = traits.api.CArray
     start_offsets = traits.api.CArray
     read_size = traits.api.Int
+    dtype = traits.api.Enum('float64', 'float32', 'native')
+    workers = traits.api.Int
+    keep_open = traits.api.Bool
+    read_strategy = traits.api.Enum('auto', 'events', 'coalesced', 'session')
 
     channel_name = 'channels'
 
-    def __init__(self, dataroot,channels=tuple(),start_offsets=tuple([0]),read_size=-1):
+    def __init__(self, dataroot,channels=tuple(),start_offsets=tuple([0]),read_size=-1,dtype='float64',
+                 workers=1,read_strategy='auto'):
         """
         Constructor
         :param dataroot {str} -  core name of the eegfile file (i.e. full path except extension e.g. '.002').
@@ -398,6 +408,14 @@ class BaseRawReader(BaseReader):
         :param channels {array-like} - array of channels (array of strings) that should be read
         :param start_offsets {array-like} -  array of ints with read offsets
         :param read_size {int} - size of the read chunk. If -1 the entire file is read
+        :param dtype {str} - type of the returned data: 'float64' (default), 'float32' or 'native'. 'native' keeps
+        the samples in the type they are stored in on disk and does not apply the gain; the gain is stored in the
+        'scale' attribute of the output instead (see :meth:`ptsa.data.timeseries.TimeSeries.scaled`)
+        :param workers {int} - number of threads readers that support it use to read channels in parallel
+        :param read_strategy {str} - how readers that plan their reads fetch the requested windows: 'events' (one
+        read per window), 'coalesced' (overlapping and nearby windows are merged into a single read), 'session' (the
+        whole file is read sequentially and sliced in memory) or 'auto' (default) to pick the cheapest one (see
+        :func:`ptsa.data.readers.planner.plan_reads`). The plan used by the last read is stored in :attr:`read_plan`
         :return:None
 
         """
@@ -405,6 +423,10 @@ class BaseRawReader(BaseReader):
         self.channels = channels
         self.start_offsets = start_offsets
         self.read_size = read_size
+        self.dtype = dtype
+        self.workers = workers
+        self.read_strategy = read_strategy
+        self.read_plan = None
         self.params_dict = self.init_params()
         if self.channels.dtype.names is None:
             self.channel_labels = self.channels
@@ -412,15 +434,52 @@ class BaseRawReader(BaseReader):
             self.channel_labels = self.channels['channel']
 
 
+    def close(self):
+        """
+        Closes any files kept open between reads when :attr:`keep_open` is set. Readers that do not keep files open
+        do not need to override this.
+        """
+        pass
+
     def init_params(self):
         from ptsa.data.readers.params import ParamsReader
         p_reader = ParamsReader(dataroot=self.dataroot)
+        self.params_filename = p_reader.filename
         return p_reader.read()
 
     def channel_labels_to_string(self):
         if np.issubdtype(self.channel_labels.dtype,np.integer):
             self.channel_labels = np.array(['{:03}'.format(c).encode() for c in self.channel_labels])
 
+    def native_dtype(self):
+        """
+        :return: {np.dtype} type of the samples as stored on disk. Readers that return already converted data
+        (e.g. physical units) use float64
+        """
+        return np.dtype(np.float64)
+
+    def output_dtype(self):
+        """
+        :return: {np.dtype} type of the array returned by :meth:`read_file` given the requested :attr:`dtype`
+        """
+        if self.dtype == 'native':
+            return self.native_dtype()
+        return np.dtype(self.dtype)
+
+    @staticmethod
+    def empty_eventdata(shape, dtype=np.float64):
+        """
+        Allocates an output array for :meth:`read_file`. Floating point arrays are filled with NaN, integer arrays
+        (which cannot hold NaN) with 0 - use the read_ok_mask to tell which chunks were read.
+
+        :param shape: {tuple} shape of the array
+        :param dtype: {np.dtype} type of the array
+        :return: {np.ndarray}
+        """
+        dtype = np.dtype(dtype)
+        fill_value = np.nan if np.issubdtype(dtype, np.inexact) else 0
+        return np.full(shape, fill_value, dtype=dtype)
+
 
     def read(self):
         """Read EEG data.
@@ -431,7 +490,9 @@ class BaseRawReader(BaseReader):
             Populated with data read from eeg files. The size of the output is
             number of channels * number of start offsets * number of time series
             points. The corresponding DataArray axes are: 'channels',
-            'start_offsets', 'offsets'
+            'start_offsets', 'offsets'. When :attr:`dtype` is ``'native'``
+            the gain is not applied; it is stored in the ``scale`` attribute
+            instead.
         read_ok_mask : np.ndarray
             Mask of chunks that were properly read.
 
@@ -447,8 +508,9 @@ class BaseRawReader(BaseReader):
                                                  self.channel_labels,
                                                  self.start_offsets,
                                                  self.read_size)
-        # multiply by the gain
-        eventdata *= self.params_dict['gain']
+        # multiply by the gain unless we keep the samples as stored
+        if self.dtype != 'native':
+            eventdata *= self.params_dict['gain']
 
         eventdata = DataArray(eventdata,
                               dims=[self.channel_name, 'start_offsets', 'offsets'],
@@ -460,11 +522,89 @@ class BaseRawReader(BaseReader):
                               }
                               )
 
-        from copy import deepcopy
-        eventdata.attrs = deepcopy(self.params_dict)
+        eventdata.attrs = self.output_attrs()
 
         return eventdata, read_ok_mask
 
+    def output_channels(self):
+        """
+        :return: channels coordinate of the array returned by :meth:`read`, determined without reading any samples.
+        Readers that resolve the channels when reading (e.g. all channels of the file when none are given) override
+        this
+        """
+        return self.channels
+
+    def output_attrs(self):
+        """
+        :return: {dict} attributes of the array returned by :meth:`read`: a copy of the params, plus the gain as
+        'scale' when :attr:`dtype` is 'native'
+        """
+        from copy import deepcopy
+        attrs = deepcopy(self.params_dict)
+        if self.dtype == 'native':
+            attrs['scale'] = self.params_dict['gain']
+        return attrs
+
+    def read_into(self, out, out_indices):
+        """Read EEG data directly into rows of an existing array.
+
+        Parameters
+        ----------
+        out : np.ndarray
+            Array of shape (channels, events, read_size) to write into. Rows
+            that cannot be read are left untouched, so it should be allocated
+            with :meth:`empty_eventdata`.
+        out_indices : np.ndarray
+            Indices along the second axis of ``out`` where the data for each of
+            :attr:`start_offsets` is written.
+
+        Returns
+        -------
+        read_ok_mask : np.ndarray
+            Mask of chunks that were properly read.
+
+        Notes
+        -----
+        Like :meth:`read`, the gain is applied unless :attr:`dtype` is
+        ``'native'``. Unlike :meth:`read`, no coordinates are built.
+
+        """
+        read_ok_mask = self.read_file_into(self.dataroot,
+                                           self.channel_labels,
+                                           self.start_offsets,
+                                           self.read_size,
+                                           out, out_indices)
+        gain = self.params_dict['gain']
+        if self.dtype != 'native' and gain != 1:
+            out_indices = np.asarray(out_indices)
+            if len(out_indices) and (np.diff(out_indices) == 1).all():
+                # consecutive rows are scaled in place through a view
+                out[:, out_indices[0]:out_indices[-1] + 1] *= gain
+            else:
+                # one channel at a time: fancy indexing copies the rows it updates
+                for channel_data in out:
+                    channel_data[out_indices] *= gain
+
+        return read_ok_mask
+
+    def read_file_into(self, filename, channels, start_offsets, read_size, out, out_indices):
+        """
+        Reads raw data from binary files into rows ``out_indices`` of ``out``, which has shape
+        (len(channels), number of events, read_size).
+
+        The default implementation reads with :meth:`read_file` and copies the result into ``out``. Subclasses
+        that can write into ``out`` directly should override this.
+
+        Returns
+        -------
+        read_ok_mask : np.ndarray
+            Boolean mask indicating whether each offset was read successfully.
+
+        """
+        eventdata, read_ok_mask = self.read_file(filename, channels, start_offsets, read_size)
+        out[:, out_indices] = eventdata
+        return read_ok_mask
+
     @abstractmethod
     def read_file(self,filename,channels,start_offsets=np.array([0]),read_size=-1):
         """
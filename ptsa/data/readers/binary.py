@@ -1,36 +1,92 @@
 from ptsa.data.readers import BaseRawReader
+from ptsa.data.common import parallel_map
 from collections import namedtuple
-from .params import ParamsReader
+from .cache import MetadataCache, metadata_cache
+from .planner import plan_reads
 import six
 import warnings
 import os.path as osp
 import numpy as np
 import struct
+import traits.api
+
+# defined at module level so readers can be pickled (e.g. for process pools)
+FileFormat = namedtuple('FileFormat', ['data_size', 'format_string', 'dtype'])
+
+
+def _windows(samples, read_size):
+    """
+    :param samples: {np.ndarray} 1D array of samples
+    :param read_size: {int} number of samples in each window
+    :return: {np.ndarray} read-only (windows, read_size) view of all windows of read_size consecutive samples, so
+        epochs can be gathered without building an index array the size of the output
+    """
+    stride = samples.strides[0]
+    return np.lib.stride_tricks.as_strided(samples, shape=(max(len(samples) - read_size + 1, 0), read_size),
+                                           strides=(stride, stride), writeable=False)
+
 
 class BinaryRawReader(BaseRawReader):
+    """Reads EEG data stored as one binary file per channel (e.g.
+    ``dataroot.001``, ``dataroot.002``, ...) next to a params file.
 
-    def __init__(self,**kwargs):
+    Keyword arguments
+    -----------------
+    dataroot : str
+        Core name of the eegfile (full path except the channel extension).
+    channels : np.ndarray
+        Channels to read.
+    start_offsets : np.ndarray
+        Sample offsets at which to start reading.
+    read_size : int
+        Number of samples to read at each offset. If -1 the entire file is
+        read.
+    dtype : str
+        ``'float64'`` (default), ``'float32'`` or ``'native'`` (keep the
+        on-disk format and defer applying the gain).
+    workers : int
+        Number of threads used to read channel files in parallel (default 1).
+    use_mmap : bool
+        When True (default) each channel file is memory-mapped and all epochs
+        are gathered with a single fancy-indexing operation. When False, each
+        epoch is read with a separate seek/read call. Only used when epochs
+        are read one at a time (see ``read_strategy``).
+    read_strategy : str
+        ``'auto'`` (default) plans the reads of each dataroot from the density
+        and size of the epochs: sparse epochs are read one at a time,
+        overlapping or nearby epochs are merged into coalesced reads and
+        epochs covering most of the file are sliced out of one sequential read
+        of the whole file. ``'events'``, ``'coalesced'`` and ``'session'``
+        force a strategy. The chosen :class:`ReadPlan` is stored in
+        :attr:`read_plan`.
+
+    """
+
+    use_mmap = traits.api.Bool
+
+    def __init__(self, use_mmap=True, **kwargs):
+        self.use_mmap = use_mmap
+        self._memmaps = {}
         if 'channels' in kwargs:
             channels = kwargs['channels']
             if channels.dtype.names is not None and 'channel_1' in channels.dtype.names:
                 raise IndexError
 
         super(BinaryRawReader, self).__init__(**kwargs)
-        FileFormat = namedtuple('FileFormat', ['data_size', 'format_string'])
+        # hard-codes little endian
         self.file_format_dict = {
-            'single': FileFormat(data_size=4, format_string='f'),
-            'float32': FileFormat(data_size=4, format_string='f'),
-            'short': FileFormat(data_size=2, format_string='h'),
-            'int16': FileFormat(data_size=2, format_string='h'),
-            'int32': FileFormat(data_size=4, format_string='i'),
-            'double': FileFormat(data_size=8, format_string='d'),
-            'float64': FileFormat(data_size=8, format_string='d')
+            'single': FileFormat(data_size=4, format_string='f', dtype=np.dtype('<f4')),
+            'float32': FileFormat(data_size=4, format_string='f', dtype=np.dtype('<f4')),
+            'short': FileFormat(data_size=2, format_string='h', dtype=np.dtype('<i2')),
+            'int16': FileFormat(data_size=2, format_string='h', dtype=np.dtype('<i2')),
+            'int32': FileFormat(data_size=4, format_string='i', dtype=np.dtype('<i4')),
+            'double': FileFormat(data_size=8, format_string='d', dtype=np.dtype('<f8')),
+            'float64': FileFormat(data_size=8, format_string='d', dtype=np.dtype('<f8'))
         }
 
         self.file_format = self.file_format_dict['int16']
 
-        p_reader = ParamsReader(dataroot=self.dataroot)
-        self.params_dict = p_reader.read()
+        # self.params_dict has been read by BaseRawReader.__init__
         try:
             format_name = self.params_dict['format']
             try:
@@ -47,6 +103,9 @@ class BinaryRawReader(BaseRawReader):
     def samplerate(self):
         return super(BinaryRawReader, self).samplerate()
 
+    def native_dtype(self):
+        return self.file_format.dtype
+
     def get_file_size(self):
         """
         :return: {int} size of the files whose core name (dataroot) matches self.dataroot. Assumes ALL files with this
@@ -57,7 +116,27 @@ class BinaryRawReader(BaseRawReader):
         else:
             ch = self.channel_labels[0]
         eegfname = self.dataroot + '.' + ch
-        return osp.getsize(eegfname)
+        return self.channel_file_size(eegfname)
+
+    def channel_file_size(self, eegfname):
+        """
+        :param eegfname: {str} path to a channel file of this dataroot
+        :return: {int} size of the file in bytes. Sizes are cached until the file changes
+        """
+        return metadata_cache.get(('file_size', eegfname), lambda: osp.getsize(eegfname),
+                                  stamp_path=eegfname)
+
+    @staticmethod
+    def channel_filename(filename, channel):
+        """
+        :param filename: {str} dataroot
+        :param channel: {str or bytes} channel label
+        :return: {str} path to the file holding data for the channel
+        """
+        try:
+            return filename + '.' + channel
+        except TypeError:
+            return filename + '.' + channel.decode()
 
     def read_file(self,filename,channels,start_offsets=np.array([0]),read_size=-1):
         if read_size < 0:
@@ -65,47 +144,217 @@ class BinaryRawReader(BaseRawReader):
             self.read_size=read_size
 
         # allocate space for data
-        eventdata = np.empty((len(channels), len(start_offsets), read_size),
-                             dtype=np.float)
-        eventdata.fill(np.nan)
+        eventdata = self.empty_eventdata((len(channels), len(start_offsets), read_size),
+                                         dtype=self.output_dtype())
+        read_ok_mask = self.read_file_into(filename, channels, start_offsets, read_size,
+                                           eventdata, np.arange(len(start_offsets)))
+        return eventdata, read_ok_mask
+
+    def read_file_into(self, filename, channels, start_offsets, read_size, out, out_indices):
         read_ok_mask = np.ones(shape=(len(channels), len(start_offsets)), dtype=np.bool)
-        # loop over channels
-        for c, channel in enumerate(channels):
-            try:
-                eegfname = filename + '.' + channel
-            except TypeError:
-                eegfname = filename + '.' + channel.decode()
+        if not len(channels):
+            return read_ok_mask
+
+        # all channel files of a dataroot have the same length, so a single plan is made for all of them
+        start_offsets = np.asarray(start_offsets, dtype=np.int64)
+        num_samples = self.channel_file_size(
+            self.channel_filename(filename, channels[0])) // self.file_format.data_size
+        valid = (start_offsets >= 0) & (start_offsets + read_size <= num_samples)
+        self.read_plan = plan_reads(start_offsets[valid], read_size, num_samples, self.file_format.data_size,
+                                    strategy=self.read_strategy)
+
+        if self.read_plan.strategy != 'events':
+            ranges = self.read_plan.ranges
+
+            def read_channel(*args):
+                self.read_channel_ranges(*args, ranges=ranges)
+        elif self.use_mmap:
+            read_channel = self.read_channel_mmap
+        else:
+            read_channel = self.read_channel_seek
+
+        # each channel is written into its own rows so channels can be read concurrently
+        def read_channel_into_rows(c):
+            eegfname = self.channel_filename(filename, channels[c])
+            read_channel(eegfname, start_offsets, read_size,
+                         out[c], out_indices, read_ok_mask[c])
+
+        parallel_map(read_channel_into_rows, range(len(channels)), workers=self.workers)
 
+        return read_ok_mask
+
+    def check_offsets(self, eegfname, start_offsets, read_size, num_samples):
+        """
+        Reports epochs that start before or end after the data in a channel file.
+
+        :param eegfname: {str} path to the channel file
+        :param start_offsets: {np.ndarray} sample offsets to start reading at
+        :param read_size: {int} number of samples to read at each offset
+        :param num_samples: {int} number of samples in the file
+        :return: {np.ndarray} boolean mask of the epochs that can be read
+        """
+        negative = start_offsets < 0
+        for start_offset in start_offsets[negative]:
+            print(('Cannot read from negative offset %d in file %s' % (start_offset, eegfname)))
+
+        past_end = ~negative & (start_offsets + read_size > num_samples)
+        for start_offset in start_offsets[past_end]:
+            print((
+                'Cannot read full chunk of data for offset ' + str(start_offset) +
+                'End of read interval  is outside the bounds of file ' + str(eegfname)))
+
+        return ~(negative | past_end)
+
+    def open_memmap(self, eegfname, num_samples):
+        """
+        :param eegfname: {str} path to the channel file
+        :param num_samples: {int} number of samples in the file. Must be positive
+        :return: {np.memmap} read-only memory map of the file. It is reused between reads when keep_open is set,
+            until the modification time or size of the file changes
+        """
+        stamp = MetadataCache.stamp(eegfname)
+        stamp_and_data = self._memmaps.get(eegfname)
+        if stamp_and_data is not None and stamp_and_data[0] == stamp:
+            return stamp_and_data[1]
+        data = np.memmap(eegfname, dtype=self.file_format.dtype, mode='r',
+                         shape=(num_samples,))
+        if self.keep_open:
+            self._memmaps[eegfname] = (stamp, data)
+        return data
+
+    def read_channel_mmap(self, eegfname, start_offsets, read_size, out, out_indices, read_ok_mask):
+        """
+        Gathers all epochs of a single channel file in one fancy-indexing
+        operation over a read-only memory map of the file.
+
+        :param eegfname: {str} path to the channel file
+        :param start_offsets: {np.ndarray} sample offsets to start reading at
+        :param read_size: {int} number of samples to read at each offset
+        :param out: {np.ndarray} (events, read_size) array the data is written into
+        :param out_indices: {np.ndarray} rows of out that correspond to start_offsets
+        :param read_ok_mask: {np.ndarray} boolean array of len(start_offsets), updated in place
+        :return: None
+        """
+        start_offsets = np.asarray(start_offsets, dtype=np.int64)
+        num_samples = self.channel_file_size(eegfname) // self.file_format.data_size
+        if num_samples == 0:
+            # empty files cannot be memory-mapped
+            self.read_channel_seek(eegfname, start_offsets, read_size, out, out_indices, read_ok_mask)
+            return
+
+        ok = self.check_offsets(eegfname, start_offsets, read_size, num_samples)
+        read_ok_mask &= ok
+
+        if not ok.any():
+            return
+
+        data = self.open_memmap(eegfname, num_samples)
+
+        out[out_indices[ok]] = _windows(data, read_size)[start_offsets[ok]]
+
+    def read_channel_ranges(self, eegfname, start_offsets, read_size, out, out_indices, read_ok_mask, ranges):
+        """
+        Reads the sample ranges of a read plan from a single channel file with
+        one sequential read each and slices the epochs out of them in memory.
+
+        :param eegfname: {str} path to the channel file
+        :param start_offsets: {np.ndarray} sample offsets to start reading at
+        :param read_size: {int} number of samples to read at each offset
+        :param out: {np.ndarray} (events, read_size) array the data is written into
+        :param out_indices: {np.ndarray} rows of out that correspond to start_offsets
+        :param read_ok_mask: {np.ndarray} boolean array of len(start_offsets), updated in place
+        :param ranges: {np.ndarray} (number of reads, 2) array of sorted [start, stop) sample ranges covering the epochs
+        :return: None
+        """
+        start_offsets = np.asarray(start_offsets, dtype=np.int64)
+        num_samples = self.channel_file_size(eegfname) // self.file_format.data_size
+
+        ok = self.check_offsets(eegfname, start_offsets, read_size, num_samples)
+        read_ok_mask &= ok
+
+        if not ok.any():
+            return
+
+        ranges = ranges.copy()
+        ranges[:, 1] = np.minimum(ranges[:, 1], num_samples)
+        lengths = ranges[:, 1] - ranges[:, 0]
+        buffer_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        buffer = np.empty(lengths.sum(), dtype=self.file_format.dtype)
+        if self.keep_open and num_samples:
+            # epochs of later batches are read from the cached memory map instead of re-reading the ranges
+            data = self.open_memmap(eegfname, num_samples)
+            for (start, stop), buffer_start in zip(ranges, buffer_starts):
+                buffer[buffer_start:buffer_start + stop - start] = data[start:stop]
+        else:
             with open(eegfname, 'rb') as efile:
-                # loop over start offsets
-                for e, start_offset in enumerate(start_offsets):
-                    # rejecting negative offset
-                    if start_offset < 0:
-                        read_ok_mask[c, e] = False
-                        print(('Cannot read from negative offset %d in file %s' % (start_offset, eegfname)))
-                        continue
-
-                    # seek to the position in the file
-                    efile.seek(self.file_format.data_size * start_offset, 0)
-
-                    # read the data
-                    data = efile.read(int(self.file_format.data_size * read_size))
-
-                    # convert from string to array based on the format
-                    # hard-codes little endian
-                    fmt = '<' + str(int(len(data) / self.file_format.data_size)) + self.file_format.format_string
-                    data = np.array(struct.unpack(fmt, data))
-
-                    # make sure we got some data
-                    if len(data) < read_size:
-                        read_ok_mask[c, e] = False
-
-                        print((
-                            'Cannot read full chunk of data for offset ' + str(start_offset) +
-                            'End of read interval  is outside the bounds of file ' + str(eegfname)))
-                    else:
-                        # append it to the eventdata
-                        eventdata[c, e, :] = data
+                for (start, stop), buffer_start in zip(ranges, buffer_starts):
+                    efile.seek(start * self.file_format.data_size)
+                    efile.readinto(memoryview(buffer[buffer_start:buffer_start + stop - start]).cast('B'))
 
-        return eventdata, read_ok_mask
+        range_indices = np.searchsorted(ranges[:, 0], start_offsets, side='right') - 1
+        covered = ok & (range_indices >= 0)
+        covered[covered] = start_offsets[covered] + read_size <= ranges[range_indices[covered], 1]
+
+        positions = buffer_starts[range_indices[covered]] + start_offsets[covered] - ranges[range_indices[covered], 0]
+        out[out_indices[covered]] = _windows(buffer, read_size)[positions]
+
+        # epochs outside the plan (only possible if the channel file is longer than the one the plan was made for)
+        uncovered = ok & ~covered
+        if uncovered.any():
+            self.read_channel_mmap(eegfname, start_offsets[uncovered], read_size,
+                                   out, out_indices[uncovered], np.ones(uncovered.sum(), dtype=bool))
+
+    def close(self):
+        """Releases the memory maps kept open when :attr:`keep_open` is set."""
+        self._memmaps.clear()
+
+    def __getstate__(self):
+        # memory maps would be pickled with their contents, so they are reopened on demand instead
+        state = super(BinaryRawReader, self).__getstate__()
+        state['_memmaps'] = {}
+        return state
+
+    def read_channel_seek(self, eegfname, start_offsets, read_size, out, out_indices, read_ok_mask):
+        """
+        Reads each epoch of a single channel file with a separate seek and
+        read call.
+
+        :param eegfname: {str} path to the channel file
+        :param start_offsets: {np.ndarray} sample offsets to start reading at
+        :param read_size: {int} number of samples to read at each offset
+        :param out: {np.ndarray} (events, read_size) array the data is written into
+        :param out_indices: {np.ndarray} rows of out that correspond to start_offsets
+        :param read_ok_mask: {np.ndarray} boolean array of len(start_offsets), updated in place
+        :return: None
+        """
+        with open(eegfname, 'rb') as efile:
+            # loop over start offsets
+            for e, start_offset in enumerate(start_offsets):
+                # rejecting negative offset
+                if start_offset < 0:
+                    read_ok_mask[e] = False
+                    print(('Cannot read from negative offset %d in file %s' % (start_offset, eegfname)))
+                    continue
+
+                # seek to the position in the file
+                efile.seek(self.file_format.data_size * start_offset, 0)
+
+                # read the data
+                data = efile.read(int(self.file_format.data_size * read_size))
+
+                # convert from string to array based on the format
+                # hard-codes little endian
+                fmt = '<' + str(int(len(data) / self.file_format.data_size)) + self.file_format.format_string
+                data = np.array(struct.unpack(fmt, data))
+
+                # make sure we got some data
+                if len(data) < read_size:
+                    read_ok_mask[e] = False
 
+                    print((
+                        'Cannot read full chunk of data for offset ' + str(start_offset) +
+                        'End of read interval  is outside the bounds of file ' + str(eegfname)))
+                else:
+                    # append it to the eventdata
+                    out[out_indices[e], :] = data
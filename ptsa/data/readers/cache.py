@@ -0,0 +1,108 @@
+"""Process-wide cache of metadata needed to construct raw readers."""
+
+import os
+import threading
+
+__all__ = [
+    'MetadataCache',
+    'metadata_cache',
+]
+
+
+class MetadataCache(object):
+    """Thread-safe cache of metadata (params files, file sizes, file headers)
+    shared by all readers in a process.
+
+    Entries are keyed by an arbitrary hashable key and, optionally, the
+    modification time and size of a "stamp" file (e.g. the file the metadata
+    was read from): when the stamp file changes, the entry is recomputed. Each entry is
+    computed at most once even when several threads ask for it at the same
+    time.
+
+    Use the module-level :data:`metadata_cache` instance rather than creating
+    new caches.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._key_locks = {}
+
+    @staticmethod
+    def stamp(path):
+        """
+        :param path: {str} path of a file or directory, a sequence of such paths, or None
+        :return: {tuple} modification time (ns) and size of path (one per path for a sequence), or None when it does
+        not exist
+        """
+        if path is None:
+            return None
+        if isinstance(path, (list, tuple)):
+            return tuple(MetadataCache.stamp(p) for p in path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, key, compute, stamp_path=None):
+        """Return the cached value for ``key``, computing it if necessary.
+
+        Parameters
+        ----------
+        key : hashable
+            Cache key, e.g. ``('params', dataroot)``.
+        compute : callable
+            Called without arguments to compute the value on a cache miss.
+            Exceptions are propagated and nothing is cached.
+        stamp_path : str, sequence of str or None
+            File(s) (or directories) whose modification time and size are part
+            of the key.
+
+        Returns
+        -------
+        The cached value. Mutable values are shared, so callers should copy
+        them before modifying.
+
+        """
+        full_key = (key, self.stamp(stamp_path))
+        try:
+            return self._entries[full_key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(full_key, threading.Lock())
+
+        try:
+            with key_lock:
+                if full_key in self._entries:
+                    return self._entries[full_key]
+
+                value = compute()
+
+                with self._lock:
+                    # entries for older versions of the stamp file are stale
+                    for stale_key in [k for k in self._entries if k[0] == key]:
+                        del self._entries[stale_key]
+                    self._entries[full_key] = value
+        finally:
+            with self._lock:
+                self._key_locks.pop(full_key, None)
+
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return any(k[0] == key for k in list(self._entries))
+
+
+#: Cache shared by all readers in the process
+metadata_cache = MetadataCache()
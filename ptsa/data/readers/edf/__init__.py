@@ -1 +1,2 @@
 from .edf import EDFRawReader
+from .mmap import EDFMemmapFile
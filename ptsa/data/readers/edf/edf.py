@@ -1,16 +1,23 @@
 from contextlib import closing
 import logging
+import os
 import os.path as osp
 import warnings
 
 import numpy as np
+import traits.api
 
 from ptsa.data.readers import BaseRawReader
+from ptsa.data.readers.cache import metadata_cache
+from ptsa.data.readers.edf.mmap import EDFMemmapFile
 from ptsa.extensions.edf import EDFFile
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Size of the float64 buffer epochs are decoded into when they cannot be written into the output directly
+EPOCH_BLOCK_BYTES = 16 * 1024 ** 2
+
 
 class EDFRawReader(BaseRawReader):
     """Reads EEG data stored in the European Data Format (EDF/BDF, EDF+/BDF+
@@ -22,15 +29,33 @@ class EDFRawReader(BaseRawReader):
         Full path to EDF/BDF/EDF+/BDF+ file (including extension).
     channels : List[Union[str, int]]
         List of channels to read.
-
+    dtype : str
+        ``'float64'`` (default), ``'float32'`` or ``'native'``. Samples are
+        returned in physical units, so ``'native'`` is the same as
+        ``'float64'``.
+    workers : int
+        Number of threads the channels are spread over when reading epochs
+        (default 1).
+    backend : str
+        ``'edflib'`` (default) reads through the compiled
+        :class:`ptsa.extensions.edf.EDFFile`; ``'mmap'`` uses
+        :class:`EDFMemmapFile`, which memory-maps the data records and decodes
+        only those overlapping the requested offsets with NumPy. Both produce
+        the same output.
 
     """
-    def __init__(self, **kwargs):
-        if EDFFile is None:
+
+    backend = traits.api.Enum('edflib', 'mmap')
+
+    def __init__(self, backend='edflib', **kwargs):
+        self.backend = backend
+        self._edf = None
+        self._edf_mtime = None
+        if self.backend == 'edflib' and EDFFile is None:
             raise RuntimeError(
                 "The compiled self._edffile extension module was not found.\n"
                 "This probably means you don't have pybind11 installed.\n"
-                "Please pip install pybind11 then reinstall ptsa"
+                "Please pip install pybind11 then reinstall ptsa, or use backend='mmap'"
             )
 
         _, data_ext = osp.splitext(kwargs['dataroot'])
@@ -45,20 +70,105 @@ class EDFRawReader(BaseRawReader):
 
 
     def samplerate(self):
-        with closing(EDFFile(self.dataroot)) as self._edf:
-            channels = self.channels
-            if not len(channels):
-                channels = [n for n in range(self._edf.num_channels)]
-            else:
-                try:
-                    channels = [int(n) for n in channels]
-                except ValueError:
-                    channels = self._edf.get_channel_numbers(channels)
+        """Sample rate of the channels to read, taken from the cached header.
 
-            samplerates = [self._edf.get_samplerate(c) for c in channels]
-            if not (len(np.unique(samplerates))==1):
-                raise RuntimeError('Inconsistent samplerates across channels; cannot read channels simultaneously')
-            return samplerates[0]
+        Raises
+        ------
+        RuntimeError
+            When the channels have different sample rates.
+
+        """
+        indexes, _ = self.resolve_channels(self.channels)
+        samplerates = [self.header()['samplerates'][c] for c in indexes]
+        if not (len(np.unique(samplerates))==1):
+            raise RuntimeError('Inconsistent samplerates across channels; cannot read channels simultaneously')
+        return samplerates[0]
+
+    def open_file(self):
+        """
+        :return: {EDFFile or EDFMemmapFile} the file opened with the selected backend
+        """
+        if self.backend == 'mmap':
+            return EDFMemmapFile(self.dataroot)
+        return EDFFile(self.dataroot)
+
+    def header(self):
+        """Parsed header of the file: channel labels, sample rates, number of
+        samples and digital/physical ranges (one entry per channel). Cached
+        per file until it changes, so readers of the same file parse it once.
+
+        """
+        return metadata_cache.get(('edf_header', self.dataroot), self.read_header,
+                                  stamp_path=self.dataroot)
+
+    def read_header(self):
+        with closing(self.open_file()) as edf:
+            infos = [edf.get_channel_info(c) for c in range(edf.num_channels)]
+            return {
+                'labels': [info.label for info in infos],
+                'samplerates': [edf.get_samplerate(c) for c in range(edf.num_channels)],
+                'num_samples': [info.smp_in_file for info in infos],
+                'phys_min': [info.phys_min for info in infos],
+                'phys_max': [info.phys_max for info in infos],
+                'dig_min': [info.dig_min for info in infos],
+                'dig_max': [info.dig_max for info in infos],
+            }
+
+    def resolve_channels(self, channels):
+        """
+        :param channels: channel numbers, channel names (a name matches the first label it is a prefix of) or an
+            empty list for all channels
+        :return: {tuple} list of channel numbers and list of their labels
+        :raises: RuntimeError when a channel name is not found
+        """
+        all_labels = self.header()['labels']
+        if not len(channels):
+            indexes = list(range(len(all_labels)))
+            return indexes, [all_labels[c] for c in indexes]
+        try:
+            indexes = [int(c) for c in channels]
+            for c in indexes:
+                if not 0 <= c < len(all_labels):
+                    raise IndexError('Channel %d out of range' % c)
+            return indexes, [all_labels[c] for c in indexes]
+        except ValueError:
+            labels = [c.decode() if isinstance(c, bytes) else str(c) for c in channels]
+            indexes = []
+            for name in labels:
+                matches = [c for c, label in enumerate(all_labels) if label.startswith(name)]
+                if not matches:
+                    raise RuntimeError('Bad channel name')
+                indexes.append(matches[0])
+            return indexes, labels
+
+    def output_channels(self):
+        indexes, labels = self.resolve_channels(self.channel_labels)
+        return np.rec.array(list(zip(indexes,labels)),dtype=[('index',int),('label','S17')])
+
+    def edf_file(self):
+        """
+        :return: {EDFFile or EDFMemmapFile} open file to read from. With :attr:`keep_open` set the same handle is
+            reused by later reads (until the file changes or :meth:`close` is called)
+        """
+        mtime = os.stat(self.dataroot).st_mtime
+        if self._edf is not None and self._edf_mtime != mtime:
+            self.close()
+        if self._edf is None:
+            self._edf = self.open_file()
+            self._edf_mtime = mtime
+        return self._edf
+
+    def close(self):
+        """Closes the file kept open when :attr:`keep_open` is set."""
+        if self._edf is not None:
+            self._edf.close()
+            self._edf = None
+
+    def __getstate__(self):
+        # open files cannot be pickled; they are reopened on demand
+        state = super(EDFRawReader, self).__getstate__()
+        state['_edf'] = None
+        return state
 
     def read_file(self, filename, channels, start_offsets=np.array([0]),
                   read_size=-1):
@@ -82,55 +192,90 @@ class EDFRawReader(BaseRawReader):
             indicating whether each offset was read successfully.
 
         """
-        with closing(EDFFile(self.dataroot)) as self._edf:
-
-            if not len(channels):
-                indexes = channels = [n for n in range(self._edf.num_channels)]
-                labels = [self._edf.get_channel_info(c).label for c in channels]
-            else:
-                try:
-                    channels = [int(c) for c in channels]
-                    indexes = channels
-                    labels = [self._edf.get_channel_info(c).label for c in channels]
-                except ValueError:
-                    channels = [c for c in channels]
-                    indexes = self._edf.get_channel_numbers(channels)
-                    labels = channels
-
-
+        indexes, labels = self.resolve_channels(channels)
+        edf = self.edf_file()
+        try:
             # Read all data
             if read_size < 0:
                 if len(start_offsets) > 1:
                     msg = "start_offsets given when read_size implies reading all data"
                     warnings.warn(msg, UserWarning)
-                data = self._edf.read_samples(channels, self._edf.num_samples)
-                self.read_size = int(self._edf.num_samples)
+                data = edf.read_samples(indexes, edf.num_samples)
+                data = data.astype(self.output_dtype(), copy=False)
+                self.read_size = int(edf.num_samples)
                 data = data[:,None,:]
-                read_ok_mask = np.ones((len(channels), 1), dtype=bool)
+                read_ok_mask = np.ones((len(indexes), 1), dtype=bool)
 
             # Read epochs
             else:
-                data = np.empty((len(channels), len(start_offsets), read_size),
-                                dtype=np.float)
-                data.fill(np.nan)
-                read_ok_mask = np.ones((len(channels), len(start_offsets)),
-                                       dtype=bool)
-
-                for i, offset in enumerate(start_offsets):
-                    if offset < 0:
-                        logger.warning("Cannot read negative offset %d", offset)
-                        read_ok_mask[:, i] = False
-                        continue
-
-                    samples = self._edf.read_samples(channels, read_size, offset=offset)
-                    if samples.shape[1] == read_size:
-                        data[:, i, :] = samples
-                    else:
-                        logger.warning("Cannot read full chunk of data for offset %d... probably end of file", offset)
-                        read_ok_mask[:, i] = False
-
-            self.channels = np.rec.array(list(zip(indexes,labels)),dtype=[('index',int),('label','S17')])
-            return data, read_ok_mask
+                data = self.empty_eventdata((len(indexes), len(start_offsets), read_size),
+                                            dtype=self.output_dtype())
+                read_ok_mask = self.read_epochs_into(edf, indexes, start_offsets, read_size,
+                                                     data, np.arange(len(start_offsets)))
+        finally:
+            if not self.keep_open:
+                self.close()
+
+        self.channels = np.rec.array(list(zip(indexes,labels)),dtype=[('index',int),('label','S17')])
+        return data, read_ok_mask
+
+    def read_file_into(self, filename, channels, start_offsets, read_size, out, out_indices):
+        if read_size < 0:
+            return super(EDFRawReader, self).read_file_into(filename, channels, start_offsets, read_size,
+                                                            out, out_indices)
+
+        indexes, labels = self.resolve_channels(channels)
+        edf = self.edf_file()
+        try:
+            read_ok_mask = self.read_epochs_into(edf, indexes, start_offsets, read_size, out, out_indices)
+        finally:
+            if not self.keep_open:
+                self.close()
+
+        self.channels = np.rec.array(list(zip(indexes,labels)),dtype=[('index',int),('label','S17')])
+        return read_ok_mask
+
+    def read_epochs_into(self, edf, indexes, start_offsets, read_size, out, out_indices):
+        """
+        Reads epochs of an open file into rows ``out_indices`` of ``out``. The extension decodes into float64 arrays,
+        so epochs are written into ``out`` directly when it is a float64 array and the rows are consecutive, and
+        otherwise decoded into a buffer of at most :data:`EPOCH_BLOCK_BYTES` and copied block by block.
+        :param edf: {EDFFile or EDFMemmapFile} open file
+        :param indexes: {list} channel numbers
+        :param start_offsets: {np.ndarray} sample offsets of the epochs
+        :param read_size: {int} number of samples in each epoch
+        :param out: {np.ndarray} (channels, events, read_size) array to write into
+        :param out_indices: {np.ndarray} rows of out (along the second axis) for each of start_offsets
+        :return: {np.ndarray} (channels, epochs) mask of the epochs that were read
+        """
+        # the extension releases the GIL and spreads the channels over threads
+        threads = max(self.workers, 1)
+        start_offsets = np.asarray(start_offsets, dtype=np.int64)
+        out_indices = np.asarray(out_indices)
+        num_epochs = len(start_offsets)
+        consecutive = num_epochs > 0 and (np.diff(out_indices) == 1).all()
+
+        if out.dtype == np.float64 and consecutive:
+            first = out_indices[0]
+            _, epoch_ok = edf.read_epochs(indexes, start_offsets, read_size,
+                                          out=out[:, first:first + num_epochs], threads=threads)
+        else:
+            epoch_ok = np.zeros(num_epochs, dtype=bool)
+            block_size = max(EPOCH_BLOCK_BYTES // (8 * max(len(indexes) * read_size, 1)), 1)
+            buffer = np.empty((len(indexes), min(block_size, num_epochs), read_size))
+            for start in range(0, num_epochs, block_size):
+                stop = min(start + block_size, num_epochs)
+                samples, block_ok = edf.read_epochs(indexes, start_offsets[start:stop], read_size,
+                                                    out=buffer[:, :stop - start], threads=threads)
+                out[:, out_indices[start:stop][block_ok]] = samples[:, block_ok]
+                epoch_ok[start:stop] = block_ok
+
+        for offset in start_offsets[~epoch_ok]:
+            if offset < 0:
+                logger.warning("Cannot read negative offset %d", offset)
+            else:
+                logger.warning("Cannot read full chunk of data for offset %d... probably end of file", offset)
+        return np.repeat(epoch_ok[None, :], len(indexes), axis=0)
 
 
 if __name__ == "__main__": # pragma: no cover
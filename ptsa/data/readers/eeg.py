@@ -1,16 +1,18 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os.path
 import warnings
 
 import numpy as np
-import xarray as xr
 
 import traits.api
 from ptsa.data.readers.params import ParamsReader
 from ptsa.data.readers.edf import EDFRawReader
 from ptsa.data.readers.binary import BinaryRawReader
 from ptsa.data.readers.hdf5 import H5RawReader
+from ptsa.data.readers.store import SessionStoreReader, STORE_EXTENSION
 from ptsa.data.readers.base import BaseReader
+from ptsa.data.common import parallel_map
 from ptsa.data.timeseries import TimeSeries
 
 __all__ = [
@@ -18,6 +20,12 @@ __all__ = [
 ]
 
 
+def _read_with_plan(raw_reader):
+    """Reads with a raw reader that may run in another process and returns its read plan with the data"""
+    eventdata, read_ok_mask = raw_reader.read()
+    return eventdata, read_ok_mask, raw_reader.read_plan
+
+
 # FIXME: centralize PTSA exception classes
 class IncompatibleDataError(Exception):
     pass
@@ -47,6 +55,31 @@ class EEGReader(traits.api.HasTraits):
         session
     remove_bad_events : bool
         Remove "bad" events. Defaults to True.
+    dtype : str
+        Type of the returned data: ``'float64'`` (default), ``'float32'`` or
+        ``'native'``. With ``'native'`` samples are kept in their on-disk type
+        and the gain is stored in the ``scale`` attribute instead of being
+        applied (see :meth:`TimeSeries.scaled`).
+    workers : int
+        Number of threads used to read dataroots in parallel. Raw readers that
+        support it also use this many threads to read channels. Defaults to 1
+        (serial reads).
+    executor : concurrent.futures.Executor
+        Executor (e.g. a thread or process pool) to read dataroots with. When
+        given it is used instead of creating a thread pool from ``workers``
+        and is not shut down by the reader. The order of the returned events
+        does not depend on how the reads are scheduled.
+    read_strategy : str
+        How raw readers that plan their reads fetch the event windows of each
+        dataroot: ``'events'`` (one read per event), ``'coalesced'``
+        (overlapping and nearby windows are merged into single reads),
+        ``'session'`` (one sequential read of the whole file that is then
+        sliced in memory) or ``'auto'`` (default) to pick the cheapest one
+        from the density and size of the windows. The strategies used and the
+        bytes read are reported by :meth:`get_read_stats`.
+    cache : ReadCache
+        Optional on-disk cache of event reads (see
+        :class:`ptsa.data.readers.ReadCache`). Session reads are not cached.
 
     Notes
     -----
@@ -59,14 +92,22 @@ class EEGReader(traits.api.HasTraits):
     buffer_time = traits.api.CFloat
     session_dataroot = traits.api.Str
     remove_bad_events = traits.api.Bool
+    dtype = traits.api.Enum('float64', 'float32', 'native')
+    workers = traits.api.Int
+    executor = traits.api.Any
+    read_strategy = traits.api.Enum('auto', 'events', 'coalesced', 'session')
+    cache = traits.api.Any
 
     READER_FILETYPE_DICT = defaultdict(lambda : BinaryRawReader)
     READER_FILETYPE_DICT.update({'.h5':H5RawReader,
                                  '.bdf':EDFRawReader,
-                                 '.edf':EDFRawReader,})
+                                 '.edf':EDFRawReader,
+                                 STORE_EXTENSION:SessionStoreReader,})
 
     def __init__(self,events=None ,channels=np.array([], dtype='|S3'),
-                 start_time=0.0,end_time=0.0,buffer_time=0.0,session_dataroot='',remove_bad_events=True):
+                 start_time=0.0,end_time=0.0,buffer_time=0.0,session_dataroot='',remove_bad_events=True,
+                 dtype='float64',workers=1,executor=None,read_strategy='auto',
+                 cache=None):
         warnings.warn("Lab-specific readers may be moved to the cmlreaders "
                       "package (https://github.com/pennmem/cmlreaders)",
                       FutureWarning)
@@ -77,8 +118,14 @@ class EEGReader(traits.api.HasTraits):
         self.buffer_time = buffer_time
         self.session_dataroot = session_dataroot
         self.remove_bad_events = remove_bad_events
+        self.dtype = dtype
+        self.workers = workers
+        self.executor = executor
+        self.read_strategy = read_strategy
+        self.cache = cache
         self.removed_corrupt_events = False
         self.event_ok_mask_sorted = None
+        self.read_stats = []
 
         assert self.start_time <= self.end_time, \
             'start_time (%s) must be less or equal to end_time(%s) ' % (self.start_time, self.end_time)
@@ -107,34 +154,35 @@ class EEGReader(traits.api.HasTraits):
 
         return start_offset, end_offset, buffer_offset
 
-    def __create_base_raw_readers(self):
+    def __create_base_raw_readers(self, channels=None):
         """
         Creates BaseRawreader for each (unique) dataroot present in events recarray
+        :param channels: channels to read. Defaults to self.channels
         :return: list of BaseRawReaders and list of dataroots
         :raises: :py:class:IncompatibleDataError if the readers are not all the same class
         """
         evs = self.events
+        if channels is None:
+            channels = self.channels
         dataroots = np.unique(evs.eegfile)
         raw_readers = []
         original_dataroots = []
 
         for dataroot in dataroots:
             RawReader = self.READER_FILETYPE_DICT[os.path.splitext(dataroot)[-1]]
-            brr = RawReader(dataroot =dataroot)
+            brr = RawReader(dataroot=dataroot,
+                            channels=channels,
+                            dtype=self.dtype,
+                            workers=self.workers,
+                            read_strategy=self.read_strategy)
 
             events_with_matched_dataroot = evs[evs.eegfile == dataroot]
 
             start_offset, end_offset, buffer_offset = self.compute_read_offsets(brr)
 
-            read_size = end_offset - start_offset + 2 * buffer_offset
-
             # start_offsets = events_with_matched_dataroot.eegoffset + start_offset - buffer_offset
-            start_offsets = events_with_matched_dataroot.eegoffset + start_offset - buffer_offset
-
-            brr = RawReader(dataroot=dataroot,
-                            channels=self.channels,
-                            start_offsets=start_offsets,
-                            read_size=read_size)
+            brr.start_offsets = events_with_matched_dataroot.eegoffset + start_offset - buffer_offset
+            brr.read_size = end_offset - start_offset + 2 * buffer_offset
             raw_readers.append(brr)
 
             original_dataroots.append(dataroot)
@@ -147,8 +195,13 @@ class EEGReader(traits.api.HasTraits):
 
         :return: TimeSeries object (channels x events x time) with data for entire session the events dimension has length 1
         """
-        brr = self.READER_FILETYPE_DICT[os.path.splitext(self.session_dataroot)[-1]](dataroot=self.session_dataroot, channels=self.channels)
+        brr = self.READER_FILETYPE_DICT[os.path.splitext(self.session_dataroot)[-1]](dataroot=self.session_dataroot,
+                                                                                     channels=self.channels,
+                                                                                     dtype=self.dtype,
+                                                                                     workers=self.workers)
+        self.read_stats = []
         session_array,read_ok_mask = brr.read()
+        self.__record_read_plan(brr.dataroot, len(brr.channel_labels), brr.read_plan)
         self.channel_name = brr.channel_name
 
         offsets_axis = session_array['offsets']
@@ -179,81 +232,235 @@ class EEGReader(traits.api.HasTraits):
     def get_event_ok_mask(self):
         return self.event_ok_mask_sorted
 
+    def get_read_stats(self):
+        """
+        :return: {list} one dict per dataroot read by the last call to :meth:`read` (or by all batches of
+        :meth:`iter_batches` so far) whose raw reader plans its reads, with keys 'dataroot', 'strategy',
+        'num_reads', 'bytes_read' and 'bytes_requested' (totals over all channels). bytes_requested counts
+        samples shared by overlapping windows once per window
+        """
+        return self.read_stats
+
+    def __record_read_plan(self, dataroot, num_channels, read_plan):
+        if read_plan is None:
+            return
+        self.read_stats.append({
+            'dataroot': dataroot,
+            'strategy': read_plan.strategy,
+            'num_reads': len(read_plan.ranges) * num_channels,
+            'bytes_read': read_plan.bytes_read * num_channels,
+            'bytes_requested': read_plan.bytes_requested * num_channels,
+        })
+
     def read_events_data(self):
         """
         Reads eeg data for individual event
 
+        The output array is allocated once and each raw reader writes its
+        events directly into their rows (in the original order of the events),
+        so no intermediate per-dataroot arrays need to be concatenated and
+        reordered.
+
         :return: TimeSeries  object (channels x events x time) with data for individual events
         """
         self.event_ok_mask_sorted = None  # reset self.event_ok_mask_sorted
+        self.read_stats = []
 
         evs = self.events
 
+        if self.cache is not None:
+            cache_key = self.cache.key(self)
+            cached = self.cache.load(cache_key)
+            if cached is not None:
+                eventdata, event_ok_mask_sorted = cached
+                # only eegfile and eegoffset are part of the key, so the other fields come from the current events
+                eventdata = eventdata.assign_coords(events=np.rec.array(evs[event_ok_mask_sorted]))
+                self.channel_name = eventdata.dims[0]
+                self.__flag_bad_events(event_ok_mask_sorted)
+                return eventdata
+
         raw_readers, original_dataroots = self.__create_base_raw_readers()
+        event_indices_list = self.__event_indices(original_dataroots)
 
-        # used for restoring original order of the events
-        ordered_indices = np.arange(len(evs))
-        event_indices_list = []
-        events = []
+        eventdata, event_ok_mask_sorted = self.__read_events(raw_readers, event_indices_list, evs)
+        self.__flag_bad_events(event_ok_mask_sorted)
 
-        ts_array_list = []
+        if self.cache is not None:
+            self.cache.store(cache_key, eventdata, event_ok_mask_sorted)
 
-        event_ok_mask_list = []
+        return eventdata
 
-        for s, (raw_reader, dataroot) in enumerate(zip(raw_readers, original_dataroots)):
+    def iter_batches(self, batch_size, by='events'):
+        """
+        Reads eeg data for individual events in batches so that only one batch has to be held in memory at a time.
 
-            ts_array, read_ok_mask = raw_reader.read()
+        Each batch is the same as the corresponding slice of the output of :meth:`read` (including removal of bad
+        events). Raw readers are created once and keep their files open between batches.
 
-            event_ok_mask_list.append(np.all(read_ok_mask,axis=0))
+        :param batch_size: {int} number of events (or channels) in each batch
+        :param by: {str} 'events' to split the events (in their original order) or 'channels' to split the channels.
+        When splitting by channels, bad events are determined separately for every batch; they are the same for all
+        batches as long as all channel files of a dataroot have the same length
+        :return: generator of TimeSeries objects (channels x events x time)
+        """
+        if by not in ('events', 'channels'):
+            raise ValueError("by must be either 'events' or 'channels'")
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive')
+        if self.events is None:
+            raise ValueError('iter_batches requires events')
 
-            ind = np.atleast_1d(evs.eegfile == dataroot)
-            event_indices_list.append(ordered_indices[ind])
-            events.append(evs[ind])
+        self.event_ok_mask_sorted = None  # reset self.event_ok_mask_sorted
+        self.read_stats = []
 
-            ts_array_list.append(ts_array)
+        evs = self.events
 
+        if by == 'events':
+            raw_readers, original_dataroots = self.__create_base_raw_readers()
+            event_indices_list = self.__event_indices(original_dataroots)
+            all_start_offsets = [raw_reader.start_offsets.copy() for raw_reader in raw_readers]
+            event_ok_mask_sorted = np.ones(len(evs), dtype=bool)
+
+            for raw_reader in raw_readers:
+                raw_reader.keep_open = True
+
+            try:
+                for start in range(0, len(evs), batch_size):
+                    stop = min(start + batch_size, len(evs))
+                    batch_readers = []
+                    batch_event_indices_list = []
+
+                    for raw_reader, start_offsets, event_indices in zip(raw_readers, all_start_offsets,
+                                                                        event_indices_list):
+                        in_batch = (event_indices >= start) & (event_indices < stop)
+                        if in_batch.any():
+                            raw_reader.start_offsets = start_offsets[in_batch]
+                            batch_readers.append(raw_reader)
+                            batch_event_indices_list.append(event_indices[in_batch] - start)
+
+                    eventdata, event_ok_mask_sorted[start:stop] = self.__read_events(
+                        batch_readers, batch_event_indices_list, evs[start:stop])
+                    self.__flag_bad_events(event_ok_mask_sorted)
+
+                    yield eventdata
+            finally:
+                for raw_reader, start_offsets in zip(raw_readers, all_start_offsets):
+                    raw_reader.start_offsets = start_offsets
+                    raw_reader.close()
+
+        else:
+            event_ok_mask_sorted = np.ones(len(evs), dtype=bool)
+
+            for start in range(0, len(self.channels), batch_size):
+                raw_readers, original_dataroots = self.__create_base_raw_readers(
+                    channels=self.channels[start:start + batch_size])
+                event_indices_list = self.__event_indices(original_dataroots)
+
+                eventdata, batch_event_ok_mask = self.__read_events(raw_readers, event_indices_list, evs)
+                event_ok_mask_sorted &= batch_event_ok_mask
+                self.__flag_bad_events(event_ok_mask_sorted)
+
+                yield eventdata
+
+    def __event_indices(self, dataroots):
+        """
+        :param dataroots: dataroots of the raw readers
+        :return: list of arrays with the positions of each dataroot's events in self.events
+        """
+        return [np.where(np.atleast_1d(self.events.eegfile == dataroot))[0]
+                for dataroot in dataroots]
+
+    def __flag_bad_events(self, event_ok_mask_sorted):
+        """
+        Warns about bad events and records them (see :meth:`get_event_ok_mask`)
+        :param event_ok_mask_sorted: boolean mask of the events that were read successfully
+        """
+        if self.remove_bad_events:
+            if np.any(~event_ok_mask_sorted):
+                warnings.warn("Found some bad events. Removing!", UserWarning)
+                self.removed_corrupt_events = True
+                self.event_ok_mask_sorted = event_ok_mask_sorted
+
+    def __read_events(self, raw_readers, event_indices_list, evs):
+        """
+        Reads events into a single preallocated array and drops bad events
+
+        :param raw_readers: list of raw readers
+        :param event_indices_list: for each raw reader, positions of its start_offsets in evs
+        :param evs: events that are read
+        :return: TimeSeries object (channels x events x time) and boolean mask of the events that were read successfully
+        """
         if not all([r.channel_name==raw_readers[0].channel_name for r in raw_readers]):
             raise IncompatibleDataError('cannot read monopolar and bipolar data together')
 
         self.channel_name = raw_readers[0].channel_name
 
-        event_indices_array = np.hstack(event_indices_list)
-        event_indices_restore_sort_order_array = event_indices_array.argsort()
+        if len(set(r.read_size for r in raw_readers)) > 1:
+            raise IncompatibleDataError('cannot read data recorded with different sample rates together')
+
+        if self.dtype == 'native' and len(set(r.params_dict['gain'] for r in raw_readers)) > 1:
+            raise IncompatibleDataError('cannot read data with different gains together using dtype="native"')
+
+        # the channels, type and attributes of the output come from the metadata of the first dataroot, so every
+        # dataroot is read straight into the output
+        first_reader = raw_readers[0]
+        cdim = first_reader.output_channels()
+        samplerate = float(first_reader.params_dict['samplerate'])
+        attrs = first_reader.output_attrs()
+        eventdata = first_reader.empty_eventdata((len(cdim), len(evs), first_reader.read_size),
+                                                 dtype=first_reader.output_dtype())
+        event_ok_mask_sorted = np.zeros(len(evs), dtype=bool)
+
+        readers_and_indices = list(zip(raw_readers, event_indices_list))
+
+        if self.executor is None or isinstance(self.executor, ThreadPoolExecutor):
+            # readers running in this process write straight into the output
+            def read_into_output(reader_and_indices):
+                raw_reader, event_indices = reader_and_indices
+                return raw_reader.read_into(eventdata, event_indices)
+
+            read_ok_masks = parallel_map(read_into_output, readers_and_indices,
+                                         workers=self.workers, executor=self.executor)
+            read_plans = [raw_reader.read_plan for raw_reader in raw_readers]
+        else:
+            # other executors (e.g. process pools) cannot share the output, so results are copied in as they arrive
+            read_ok_masks = []
+            read_plans = []
+            read_results = parallel_map(_read_with_plan, raw_readers, executor=self.executor)
+            for (ts_array, read_ok_mask, read_plan), event_indices in zip(read_results, event_indices_list):
+                eventdata[:, event_indices] = ts_array.values
+                read_ok_masks.append(read_ok_mask)
+                read_plans.append(read_plan)
+
+        for raw_reader, read_plan in zip(raw_readers, read_plans):
+            self.__record_read_plan(raw_reader.dataroot, len(raw_reader.channel_labels), read_plan)
+
+        for read_ok_mask, event_indices in zip(read_ok_masks, event_indices_list):
+            event_ok_mask_sorted[event_indices] = np.all(read_ok_mask, axis=0)
+
+        # removing bad events
+        if not event_ok_mask_sorted.all():
+            # compacting good events to the front one channel at a time keeps the extra memory to a single channel
+            num_good_events = np.count_nonzero(event_ok_mask_sorted)
+            for channel_data in eventdata:
+                channel_data[:num_good_events] = channel_data[event_ok_mask_sorted]
+            eventdata = eventdata[:, :num_good_events]
 
-        eventdata = xr.concat(ts_array_list, dim='start_offsets')
-        samplerate = float(eventdata['samplerate'])
         tdim = np.arange(eventdata.shape[-1]) * (1.0 / samplerate) + (self.start_time - self.buffer_time)
-        cdim = eventdata[self.channel_name]
-        edim = np.rec.array(np.concatenate(events))
+        edim = np.rec.array(evs[event_ok_mask_sorted])
 
-        attrs = eventdata.attrs.copy()
-        eventdata = TimeSeries(eventdata.data,
+        eventdata = TimeSeries(eventdata,
                                dims=[self.channel_name, 'events', 'time'],
                                coords={self.channel_name: cdim,
-                                        'events': edim,
-                                        'time': tdim,
-                                        'samplerate': samplerate
-                                        }
+                                       'events': edim,
+                                       'time': tdim,
+                                       'samplerate': samplerate
+                                       }
                                )
 
         eventdata.attrs = attrs
 
-        # restoring original order of the events
-        eventdata = eventdata[:, event_indices_restore_sort_order_array, :]
-
-        event_ok_mask = np.hstack(event_ok_mask_list)
-        event_ok_mask_sorted = event_ok_mask[event_indices_restore_sort_order_array]
-
-        # removing bad events
-        if self.remove_bad_events:
-            if np.any(~event_ok_mask_sorted):
-                warnings.warn("Found some bad events. Removing!", UserWarning)
-                self.removed_corrupt_events = True
-                self.event_ok_mask_sorted = event_ok_mask_sorted
-
-        eventdata = eventdata[:, event_ok_mask_sorted, :]
-
-        return eventdata
+        return eventdata, event_ok_mask_sorted
 
     def read(self):
         """
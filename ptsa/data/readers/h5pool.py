@@ -0,0 +1,135 @@
+"""Process-wide pool of open read-only HDF5 files."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+
+import h5py
+
+__all__ = [
+    'H5FilePool',
+    'h5_file_pool',
+]
+
+
+class H5FilePool(object):
+    """Bounded LRU pool of read-only :class:`h5py.File` handles shared by
+    all HDF5 readers in a process.
+
+    Opening an HDF5 file (especially one with a lot of metadata on a network
+    filesystem) is expensive, so handles are kept open after use and reused
+    by later reads of the same file. At most ``max_files`` idle handles are
+    kept; the least recently used ones are closed first. A handle is reopened
+    when the modification time of its file changes.
+
+    The pool is fork-safe: a child process never reuses handles inherited
+    from its parent (HDF5 handles must not be shared across processes) and
+    opens its own instead.
+
+    Use the module-level :data:`h5_file_pool` instance rather than creating
+    new pools.
+
+    Parameters
+    ----------
+    max_files : int
+        Maximum number of open files that are not in use.
+    rdcc_nbytes : int or None
+        Size in bytes of the raw data chunk cache of each file (see
+        :class:`h5py.File`). None uses the HDF5 default (1 MiB). Changes
+        apply to files opened afterwards.
+
+    """
+    def __init__(self, max_files=16, rdcc_nbytes=None):
+        self.max_files = max_files
+        self.rdcc_nbytes = rdcc_nbytes
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # filename -> [h5py.File, mtime, number of users]
+        self._files = OrderedDict()
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            # handles inherited from the parent belong to its HDF5 library state: forget them without closing
+            self._files = OrderedDict()
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _open_file(self, filename):
+        kwargs = {}
+        if self.rdcc_nbytes is not None:
+            kwargs['rdcc_nbytes'] = self.rdcc_nbytes
+        return h5py.File(filename, 'r', **kwargs)
+
+    @contextmanager
+    def open(self, filename):
+        """Context manager yielding an open read-only handle for ``filename``.
+
+        The handle stays open after the block exits and must not be closed
+        by the caller.
+
+        """
+        self._check_pid()
+        filename = os.path.abspath(filename)
+        mtime = self._mtime(filename)
+        stale = None
+
+        with self._lock:
+            entry = self._files.get(filename)
+            if entry is not None and entry[1] != mtime and entry[2] == 0:
+                stale = self._files.pop(filename)[0]
+                entry = None
+            if entry is None:
+                entry = [self._open_file(filename), mtime, 0]
+                self._files[filename] = entry
+            entry[2] += 1
+            self._files.move_to_end(filename)
+
+        if stale is not None:
+            stale.close()
+
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                evicted = self._evict()
+            for h5file in evicted:
+                h5file.close()
+
+    def _evict(self):
+        """Removes the least recently used idle handles beyond max_files. Must be called with the lock held.
+
+        :return: {list} removed handles, to be closed by the caller
+        """
+        idle = [filename for filename, entry in self._files.items() if entry[2] == 0]
+        evicted = []
+        for filename in idle[:max(len(idle) - self.max_files, 0)]:
+            evicted.append(self._files.pop(filename)[0])
+        return evicted
+
+    def close_all(self):
+        """Closes all handles that are not in use."""
+        self._check_pid()
+        with self._lock:
+            idle = [filename for filename, entry in self._files.items() if entry[2] == 0]
+            evicted = [self._files.pop(filename)[0] for filename in idle]
+        for h5file in evicted:
+            h5file.close()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self._files
+
+
+#: Pool shared by all HDF5 readers in the process
+h5_file_pool = H5FilePool()
@@ -1,9 +1,11 @@
 import os.path as osp
 
-import h5py
 import numpy as np
 
 from ptsa.data.readers import BaseRawReader
+from ptsa.data.readers.cache import metadata_cache
+from ptsa.data.readers.h5pool import h5_file_pool
+from ptsa.data.readers.planner import SEEK_COST_BYTES, merge_intervals
 
 __all__ = [
     'H5RawReader',
@@ -11,7 +13,11 @@ __all__ = [
 
 
 class H5RawReader(BaseRawReader):
-    """Class for reading raw EEG data stored in HDF5 format."""
+    """Class for reading raw EEG data stored in HDF5 format.
+
+    Files are opened through the process-wide :data:`h5_file_pool`, so
+    readers of the same file share one open handle.
+    """
     def __init__(self, **kwargs):
         """
         :param kwargs: allowed values are:
@@ -23,29 +29,83 @@ class H5RawReader(BaseRawReader):
             will result in an IndexError.
         :param start_offsets {ndarray} -  array of ints with read offsets.
         :param read_size {int} - size of the read chunk. If -1 the entire file is read
+        :param dtype {str} - 'float64' (default), 'float32' or 'native' (keep the stored sample type and defer
+            applying the gain)
         --------------------------------------
         :return:None
         """
         _, data_ext = osp.splitext(kwargs['dataroot'])
         assert len(data_ext), 'Dataroot missing extension'
-        super(H5RawReader, self).__init__(**kwargs)
-        channels = self.channels
+        channels = np.asarray(kwargs.get('channels', ()))
         if channels.dtype.names is not None:
             if 'channel_1' not in channels.dtype.names:
                 raise IndexError('Cannot load bipolar data from monopolar channel list')
             kwargs['channels'] = channels['channel_1']
         super(H5RawReader, self).__init__(**kwargs)
-        with h5py.File(self.dataroot,'r') as eegfile:
-            if 'samplerate' in eegfile:
-                self.params_dict['samplerate']= eegfile['samplerate'].value
+        header = metadata_cache.get(('h5_header', self.dataroot), self.read_header,
+                                    stamp_path=self.dataroot)
+        if header['samplerate'] is not None:
+            self.params_dict['samplerate'] = header['samplerate']
+        self._native_dtype = header['dtype']
         self.channels = channels
         self.channel_labels_to_string()
 
+    def native_dtype(self):
+        return self._native_dtype
+
+    def read_header(self):
+        """
+        :return: {dict} samplerate stored in the file (None if there is none) and dtype of the timeseries dataset
+        """
+        with h5_file_pool.open(self.dataroot) as eegfile:
+            samplerate = eegfile['samplerate'][()] if 'samplerate' in eegfile else None
+            return {'samplerate': samplerate,
+                    'dtype': eegfile['/timeseries'].dtype}
+
+    def resolve_channels(self, eegfile, channels):
+        """
+        Does some mangling of the channels parameter if it is empty or if the HDF5 file is a bipolar recording
+
+        :param eegfile: An open HDF5 file
+        :param channels: The channels to read from the file. If empty, all channels (ports) are read
+        :return: {tuple} channels (ports) to read and channel labels: the channels, or a recarray of (ch0, ch1)
+            pairs for bipolar recordings
+        :raises: IndexError when a channel is not in a bipolar recording
+        """
+        if len(channels) == 0:
+            channels_ = labels = np.array(['{:03d}'.format(x).encode() for x in eegfile['/ports'][:]])
+        else:
+            channels_ = labels = channels
+        try:
+            monopolar_possible = bool(eegfile['/monopolar_possible'][0])
+
+            if 'bipolar_info' in eegfile and not monopolar_possible:
+
+                if not (np.in1d(channels_, eegfile['/bipolar_info/ch0_label']).all()):
+                    raise IndexError('Channel[s] %s not in recording' % (
+                        channels_[~np.in1d(channels_, eegfile['/bipolar_info/ch0_label'])]))
+                channel_mask = np.in1d(eegfile['/bipolar_info/ch0_label'], channels_)
+                labels = np.rec.array(
+                    list(
+                        zip(eegfile['/bipolar_info/ch0_label'][channel_mask],
+                            eegfile['/bipolar_info/ch1_label'][channel_mask]),
+                    ),
+                    dtype=[('ch0', int), ('ch1', int)])
+                channels_ = labels.ch0
+        except KeyError:
+            pass
+        return channels_, labels
+
+    def output_channels(self):
+        if len(self.channel_labels) == 0:
+            with h5_file_pool.open(self.dataroot) as eegfile:
+                return self.resolve_channels(eegfile, self.channel_labels)[1]
+        return self.channels
 
     def read_file(self, filename, channels, start_offsets=np.array([0]), read_size=-1):
         """
         Overloads BaseRawReader.read_file(). Does some mangling of the channels parameter if it is empty or if the
-        HDF5 file is a bipolar recording
+        HDF5 file is a bipolar recording (see :meth:`resolve_channels`)
 
         :param filename: The name of the file to read
         :param channels: The channels to read from the file
@@ -54,95 +114,173 @@ class H5RawReader(BaseRawReader):
         :return: event_data: The EEG data corresponding to each offset
         :return: read_ok_mask: Boolean mask indicating whether each offset was read successfully.
         """
-        with h5py.File(self.dataroot, 'r') as eegfile:
-            if len(channels) == 0:
-                channels_ = self.channel_labels = np.array(['{:03d}'.format(x).encode() for x in eegfile['/ports'][:]])
-            else:
-                channels_ = channels
-            try:
-                monopolar_possible = bool(eegfile['/monopolar_possible'][0])
-
-                if 'bipolar_info' in eegfile and not monopolar_possible:
-
-                    if not (np.in1d(channels_, eegfile['/bipolar_info/ch0_label']).all()):
-                        raise IndexError('Channel[s] %s not in recording' % (
-                            channels_[~np.in1d(channels_, eegfile['/bipolar_info/ch0_label'])]))
-                    channel_mask = np.in1d(eegfile['/bipolar_info/ch0_label'], channels_)
-                    self.channel_labels = np.rec.array(
-                        list(
-                            zip(eegfile['/bipolar_info/ch0_label'][channel_mask],
-                                eegfile['/bipolar_info/ch1_label'][channel_mask]),
-                        ),
-                        dtype=[('ch0', int), ('ch1', int)])
-
-                    is_bipolar = True
-                else:
-                    is_bipolar = False
-            except KeyError:
-                is_bipolar = False
-
-            channels_ = channels_ if not is_bipolar else self.channel_labels.ch0
+        with h5_file_pool.open(self.dataroot) as eegfile:
+            channels_, self.channel_labels = self.resolve_channels(eegfile, channels)
             event_data, read_ok_mask = self.read_h5file(eegfile, channels_,
-                                                        start_offsets, read_size)
+                                                        start_offsets, read_size,
+                                                        dtype=self.output_dtype())
             if self.read_size == -1:
                 self.read_size = max(event_data.shape)
             if len(channels) == 0:
                 self.channels = self.channel_labels
             return event_data, read_ok_mask
 
+    def read_file_into(self, filename, channels, start_offsets, read_size, out, out_indices):
+        if read_size < 0:
+            return super(H5RawReader, self).read_file_into(filename, channels, start_offsets, read_size,
+                                                           out, out_indices)
+        with h5_file_pool.open(self.dataroot) as eegfile:
+            channels_, self.channel_labels = self.resolve_channels(eegfile, channels)
+            read_ok_mask = self.read_h5file_into(eegfile, channels_, start_offsets, read_size, out, out_indices)
+            if len(channels) == 0:
+                self.channels = self.channel_labels
+            return read_ok_mask
+
     @staticmethod
-    def read_h5file(eegfile, channels, start_offsets=np.array([0]), read_size=-1):
+    def read_h5file(eegfile, channels, start_offsets=np.array([0]), read_size=-1, dtype=np.float64):
         """
         Reads raw data from HDF5 files into a numpy array of shape (len(channels),len(start_offsets), read_size).
         For each channel and offset, indicates whether the data at that offset on that channel could be read successfully.
+        Channels are not read in parallel: h5py serializes all calls behind a process-wide lock, so use a process
+        pool (see the executor option of EEGReader) to overlap HDF5 reads.
 
         :param eegfile: An open HDF5 file
         :param channels: The channels to read from the file
         :param start_offsets: The indices in the array to start reading at
         :param read_size: The number of samples to read at each offset.
+        :param dtype: The type of the returned data.
         :return: event_data: The EEG data corresponding to each offset
         :return: read_ok_mask: Boolean mask indicating whether each offset was read successfully.
 
         """
-        timeseries = eegfile['/timeseries']
-        ports = eegfile['/ports']
-        channels_to_read = np.where(np.in1d(ports, channels.astype(int)))[0]
         if read_size < 0:
-            if 'orient' in timeseries.attrs and timeseries.attrs['orient'] == 'row':
+            timeseries = eegfile['/timeseries']
+            channels_to_read = np.where(np.in1d(eegfile['/ports'], channels.astype(int)))[0]
+            if H5RawReader.is_row_oriented(timeseries):
                 eventdata = timeseries[:, channels_to_read].T
             else:
                 eventdata = timeseries[channels_to_read, :]
+            eventdata = eventdata.astype(dtype, copy=False)
             return eventdata[:, None, :], np.ones((len(channels), 1)).astype(bool)
 
         else:
-            eventdata = np.empty((len(channels), len(start_offsets), read_size),
-                                 dtype=np.float)
-            eventdata.fill(np.nan)
-            read_ok_mask = np.ones((len(channels), len(start_offsets))).astype(bool)
-            for i, start_offset in enumerate(start_offsets):
-                if start_offset<0:
-                    print('Cannot read negative offset %s '%start_offset)
-                    read_ok_mask[:,i] = False
-                else:
-                    try:
-                        if 'orient' in timeseries.attrs.keys() and timeseries.attrs['orient'] == b'row':
-                            data = timeseries[start_offset:start_offset + read_size, channels_to_read].T
-                        else:
-                            data = timeseries[channels_to_read, start_offset:start_offset + read_size]
-                        if data.shape[-1] == read_size:
-                            eventdata[:, i, :] = data
-                        else:
-                            print(
-                                'Cannot read full chunk of data for offset ' + str(start_offset) +
-                                'End of read interval  is outside the bounds of file ' + eegfile.filename)
-                            read_ok_mask[:, i] = False
-                    except IndexError:
-                        print(
-                            'Cannot read full chunk of data for offset ' + str(start_offset) +
-                            'End of read interval  is outside the bounds of file ' + eegfile.filename)
-                        read_ok_mask[:, i] = False
-
-            if np.isnan(eventdata).all():
-                raise RuntimeError("All eventdata is nan!")
-
+            eventdata = BaseRawReader.empty_eventdata((len(channels), len(start_offsets), read_size),
+                                                      dtype=dtype)
+            read_ok_mask = H5RawReader.read_h5file_into(eegfile, channels, start_offsets, read_size,
+                                                        eventdata, np.arange(len(start_offsets)))
             return eventdata, read_ok_mask
+
+    @staticmethod
+    def read_h5file_into(eegfile, channels, start_offsets, read_size, out, out_indices):
+        """
+        Reads epochs of an HDF5 file into rows ``out_indices`` of ``out``, an array of shape
+        (len(channels), number of events, read_size).
+
+        :param eegfile: An open HDF5 file
+        :param channels: The channels to read from the file
+        :param start_offsets: The indices in the array to start reading at
+        :param read_size: The number of samples to read at each offset.
+        :param out: {np.ndarray} array to write into
+        :param out_indices: {np.ndarray} rows of out (along the second axis) for each of start_offsets
+        :return: read_ok_mask: Boolean mask indicating whether each offset was read successfully.
+        """
+        timeseries = eegfile['/timeseries']
+        ports = eegfile['/ports']
+        channels_to_read = np.where(np.in1d(ports, channels.astype(int)))[0]
+        row_orient = H5RawReader.is_row_oriented(timeseries)
+        read_ok_mask = np.ones((len(channels), len(start_offsets))).astype(bool)
+
+        start_offsets = np.asarray(start_offsets, dtype=np.int64)
+        out_indices = np.asarray(out_indices)
+        num_samples = timeseries.shape[0 if row_orient else 1]
+        for start_offset in start_offsets[start_offsets < 0]:
+            print('Cannot read negative offset %s '%start_offset)
+        for start_offset in start_offsets[(start_offsets >= 0) & (start_offsets + read_size > num_samples)]:
+            print(
+                'Cannot read full chunk of data for offset ' + str(start_offset) +
+                'End of read interval  is outside the bounds of file ' + eegfile.filename)
+        ok = (start_offsets >= 0) & (start_offsets + read_size <= num_samples)
+        read_ok_mask[:, ~ok] = False
+
+        H5RawReader.read_h5epochs(timeseries, channels_to_read, start_offsets[ok], read_size,
+                                  out, out_indices[ok], row_orient)
+
+        # checked one channel at a time so that no copy of the output is made
+        if not read_ok_mask.any() or (np.issubdtype(out.dtype, np.inexact) and
+                                      all(np.isnan(channel_data[out_indices]).all() for channel_data in out)):
+            raise RuntimeError("All eventdata is nan!")
+
+        return read_ok_mask
+
+    @staticmethod
+    def is_row_oriented(timeseries):
+        """
+        :param timeseries: {h5py.Dataset} timeseries dataset
+        :return: {bool} True if samples are stored along the first axis (orient attribute set to 'row')
+        """
+        orient = timeseries.attrs.get('orient', b'')
+        if isinstance(orient, bytes):
+            orient = orient.decode()
+        return orient == 'row'
+
+    @staticmethod
+    def read_h5epochs(timeseries, channels_to_read, start_offsets, read_size, out, out_indices, row_orient=False,
+                      out_channels=None):
+        """
+        Reads epochs from a timeseries dataset with one hyperslab selection per group of nearby epochs instead of one
+        per epoch. Epochs are grouped into the union of their sample ranges, widened to chunk boundaries (HDF5 reads
+        whole chunks anyway) and merged when less than a chunk apart; the epochs are then sliced out in memory, so
+        the time taken grows with the number of bytes read rather than the number of epochs. Epochs of contiguous
+        datasets are merged when the gap between them is cheaper to read than a seek
+        (:data:`ptsa.data.readers.planner.SEEK_COST_BYTES`).
+
+        :param timeseries: {h5py.Dataset} (channels, samples) dataset, or (samples, channels) if row_orient is True
+        :param channels_to_read: {np.ndarray} sorted indices of the channels to read
+        :param start_offsets: {np.ndarray} sample offsets of the epochs. They must lie within the dataset
+        :param read_size: {int} number of samples in each epoch
+        :param out: {np.ndarray} (channels, events, read_size) array the data is written into
+        :param out_indices: {np.ndarray} rows of out (along the second axis) that correspond to start_offsets
+        :param row_orient: {bool} whether samples are stored along the first axis
+        :param out_channels: {np.ndarray} rows of out (along the first axis) that correspond to channels_to_read.
+            Defaults to the first len(channels_to_read) rows in order
+        :return: None
+        """
+        if not len(start_offsets) or not len(channels_to_read):
+            return
+
+        time_axis = 0 if row_orient else 1
+        num_samples = timeseries.shape[time_axis]
+        if timeseries.chunks is not None:
+            chunk_size = max_gap = timeseries.chunks[time_axis]
+        else:
+            chunk_size = 1
+            sample_bytes = timeseries.dtype.itemsize * (timeseries.shape[1] if row_orient else 1)
+            max_gap = max(SEEK_COST_BYTES // sample_bytes, 1)
+
+        aligned_starts = start_offsets // chunk_size * chunk_size
+        aligned_stops = np.minimum(-(-(start_offsets + read_size) // chunk_size) * chunk_size, num_samples)
+        ranges = merge_intervals(aligned_starts, aligned_stops, max_gap=max_gap)
+
+        # a contiguous block of channels is a plain hyperslab; h5py point selections are much slower
+        first_channel, last_channel = channels_to_read[0], channels_to_read[-1]
+        if last_channel - first_channel + 1 <= 2 * len(channels_to_read):
+            channel_selection = slice(first_channel, last_channel + 1)
+            channel_indices = channels_to_read - first_channel
+        else:
+            channel_selection = list(channels_to_read)
+            channel_indices = np.arange(len(channels_to_read))
+
+        range_indices = np.searchsorted(ranges[:, 0], start_offsets, side='right') - 1
+        window = np.arange(read_size)
+        for r, (start, stop) in enumerate(ranges):
+            in_range = np.flatnonzero(range_indices == r)
+            if row_orient:
+                block = timeseries[start:stop, channel_selection].T
+            else:
+                block = timeseries[channel_selection, start:stop]
+            block = block[channel_indices]
+            positions = start_offsets[in_range] - start
+            if out_channels is None:
+                out[:, out_indices[in_range]] = block[:, positions[:, None] + window]
+            else:
+                out[np.ix_(out_channels, out_indices[in_range])] = block[:, positions[:, None] + window]
@@ -4,6 +4,7 @@ from os.path import *
 import warnings
 
 from ptsa.data.readers import BaseReader
+from ptsa.data.readers.cache import metadata_cache
 import traits.api
 
 __all__ = [
@@ -40,7 +41,7 @@ class ParamsReader(BaseReader, traits.api.HasTraits):
                 raise IOError('Could not open params file: %s' % self.filename)
 
         elif self.dataroot:
-            self.filename = self.locate_params_file(dataroot=self.dataroot)
+            self.filename = self.find_params_file(self.dataroot)
         else:
             raise IOError('Could not find params file using dataroot: %s or using direct path:%s' % (
             self.dataroot, self.filename))
@@ -80,11 +81,32 @@ class ParamsReader(BaseReader, traits.api.HasTraits):
                       'params.txt, or sources.json, or be in the directory above and '+
                       'named sources.json')
 
+    @classmethod
+    def find_params_file(cls, dataroot):
+        """
+        Cached :meth:`locate_params_file`. Locations are cached until a file is added to or removed from the directory
+        of the dataroot or the directory above it (which may hold sources.json).
+        :param dataroot: {str} eeg core file name
+        :return: {str}
+        """
+        data_dir = dirname(abspath(dataroot))
+        return metadata_cache.get(('params_file', dataroot), lambda: cls.locate_params_file(dataroot=dataroot),
+                                  stamp_path=(data_dir, dirname(data_dir)))
+
     def read(self):
+        """
+        Reads the params file. Results are cached per params file (and dataroot) until the file is modified
+        (see :data:`ptsa.data.readers.cache.metadata_cache`)
+        :return: {dict} params
+        """
         if splitext(self.filename)[-1] == '.txt':
-            return self.read_txt()
+            read_fcn = self.read_txt
         else:
-            return self.read_json()
+            read_fcn = self.read_json
+
+        params = metadata_cache.get(('params', self.filename, basename(self.dataroot)), read_fcn,
+                                    stamp_path=self.filename)
+        return dict(params)
 
     def read_json(self):
         with open(self.filename) as f:
@@ -0,0 +1,120 @@
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = [
+    'ReadPlan',
+    'plan_reads',
+    'merge_ranges',
+    'merge_intervals',
+    'READ_STRATEGIES',
+]
+
+READ_STRATEGIES = ('events', 'coalesced', 'session')
+
+# Cost of one extra read call expressed in bytes: gaps between windows smaller than this are cheaper to read through
+# than to seek over. 256 KiB is roughly the bytes a spinning disk or network filesystem streams in one seek time.
+SEEK_COST_BYTES = 256 * 1024
+
+# When the cheapest plan reads at least this fraction of the file the whole file is read with one sequential read
+SESSION_FRACTION = 0.9
+
+ReadPlan = namedtuple('ReadPlan', ['strategy', 'ranges', 'bytes_read', 'bytes_requested'])
+ReadPlan.__doc__ = """
+How the windows of one channel file are read.
+
+strategy : {str} 'events' (one read per window), 'coalesced' (one read per merged range) or 'session' (one read of
+    the whole file followed by slicing in memory)
+ranges : {np.ndarray} (number of reads, 2) array of [start, stop) sample ranges that are read
+bytes_read : {int} bytes read from the file
+bytes_requested : {int} bytes covered by the windows, counting overlapping samples once per window
+"""
+
+
+def merge_intervals(starts, stops, max_gap=0):
+    """
+    Merges [start, stop) intervals that overlap or are separated by at most max_gap samples
+
+    :param starts: {np.ndarray} interval starts (any order)
+    :param stops: {np.ndarray} interval stops
+    :param max_gap: {int} largest gap (in samples) between two intervals that is read through
+    :return: {np.ndarray} (number of ranges, 2) array of sorted [start, stop) ranges
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    if not len(starts):
+        return np.empty((0, 2), dtype=np.int64)
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    stops = stops[order]
+    # an interval starts a new range when it begins after every earlier interval has ended (plus the allowed gap)
+    new_range = np.ones(len(starts), dtype=bool)
+    new_range[1:] = starts[1:] > np.maximum.accumulate(stops)[:-1] + max_gap
+
+    ranges = np.empty((new_range.sum(), 2), dtype=np.int64)
+    ranges[:, 0] = starts[new_range]
+    ranges[:, 1] = np.maximum.reduceat(stops, np.flatnonzero(new_range))
+    return ranges
+
+
+def merge_ranges(start_offsets, read_size, max_gap=0):
+    """
+    Merges windows [offset, offset + read_size) that overlap or are separated by at most max_gap samples
+
+    :param start_offsets: {np.ndarray} window start offsets (any order)
+    :param read_size: {int} length of every window
+    :param max_gap: {int} largest gap (in samples) between two windows that is read through
+    :return: {np.ndarray} (number of ranges, 2) array of sorted [start, stop) ranges
+    """
+    start_offsets = np.asarray(start_offsets, dtype=np.int64)
+    return merge_intervals(start_offsets, start_offsets + read_size, max_gap=max_gap)
+
+
+def plan_reads(start_offsets, read_size, num_samples, itemsize, strategy='auto', seek_cost=SEEK_COST_BYTES):
+    """
+    Decides how to read windows of read_size samples starting at start_offsets from a file of num_samples samples.
+
+    Reading every window separately and reading merged ranges of windows are costed as
+    (number of read calls) * seek_cost + bytes read and the cheaper one is picked: sparse windows are read one at a
+    time while windows that overlap or are separated by gaps shorter than seek_cost are merged into coalesced reads.
+    If the cheaper plan still reads at least SESSION_FRACTION of the file, the whole file is read sequentially instead.
+
+    :param start_offsets: {np.ndarray} window start offsets. They must lie within the file
+    :param read_size: {int} number of samples in each window
+    :param num_samples: {int} number of samples in the file
+    :param itemsize: {int} bytes per sample
+    :param strategy: {str} 'auto' to pick the cheapest strategy or one of READ_STRATEGIES to force it
+    :param seek_cost: {int} cost of one read call in bytes
+    :return: {ReadPlan}
+    """
+    if strategy != 'auto' and strategy not in READ_STRATEGIES:
+        raise ValueError('strategy must be one of %s' % (('auto',) + READ_STRATEGIES,))
+
+    start_offsets = np.asarray(start_offsets, dtype=np.int64)
+    bytes_requested = len(start_offsets) * read_size * itemsize
+
+    events_ranges = np.column_stack([start_offsets, start_offsets + read_size]).astype(np.int64)
+    events_plan = ReadPlan('events', events_ranges, bytes_requested, bytes_requested)
+    if strategy == 'events':
+        return events_plan
+
+    session_plan = ReadPlan('session', np.array([[0, num_samples]], dtype=np.int64), num_samples * itemsize,
+                            bytes_requested)
+    if strategy == 'session':
+        return session_plan
+
+    coalesced_ranges = merge_ranges(start_offsets, read_size, max_gap=seek_cost // itemsize)
+    coalesced_plan = ReadPlan('coalesced', coalesced_ranges,
+                              int((coalesced_ranges[:, 1] - coalesced_ranges[:, 0]).sum()) * itemsize,
+                              bytes_requested)
+    if strategy == 'coalesced':
+        return coalesced_plan
+
+    def cost(plan):
+        return len(plan.ranges) * seek_cost + plan.bytes_read
+
+    plan = min(events_plan, coalesced_plan, key=cost)
+    if plan.bytes_read >= SESSION_FRACTION * session_plan.bytes_read:
+        return session_plan
+    return plan
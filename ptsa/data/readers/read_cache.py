@@ -0,0 +1,257 @@
+"""Opt-in on-disk cache of :class:`EEGReader` results."""
+
+import hashlib
+import os
+import os.path as osp
+import pickle
+import time
+import uuid
+import warnings
+
+import numpy as np
+
+from ptsa.helper import lock_file, release_file
+
+__all__ = [
+    'ReadCache',
+]
+
+
+class ReadCache(object):
+    """Content-addressed on-disk cache of event reads with LRU eviction.
+
+    Pass an instance to :class:`EEGReader` via its ``cache`` argument. Results
+    are keyed by a hash of the events' ``eegfile`` and ``eegoffset`` columns,
+    the channels, the read window (``start_time``, ``end_time``,
+    ``buffer_time``), the requested dtype and the modification times and sizes
+    of the source files, including every channel file read. A hit costs a
+    single sequential read of one file.
+
+    Entries are pickled :class:`TimeSeries` objects, which (unlike
+    :meth:`TimeSeries.to_hdf`) round-trip recarray coordinates exactly and load
+    with one sequential read. Only use a cache directory that is writable by
+    people you trust.
+
+    Several processes can share a cache directory: entries are written to a
+    temporary file and atomically renamed into place, and eviction is guarded
+    by a lock (see :func:`ptsa.helper.lock_file`).
+
+    Parameters
+    ----------
+    directory : str
+        Directory where entries are stored. Created if it does not exist.
+    max_size : int
+        Maximum total size of the entries in bytes (default: 10 GiB). When
+        exceeded, the least recently used entries are removed.
+    stale_lock_timeout : float
+        Seconds after which an eviction lock left behind by a crashed process
+        is considered stale and removed (default: 600).
+
+    """
+    extension = '.pkl'
+    version = b'ptsa-eeg-read-cache-v1'
+
+    def __init__(self, directory, max_size=10 * 2 ** 30, stale_lock_timeout=600.0):
+        self.directory = osp.abspath(directory)
+        self.max_size = max_size
+        self.stale_lock_timeout = stale_lock_timeout
+        if not osp.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, key):
+        """Path of the entry for ``key``."""
+        return osp.join(self.directory, key + self.extension)
+
+    @staticmethod
+    def channel_labels(channels):
+        """Labels of the channel files that reading ``channels`` touches.
+
+        Structured arrays contribute their ``channel`` field, or both
+        ``channel_1`` and ``channel_2`` for bipolar pairs; integer labels are
+        zero padded as in :meth:`BaseRawReader.channel_labels_to_string`.
+
+        """
+        channels = np.asarray(channels)
+        names = channels.dtype.names or ()
+        if 'channel' in names:
+            channels = channels['channel']
+        elif 'channel_1' in names and 'channel_2' in names:
+            channels = np.concatenate([channels['channel_1'], channels['channel_2']])
+        if np.issubdtype(channels.dtype, np.integer):
+            return ['{:03}'.format(c) for c in channels]
+        return [c.decode() if isinstance(c, bytes) else str(c) for c in channels.tolist()]
+
+    @staticmethod
+    def source_mtimes(dataroot, channels=()):
+        """Stamps identifying the version of the files a read of ``dataroot`` touches.
+
+        For single-file formats (HDF5, EDF) this is the file itself. For split
+        channel files it is the params file and every channel file in
+        ``channels``. Each stamp is the ``(mtime, size)`` of a file, or None
+        when it does not exist.
+
+        """
+        from ptsa.data.readers.binary import BinaryRawReader
+        from ptsa.data.readers.cache import MetadataCache
+        from ptsa.data.readers.params import ParamsReader
+
+        if osp.isfile(dataroot):
+            return MetadataCache.stamp(dataroot),
+
+        try:
+            params_file = ParamsReader.find_params_file(dataroot)
+        except IOError:
+            params_file = None
+
+        stamps = [(params_file, MetadataCache.stamp(params_file))]
+        for label in sorted(set(ReadCache.channel_labels(channels))):
+            path = BinaryRawReader.channel_filename(dataroot, label)
+            stamps.append((label, MetadataCache.stamp(path)))
+        return tuple(stamps)
+
+    def key(self, reader):
+        """Compute the cache key of an :class:`EEGReader`'s event read.
+
+        Returns
+        -------
+        str
+            Hex digest identifying the read.
+
+        """
+        events = reader.events
+        channels = np.asarray(reader.channels)
+
+        digest = hashlib.sha1(self.version)
+        digest.update(np.asarray(events.eegfile).astype(str).astype('U').tobytes())
+        digest.update(np.asarray(events.eegoffset, dtype=np.int64).tobytes())
+
+        digest.update(str(channels.dtype.descr).encode())
+        if channels.dtype.hasobject:
+            digest.update(repr(channels.tolist()).encode())
+        else:
+            digest.update(channels.tobytes())
+
+        digest.update(repr((float(reader.start_time), float(reader.end_time), float(reader.buffer_time),
+                            reader.dtype)).encode())
+
+        for dataroot in np.unique(events.eegfile):
+            digest.update(repr((str(dataroot), self.source_mtimes(str(dataroot), channels))).encode())
+
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Load an entry and mark it as recently used.
+
+        Returns
+        -------
+        tuple or None
+            ``(eventdata, event_ok_mask)`` or None when there is no usable
+            entry for ``key``.
+
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # written by an incompatible version of the libraries; drop it
+            self._remove(path)
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def store(self, key, eventdata, event_ok_mask):
+        """Store an entry and evict old entries if the cache is too large.
+
+        Failures to write are reported as warnings rather than raised so that
+        a full or read-only cache never breaks a read.
+
+        """
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((eventdata, event_ok_mask), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self._remove(tmp_path)
+            warnings.warn('Could not write to the read cache: {}'.format(e), RuntimeWarning)
+            return
+
+        self.evict()
+
+    def entries(self):
+        """List the entries as ``(path, size, last_used)`` tuples, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.extension):
+                continue
+            path = osp.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        """Total size of the entries in bytes."""
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in
+        :attr:`max_size`. Does nothing if another process is already evicting.
+
+        """
+        lock_name = osp.join(self.directory, 'evict')
+        if not lock_file(lock_name):
+            try:
+                lock_age = time.time() - os.stat(lock_name + '.lock').st_mtime
+            except OSError:
+                return
+            if lock_age < self.stale_lock_timeout:
+                return
+            release_file(lock_name)
+            if not lock_file(lock_name):
+                return
+
+        try:
+            self._remove_stale_tmp_files()
+            entries = self.entries()
+            total = sum(entry[1] for entry in entries)
+            for path, size, _ in entries:
+                if total <= self.max_size:
+                    break
+                self._remove(path)
+                total -= size
+        finally:
+            release_file(lock_name)
+
+    def clear(self):
+        """Remove all entries."""
+        for path, _, _ in self.entries():
+            self._remove(path)
+
+    def _remove_stale_tmp_files(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                path = osp.join(self.directory, name)
+                try:
+                    if time.time() - os.stat(path).st_mtime > self.stale_lock_timeout:
+                        self._remove(path)
+                except OSError:
+                    continue
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,326 @@
+"""Chunked single-file session store.
+
+Sessions recorded as one binary file per channel, EDF/BDF files and HDF5
+sessions can be transcoded with :func:`transcode` into a single HDF5
+container (extension ``.ptsa``) holding a (channels, samples) dataset in the
+on-disk sample type, chunked along both channels and time so that an epoch
+across all channels touches only a few chunks. EDF/BDF sessions are the
+exception: their samples are stored as float64 physical values, because each
+channel has its own digital-to-physical scaling while a store has a single
+gain, so an EDF (16 bit) store is about four times the size of its source
+before compression. :class:`SessionStoreReader`
+reads these files and is registered with :class:`EEGReader`.
+
+From the command line::
+
+    python -m ptsa.data.readers.store SOURCE DESTINATION [--compression gzip] [--workers 4] [--verify]
+
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import os
+import os.path as osp
+import re
+import tempfile
+
+import h5py
+import numpy as np
+
+from ptsa.data.readers import BaseRawReader
+from ptsa.data.readers.binary import BinaryRawReader
+from ptsa.data.readers.cache import metadata_cache
+from ptsa.data.readers.edf import EDFRawReader
+from ptsa.data.readers.h5pool import h5_file_pool
+from ptsa.data.readers.hdf5 import H5RawReader
+
+__all__ = [
+    'STORE_EXTENSION',
+    'SessionStoreReader',
+    'transcode',
+    'verify_store',
+]
+
+STORE_EXTENSION = '.ptsa'
+STORE_FORMAT_VERSION = 1
+
+
+def _label(channel):
+    return channel.decode() if isinstance(channel, bytes) else str(channel)
+
+
+def _checksum(samples):
+    """sha256 of the little-endian bytes of a channel's samples"""
+    samples = np.ascontiguousarray(samples)
+    return hashlib.sha256(samples.astype(samples.dtype.newbyteorder('<'), copy=False).tobytes()).hexdigest()
+
+
+class SessionStoreReader(BaseRawReader):
+    """Reads sessions stored by :func:`transcode` in a single chunked file.
+
+    Keyword arguments
+    -----------------
+    dataroot : str
+        Path to the ``.ptsa`` file.
+    channels : np.ndarray
+        Labels of the channels to read. If empty, all channels are read.
+    start_offsets : np.ndarray
+        Sample offsets at which to start reading.
+    read_size : int
+        Number of samples to read at each offset. If -1 the entire session is
+        read.
+    dtype : str
+        ``'float64'`` (default), ``'float32'`` or ``'native'`` (keep the
+        stored sample type and defer applying the gain).
+
+    """
+
+    def init_params(self):
+        self.params_filename = self.dataroot
+        header = self.header()
+        return {'samplerate': header['samplerate'], 'gain': header['gain']}
+
+    def header(self):
+        """Samplerate, gain, sample type, channel labels and number of samples of the store. Cached until the file
+        changes."""
+        return metadata_cache.get(('store_header', self.dataroot), self.read_header, stamp_path=self.dataroot)
+
+    def read_header(self):
+        with h5_file_pool.open(self.dataroot) as store:
+            data = store['data']
+            return {'samplerate': float(store.attrs['samplerate']),
+                    'gain': float(store.attrs['gain']),
+                    'dtype': data.dtype,
+                    'labels': [_label(c) for c in store['channels'][()]],
+                    'num_samples': data.shape[1]}
+
+    def native_dtype(self):
+        return self.header()['dtype']
+
+    def output_channels(self):
+        if not len(self.channel_labels):
+            return np.array(self.header()['labels'])
+        return self.channels
+
+    def channel_indices(self, channels):
+        """
+        :param channels: channel labels (str or bytes). If empty, all channels
+        :return: {np.ndarray} positions of the channels in the store
+        :raises: IndexError when a channel is not in the store
+        """
+        labels = self.header()['labels']
+        if not len(channels):
+            return np.arange(len(labels))
+        positions = {label: i for i, label in enumerate(labels)}
+        missing = [_label(c) for c in channels if _label(c) not in positions]
+        if missing:
+            raise IndexError('Channel[s] %s not in recording' % missing)
+        return np.array([positions[_label(c)] for c in channels])
+
+    def read_file(self, filename, channels, start_offsets=np.array([0]), read_size=-1):
+        if read_size < 0:
+            start_offsets = np.array([0])
+            read_size = self.read_size = self.header()['num_samples']
+        eventdata = self.empty_eventdata((len(self.channel_indices(channels)), len(start_offsets), read_size),
+                                         dtype=self.output_dtype())
+        read_ok_mask = self.read_file_into(filename, channels, start_offsets, read_size,
+                                           eventdata, np.arange(len(start_offsets)))
+        return eventdata, read_ok_mask
+
+    def read_file_into(self, filename, channels, start_offsets, read_size, out, out_indices):
+        indices = self.channel_indices(channels)
+        if read_size < 0:
+            start_offsets = np.array([0])
+            read_size = self.header()['num_samples']
+        # h5py needs increasing indices; each channel is written into the row it was requested in
+        order = np.argsort(indices, kind='mergesort')
+        out_channels = order if (order != np.arange(len(order))).any() else None
+
+        with h5_file_pool.open(self.dataroot) as store:
+            data = store['data']
+            start_offsets = np.asarray(start_offsets, dtype=np.int64)
+            ok = (start_offsets >= 0) & (start_offsets + read_size <= data.shape[1])
+            for start_offset in start_offsets[~ok]:
+                print('Cannot read full chunk of data for offset %d from %s' % (start_offset, self.dataroot))
+            H5RawReader.read_h5epochs(data, indices[order], start_offsets[ok], read_size,
+                                      out, np.asarray(out_indices)[ok], out_channels=out_channels)
+
+        if not len(channels):
+            self.channels = self.channel_labels = np.array(self.header()['labels'])
+        return np.repeat(ok[None, :], len(indices), axis=0)
+
+
+def _source_reader(source, channels):
+    """
+    :param source: {str} split-channel dataroot, EDF/BDF file or HDF5 session
+    :param channels: channels to read (None for all)
+    :return: raw reader for the whole session of the channels, returning samples in their on-disk type
+    """
+    ext = osp.splitext(source)[-1]
+    if ext in ('.edf', '.bdf'):
+        return EDFRawReader(dataroot=source, channels=np.array(channels if channels is not None else []),
+                            dtype='native')
+    if ext == '.h5':
+        return H5RawReader(dataroot=source, channels=np.array(channels if channels is not None else []),
+                           dtype='native')
+    if channels is None:
+        channels = sorted(osp.splitext(f)[-1][1:] for f in glob.glob(glob.escape(source) + '.*')
+                          if re.match(r'^\.\d+$', osp.splitext(f)[-1]))
+        if not channels:
+            raise IOError('No channel files found for dataroot %s' % source)
+    return BinaryRawReader(dataroot=source, channels=np.array(channels), dtype='native')
+
+
+def _source_channels(reader):
+    """
+    :param reader: raw reader that has read from its source
+    :return: {tuple} list of channel labels and list of the channels to pass to the source reader to read them
+    """
+    if reader.channels.dtype.names is not None:
+        if 'label' in reader.channels.dtype.names:
+            # EDF channels are read by number: labels only need to match a prefix
+            return [_label(c) for c in reader.channels['label']], [int(c) for c in reader.channels['index']]
+        raise ValueError('Cannot transcode bipolar sessions')
+    labels = [_label(c) for c in reader.channel_labels]
+    return labels, labels
+
+
+def transcode(source, destination, channels=None, chunk_channels=None, chunk_samples=None,
+              compression=None, compression_opts=None, workers=1):
+    """Converts a session into a single chunked ``.ptsa`` file.
+
+    Samples are stored in their on-disk type with the samplerate, gain, sample
+    type and source path as attributes, together with the sha256 checksum of
+    every channel as read from the source (see :func:`verify_store`). EDF/BDF
+    samples are stored as float64 physical values (see the module
+    documentation), which takes four (EDF) or about three (BDF) times the
+    space of the source.
+
+    The file is written to a temporary file next to ``destination`` and
+    renamed once complete; the temporary file is removed on error.
+
+    :param source: {str} split-channel dataroot (``dataroot.001``, ... with a params file), EDF/BDF file or HDF5
+        session
+    :param destination: {str} path of the file to write. Should end with ``.ptsa`` to be read by :class:`EEGReader`
+    :param channels: channels to convert. Defaults to all channels of the source
+    :param chunk_channels: {int} channels per chunk. Defaults to all channels, up to 64
+    :param chunk_samples: {int} samples per chunk. Defaults to the power of two closest to one second
+    :param compression: {str} lossless HDF5 filter ('gzip' or 'lzf') or None. The shuffle filter is added when
+        compressing
+    :param compression_opts: compression level for gzip
+    :param workers: {int} number of threads reading blocks of channels from the source in parallel
+    :return: {str} destination
+    """
+    # reading one sample of every channel determines the labels and sample type of the session
+    header_reader = _source_reader(source, channels)
+    header_reader.start_offsets = np.array([0])
+    header_reader.read_size = 1
+    header_reader.read()
+    labels, source_channels = _source_channels(header_reader)
+    dtype = header_reader.output_dtype()
+    samplerate = float(header_reader.params_dict['samplerate'])
+    gain = float(header_reader.params_dict['gain'])
+
+    if chunk_channels is None:
+        chunk_channels = min(len(labels), 64)
+    if chunk_samples is None:
+        chunk_samples = int(2 ** np.round(np.log2(samplerate)))
+    blocks = [source_channels[start:start + chunk_channels] for start in range(0, len(labels), chunk_channels)]
+
+    def read_block(block):
+        block_reader = _source_reader(source, block)
+        data, _ = block_reader.read()
+        return data.values[:, 0]
+
+    # a unique temporary file in the destination directory is renamed into place once complete
+    fd, tmp_destination = tempfile.mkstemp(suffix='.tmp', prefix=osp.basename(destination) + '.',
+                                           dir=osp.dirname(osp.abspath(destination)))
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_destination, 0o666 & ~umask)
+    try:
+        with h5py.File(tmp_destination, 'w') as store:
+            store.attrs['samplerate'] = samplerate
+            store.attrs['gain'] = gain
+            store.attrs['format'] = np.dtype(dtype).str
+            store.attrs['source'] = osp.abspath(source)
+            store.attrs['format_version'] = STORE_FORMAT_VERSION
+            store.create_dataset('channels', data=np.array(labels, dtype='S'))
+            checksums = store.create_dataset('checksums', shape=(len(labels),), dtype='S64')
+
+            data = None
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                # at most `workers` blocks are held in memory at a time
+                for window_start in range(0, len(blocks), max(workers, 1)):
+                    window = blocks[window_start:window_start + max(workers, 1)]
+                    for i, block_data in enumerate(pool.map(read_block, window)):
+                        if data is None:
+                            data = store.create_dataset(
+                                'data', shape=(len(labels), block_data.shape[-1]), dtype=dtype,
+                                chunks=(chunk_channels, min(chunk_samples, block_data.shape[-1])),
+                                compression=compression, compression_opts=compression_opts,
+                                shuffle=compression is not None)
+                        start = (window_start + i) * chunk_channels
+                        data[start:start + len(block_data)] = block_data
+                        checksums[start:start + len(block_data)] = [_checksum(channel) for channel in block_data]
+
+        os.replace(tmp_destination, destination)
+    except BaseException:
+        try:
+            os.remove(tmp_destination)
+        except OSError:
+            pass
+        raise
+    return destination
+
+
+def verify_store(path, workers=1):
+    """Recomputes the checksum of every channel of a store.
+
+    :param path: {str} path to a ``.ptsa`` file
+    :param workers: {int} number of threads computing checksums
+    :return: {list} labels of the channels whose data does not match the checksum recorded at conversion
+    """
+    with h5py.File(path, 'r') as store:
+        data = store['data']
+        labels = [_label(c) for c in store['channels'][()]]
+        expected = [_label(c) for c in store['checksums'][()]]
+        block_size = data.chunks[0] if data.chunks is not None else len(labels)
+        bad = []
+        for start in range(0, len(labels), block_size):
+            block = data[start:start + block_size]
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                checksums = list(pool.map(_checksum, block))
+            bad.extend(label for label, checksum, expected_checksum
+                       in zip(labels[start:start + block_size], checksums, expected[start:start + block_size])
+                       if checksum != expected_checksum)
+    return bad
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transcode an EEG session into a chunked .ptsa store')
+    parser.add_argument('source', help='split-channel dataroot, EDF/BDF file or HDF5 session')
+    parser.add_argument('destination', help='path of the .ptsa file to write')
+    parser.add_argument('--channels', nargs='+', help='channels to convert (default: all)')
+    parser.add_argument('--chunk-channels', type=int)
+    parser.add_argument('--chunk-samples', type=int)
+    parser.add_argument('--compression', choices=['gzip', 'lzf'])
+    parser.add_argument('--compression-level', type=int)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--verify', action='store_true', help='verify checksums after writing')
+    args = parser.parse_args(argv)
+
+    transcode(args.source, args.destination, channels=args.channels, chunk_channels=args.chunk_channels,
+              chunk_samples=args.chunk_samples, compression=args.compression,
+              compression_opts=args.compression_level, workers=args.workers)
+    if args.verify:
+        bad = verify_store(args.destination, workers=args.workers)
+        if bad:
+            parser.exit(1, 'Checksum mismatch for channels: %s\n' % ', '.join(bad))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -6,8 +6,8 @@ import time
 import warnings
 
 import xarray as xr
+from xarray.core import indexing
 import numpy as np
-from scipy.signal import resample
 
 from ptsa import __version__ as ptsa_version
 from ptsa.data.common import get_axis_index
@@ -21,6 +21,73 @@ class ConcatenationError(Exception):
     """
 
 
+def _decode(value):
+    """Decode bytes attributes (h5py < 3 returns bytes, newer versions str)."""
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class _H5DataArray(xr.backends.BackendArray):
+    """Lazily indexed view of an HDF5 dataset.
+
+    Indexing reads only the requested hyperslab. h5py supports a single
+    (increasing) index list per read, so outer indexing with several lists
+    reads the bounding slices of all but one of them and completes the
+    selection in memory.
+
+    The file is opened on first access and reopened after unpickling.
+
+    """
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.path = path
+        self._hfile = None
+        dataset = self.dataset()
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+
+    def dataset(self):
+        if self._hfile is None:
+            import h5py
+            self._hfile = h5py.File(self.filename, 'r')
+        return self._hfile[self.path]
+
+    def close(self):
+        if self._hfile is not None:
+            self._hfile.close()
+            self._hfile = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_hfile'] = None
+        return state
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.OUTER_1VECTOR,
+            self._getitem)
+
+    def _getitem(self, key):
+        return self.dataset()[key]
+
+
+def _memmap_dataset(filename, dataset):
+    """Memory-map a contiguous, unfiltered HDF5 dataset.
+
+    Returns
+    -------
+    np.memmap or None
+        None when the dataset is chunked or has no storage allocated yet.
+
+    """
+    if dataset.chunks is not None or dataset.dtype.hasobject:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset,
+                     shape=dataset.shape)
+
+
 class TimeSeries(xr.DataArray):
     """A thin wrapper around :class:`xr.DataArray` for dealing with time series
     data.
@@ -78,7 +145,8 @@ class TimeSeries(xr.DataArray):
             coords['samplerate'] = float(samplerate)
         return cls(data, coords=coords, dims=dims, name=name, attrs=attrs)
 
-    def to_hdf(self, filename, mode='w', data_kwargs={'chunks': True}):
+    def to_hdf(self, filename, mode='w', data_kwargs=None, chunk_by=None,
+               compression=None, shuffle=True, dtype=None):
         """Save to disk using HDF5.
 
         Parameters
@@ -88,10 +156,26 @@ class TimeSeries(xr.DataArray):
         mode : str
             File mode to use. See the :mod:`h5py` documentation for details.
             Default: ``'w'``
-        kwargs: dict
+        data_kwargs: dict
             Keyword arguments to be passed on to the create_dataset call for
             the main data array (e.g., to specify compression; see the :mod:`h5py`
-            documentation for details).
+            documentation for details). These take precedence over the
+            options derived from ``chunk_by`` and ``compression``.
+        chunk_by : tuple or None
+            Dimensions along which the data will be read one index at a time,
+            e.g. ``('channels', 'events')`` when reading all time points of a
+            channel and event. Chunks span one index of these dimensions (see
+            :func:`ptsa.io.hdf5.chunk_shape`). When None, chunk shapes are
+            guessed by h5py.
+        compression : str or None
+            Lossless compression preset: ``'lzf'``, ``'gzip'`` or ``'gzip1'``
+            to ``'gzip9'``. Default: no compression
+        shuffle : bool
+            Apply the shuffle filter when compressing. Default: True
+        dtype : str or np.dtype or None
+            Type to store the data as, e.g. ``'float32'`` or ``'float16'`` to
+            halve or quarter the size of float64 power values at the expense of
+            precision. Default: keep the type of the data
 
         Notes
         -----
@@ -106,8 +190,20 @@ class TimeSeries(xr.DataArray):
 
         from ptsa.io import hdf5
 
+        data = self.data
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+
+        kwargs = hdf5.filter_options(compression, shuffle)
+        if chunk_by is not None:
+            kwargs['chunks'] = hdf5.chunk_shape(data.shape, self.dims,
+                                                data.dtype.itemsize, chunk_by)
+        else:
+            kwargs['chunks'] = True
+        kwargs.update(data_kwargs or {})
+
         with h5py.File(filename, mode) as hfile:
-            hfile.create_dataset("data", data=self.data, **data_kwargs)
+            hfile.create_dataset("data", data=data, **kwargs)
 
             dims = [dim.encode() for dim in self.dims]
             hfile.create_dataset("dims", data=dims)
@@ -154,7 +250,7 @@ class TimeSeries(xr.DataArray):
         root = hfile['/']
 
         coords_group = hfile['coords']
-        names = json.loads(coords_group.attrs['names'].decode())
+        names = json.loads(_decode(coords_group.attrs['names']))
         coords = {}
 
         for name in names:
@@ -162,15 +258,13 @@ class TimeSeries(xr.DataArray):
             coord = np.load(buffer, allow_pickle=True)
             coords[name] = coord
 
-        name = root.attrs.get('name', None)
-        if name is not None:
-            name = name.decode()
+        name = _decode(root.attrs.get('name', None))
 
         attrs = root.attrs.get('attrs', None)
         if attrs is not None:
-            attrs = json.loads(attrs.decode())
+            attrs = json.loads(_decode(attrs))
 
-        dims = [dim.decode() for dim in dims]
+        dims = [_decode(dim) for dim in dims]
 
         return rtype(name, dims, coords, attrs)
 
@@ -188,15 +282,13 @@ class TimeSeries(xr.DataArray):
         rtype = namedtuple("HDFHumanRedableRType", "name,dims,coords,attrs")
 
         root = hfile["/"]
-        dims = [dim.decode() for dim in hfile["dims"][:]]
+        dims = [_decode(dim) for dim in hfile["dims"][:]]
 
-        name = root.attrs.get("name", None)
-        if name is not None:
-            name = name.decode()
+        name = _decode(root.attrs.get("name", None))
 
         attrs = root.attrs.get("attrs", None)
         if attrs is not None:
-            attrs = json.loads(attrs.decode())
+            attrs = json.loads(_decode(attrs))
 
         coords_group = hfile["coords"]
         coords = {
@@ -207,13 +299,41 @@ class TimeSeries(xr.DataArray):
         return rtype(name, dims, coords, attrs)
 
     @classmethod
-    def from_hdf(cls, filename):
+    def from_hdf(cls, filename, selection=None, lazy=False):
         """Load a serialized time series from an HDF5 file.
 
         Parameters
         ----------
         filename : str
             Path to HDF5 file.
+        selection : dict or None
+            Subset of the data to load as ``{dim: labels}``. Labels are
+            matched against the coordinate of each dimension as with
+            :meth:`xr.DataArray.sel` (lists, scalars or label slices);
+            dimensions without a coordinate are indexed by position. Only
+            the selected hyperslab is read from disk.
+        lazy : bool
+            When True, no data is read until it is accessed. Contiguous
+            (unchunked) datasets are memory-mapped read-only; other datasets
+            are wrapped in a lazily indexed array that reads only what is
+            indexed and caches the data once it has been fully loaded. The
+            latter keep the file open until :meth:`close` is called on the
+            returned object, or it is used as a context manager; close it
+            before overwriting the file. Data that has not been loaded yet is
+            read by reopening the file. Default: False
+
+        Examples
+        --------
+        Load two channels of a frequency band from a large power file::
+
+            >>> power = TimeSeries.from_hdf('power.h5', selection={
+            ...     'channels': ['LA1', 'LA2'], 'frequency': slice(3, 8)})
+
+        Read a file lazily and release it afterwards::
+
+            >>> with TimeSeries.from_hdf('power.h5', lazy=True) as power:
+            ...     mean_power = power.mean('time').load()
+
 
         """
         try:  # pragma: nocover
@@ -227,13 +347,199 @@ class TimeSeries(xr.DataArray):
             else:
                 loaded = cls._from_hdf_human_readable(hfile)
 
-            array = cls.create(hfile['data'][()],
-                               None,
-                               coords=loaded.coords,
-                               dims=loaded.dims,
-                               name=loaded.name,
-                               attrs=loaded.attrs)
-            return array
+            data = _memmap_dataset(filename, hfile['data']) if lazy else None
+
+        backend = None
+        if data is None:
+            backend = _H5DataArray(filename, 'data')
+            data = indexing.MemoryCachedArray(indexing.CopyOnWriteArray(
+                indexing.LazilyIndexedArray(backend)))
+
+        array = cls.create(data,
+                           None,
+                           coords=loaded.coords,
+                           dims=loaded.dims,
+                           name=loaded.name,
+                           attrs=loaded.attrs)
+
+        if selection:
+            positional = {dim: labels for dim, labels in selection.items()
+                          if dim not in array.indexes}
+            array = array.isel(positional).sel(
+                {dim: labels for dim, labels in selection.items()
+                 if dim not in positional})
+
+        if not lazy:
+            array = array.load()
+            backend.close()
+        elif backend is not None:
+            if hasattr(array, 'set_close'):
+                array.set_close(backend.close)
+            else:  # pragma: nocover
+                # xarray < 0.17 closes the file object instead
+                array._file_obj = backend
+        return array
+
+    def to_shared_memory(self):
+        """Copy the time series into a shared memory block so that other
+        processes can use it without copying it again.
+
+        The data is stored as a raw buffer preceded by a small pickled header
+        with the dims, coords, name and attrs. Pass the returned handle (which
+        pickles to a few bytes) to other processes and load it with
+        :meth:`from_shared_memory`.
+
+        The block persists until :meth:`SharedMemoryHandle.unlink` is called
+        on the handle, which should be done once every process that needs the
+        data has loaded it. Time series already loaded remain valid.
+
+        Requires Python 3.8 or later (:mod:`multiprocessing.shared_memory`).
+
+        Returns
+        -------
+        ptsa.data.common.shared_memory_utils.SharedMemoryHandle
+
+        Raises
+        ------
+        TypeError
+            When the data has an object dtype.
+
+        """
+        from ptsa.data.common.shared_memory_utils import write_shared_block
+
+        coords = {name: (coord.dims, coord.values)
+                  for name, coord in self.coords.items()}
+        metadata = (self.dims, coords, self.name, self.attrs)
+        return write_shared_block(self.data, metadata)
+
+    @classmethod
+    def from_shared_memory(cls, handle):
+        """Load a time series placed in shared memory by
+        :meth:`to_shared_memory`.
+
+        The data is not copied: it is a view of the shared memory block, so
+        modifications are visible to every process that loaded it.
+
+        Parameters
+        ----------
+        handle : ptsa.data.common.shared_memory_utils.SharedMemoryHandle
+
+        """
+        from ptsa.data.common.shared_memory_utils import read_shared_block
+
+        data, (dims, coords, name, attrs) = read_shared_block(handle)
+        return cls(data, coords=coords, dims=dims, name=name, attrs=attrs)
+
+    @staticmethod
+    def _concat_coords(arrays, axis):
+        """Concatenate coordinate values, promoting the fields of record
+        arrays with different string lengths to a common dtype.
+
+        """
+        dtypes = set(array.dtype for array in arrays)
+        if len(dtypes) == 1 or arrays[0].dtype.names is None:
+            return np.concatenate(arrays, axis=axis)
+
+        names = arrays[0].dtype.names
+        if any(array.dtype.names != names for array in arrays):
+            raise ConcatenationError("Record fields differ")
+        dtype = [(field, np.result_type(*[array.dtype[field]
+                                          for array in arrays]))
+                 for field in names]
+        return np.concatenate([array.astype(dtype, copy=False)
+                               for array in arrays], axis=axis)
+
+    @classmethod
+    def concat(cls, objs, dim=None, name=None):
+        """Join any number of time series along a dimension.
+
+        Unlike repeated calls to :meth:`append`, coordinates are validated
+        once for all objects and the result is allocated once, with each time
+        series copied into its place.
+
+        Parameters
+        ----------
+        objs : sequence of TimeSeries
+            Time series with identical dimensions, scalar coordinates (e.g.
+            ``samplerate``) and coordinates along the other dimensions.
+        dim : str or None
+            Dimension to concatenate on. If None, the first dimension is used.
+            If not present, a new leading dimension is created with coords
+            ``0, 1, ..., len(objs) - 1``.
+        name : str or None
+            Name of the result. Defaults to the name shared by all objects, if
+            any.
+
+        Returns
+        -------
+        Concatenated TimeSeries
+
+        Raises
+        ------
+        ConcatenationError
+            When the objects cannot be joined.
+
+        """
+        objs = list(objs)
+        if not objs:
+            raise ValueError("Need at least one TimeSeries to concatenate")
+
+        first = objs[0]
+        dims = first.dims
+        for obj in objs[1:]:
+            if obj.dims != dims:
+                raise ConcatenationError("Dimensions are not identical")
+            if set(obj.coords) != set(first.coords):
+                raise ConcatenationError("Coordinates are not identical")
+
+        if dim is None:
+            dim = dims[0]
+        new_dim = dim not in dims
+        if new_dim:
+            dims = (dim,) + dims
+
+        coords = {}
+        for key, coord in first.coords.items():
+            if dim in coord.dims:
+                axis = coord.dims.index(dim)
+                coords[key] = (coord.dims, cls._concat_coords(
+                    [obj.coords[key].values for obj in objs], axis))
+                continue
+            for obj in objs[1:]:
+                other = obj.coords[key]
+                if other.dims != coord.dims or not np.array_equal(
+                        other.values, coord.values):
+                    raise ConcatenationError(
+                        "coordinate {:s} differs\n".format(key) +
+                        "{!s} -> {!s}, {!s} -> {!s}".format(
+                            first.name, coord.values, obj.name, other.values))
+            coords[key] = (coord.dims, coord.values)
+        if new_dim:
+            coords[dim] = np.arange(len(objs))
+
+        axis = dims.index(dim)
+        sizes = [1 if new_dim else obj.shape[axis] for obj in objs]
+        shape = list(first.shape)
+        if new_dim:
+            shape.insert(axis, len(objs))
+        else:
+            shape[axis] = sum(sizes)
+        data = np.empty(shape, dtype=np.result_type(*[obj.dtype
+                                                      for obj in objs]))
+        index = [slice(None)] * data.ndim
+        start = 0
+        for obj, size in zip(objs, sizes):
+            index[axis] = slice(start, start + size)
+            data[tuple(index)] = obj.data[None] if new_dim else obj.data
+            start += size
+
+        attrs = {}
+        for obj in objs:
+            attrs.update(obj.attrs)
+        if name is None and all(obj.name == first.name for obj in objs):
+            name = first.name
+
+        return cls(data, coords=coords, dims=dims, name=name, attrs=attrs)
 
     def append(self, other, dim=None):
         """Append another :class:`TimeSeries` to this one.
@@ -255,6 +561,10 @@ class TimeSeries(xr.DataArray):
         -------
         Appended TimeSeries
 
+        See also
+        --------
+        concat : join many time series at once
+
         """
         if not self.dims == other.dims:
             raise ConcatenationError("Dimensions are not identical")
@@ -303,6 +613,37 @@ class TimeSeries(xr.DataArray):
                                 dims=dims, attrs=attrs, name=name)
         return new
 
+    def scaled(self, dtype=np.float64):
+        """Return a new time series with the ``scale`` attribute applied.
+
+        Readers constructed with ``dtype='native'`` return samples in their
+        on-disk type and store the gain in ``attrs['scale']`` instead of
+        applying it. This converts such a time series to physical units.
+
+        Parameters
+        ----------
+        dtype : str or np.dtype
+            Type of the scaled data (default: ``np.float64``).
+
+        Returns
+        -------
+        ts : TimeSeries
+            A TimeSeries with the scale applied and removed from ``attrs``.
+            When there is no ``scale`` attribute the data is only converted
+            to ``dtype``.
+
+        """
+        attrs = self.attrs.copy()
+        scale = attrs.pop('scale', None)
+
+        data = self.data.astype(dtype)
+        if scale is not None:
+            data *= scale
+
+        new_ts = self.copy(data=data)
+        new_ts.attrs = attrs
+        return new_ts
+
     def __duration_to_samples(self, duration):
         """Convenience function to convert a duration in seconds to number of
         samples.
@@ -370,31 +711,43 @@ class TimeSeries(xr.DataArray):
         return new_ts
 
     def resampled(self, resampled_rate, window=None,
-                  loop_axis=None, num_mp_procs=0, pad_to_pow2=False):
-        """Returns a time series Fourier resampled at resampled_rate.
+                  loop_axis=None, num_mp_procs=0, pad_to_pow2=False,
+                  method='fft', chunk_size=0):
+        """Returns a time series resampled at resampled_rate.
         
         Note that Fourier resampling assumes periodicity, so edge effects can
         arise.  Keeping a buffer of at least 1/f for the lowest frequency of
-        interest guards against this.
+        interest guards against this. Polyphase resampling does not wrap
+        around but pads the edges with zeros.
 
         Parameters
         ----------
         resampled_rate : float
            New sample rate
         window
-            ignored for now - added for legacy reasons
+            Window passed to :func:`scipy.signal.resample` (``'fft'``) or
+            anti-aliasing window of :func:`scipy.signal.resample_poly`
+            (``'polyphase'``)
         loop_axis
             ignored for now - added for legacy reasons
         num_mp_procs
             ignored for now - added for legacy reasons
         pad_to_pow2
             ignored for now - added for legacy reasons
+        method : str
+            ``'fft'`` (default) or ``'polyphase'``. See
+            :class:`ptsa.data.filters.ResampleFilter`.
+        chunk_size : int
+            When positive, resample in chunks of this many samples (polyphase
+            only) to bound memory use. Default: 0
 
         Returns
         -------
         Resampled time series
 
         """
+        from ptsa.data.filters.resample import resample_array, resampled_time
+
         # use ResampleFilter instead
         # samplerate = self.attrs['samplerate']
         samplerate = float(self['samplerate'])
@@ -407,9 +760,10 @@ class TimeSeries(xr.DataArray):
         new_length = int(np.round(time_axis_length * resampled_rate /
                                   float(samplerate)))
 
-        resampled_array, new_time_axis = resample(
-            self.values, new_length, t=time_axis.values,
-            axis=time_axis_index, window=window)
+        resampled_array = resample_array(
+            self.values, samplerate, resampled_rate, axis=time_axis_index,
+            method=method, chunk_size=chunk_size, window=window)
+        new_time_axis = resampled_time(time_axis.values, new_length)
 
         # constructing axes
         coords = {}
@@ -1,8 +1,15 @@
+#include <algorithm>
+#include <cmath>
+#include <limits>
+
+#include <ThreadPool.h>
+
 #include "edffile.hpp"
 
 
 void EDFFile::open(std::string filename)
 {
+    this->filename = filename;
     auto res = edfopen_file_readonly(filename.c_str(), &this->header, EDFLIB_DO_NOT_READ_ANNOTATIONS);
     if (res != 0) {
         // We're not going to try to catch each specific type of error, but
@@ -46,7 +53,7 @@ EDFFile::~EDFFile()
 
 void EDFFile::close()
 {
-    if (edfclose_file(this->handle() < 0)) {
+    if (edfclose_file(this->handle()) < 0) {
         throw std::runtime_error("Error closing EDF file!");
     }
     else {
@@ -147,3 +154,152 @@ py::array_t<double> EDFFile::read_samples(std::vector<std::string> channel_names
     auto numbers = get_channel_numbers(channel_names);
     return read_samples(numbers, n_samples, offset);
 }
+
+
+bool EDFFile::read_epochs_with_handle(int handle, const std::vector<int> &channels,
+                                      const std::vector<ssize_t> &rows,
+                                      const std::vector<long long> &offsets, int n_samples,
+                                      double *out, const std::vector<ssize_t> &strides,
+                                      const std::vector<bool> &valid)
+{
+    const bool contiguous = strides[2] == 1;
+    std::vector<double> buffer(contiguous ? 0 : n_samples);
+
+    for (size_t j = 0; j < channels.size(); ++j) {
+        for (size_t e = 0; e < offsets.size(); ++e) {
+            if (!valid[e]) {
+                continue;
+            }
+
+            double *epoch = out + rows[j] * strides[0] + e * strides[1];
+            double *target = contiguous ? epoch : buffer.data();
+
+            if (edfseek(handle, channels[j], offsets[e], EDFSEEK_SET) != offsets[e]) {
+                return false;
+            }
+            if (edfread_physical_samples(handle, channels[j], n_samples, target) != n_samples) {
+                return false;
+            }
+
+            if (!contiguous) {
+                for (int i = 0; i < n_samples; ++i) {
+                    epoch[i * strides[2]] = buffer[i];
+                }
+            }
+        }
+    }
+
+    return true;
+}
+
+
+py::tuple EDFFile::read_epochs(std::vector<int> channels, py::array_t<long long> offsets, int n_samples,
+                               py::object out, int threads)
+{
+    ensure_open();
+
+    const auto n_channels = static_cast<ssize_t>(channels.size());
+    const auto n_epochs = static_cast<ssize_t>(offsets.size());
+
+    for (auto channel: channels) {
+        if (channel < 0 || channel >= this->get_num_channels()) {
+            throw py::index_error("Channel " + std::to_string(channel) + " out of range");
+        }
+    }
+
+    py::array_t<double> output;
+    if (out.is_none()) {
+        output = py::array_t<double>(std::vector<ssize_t>{n_channels, n_epochs, n_samples});
+        std::fill(output.mutable_data(), output.mutable_data() + output.size(),
+                  std::numeric_limits<double>::quiet_NaN());
+    }
+    else {
+        if (!py::isinstance<py::array_t<double>>(out)) {
+            throw py::type_error("out must be a float64 array");
+        }
+        output = out.cast<py::array_t<double>>();
+        if (output.ndim() != 3 || output.shape(0) != n_channels || output.shape(1) != n_epochs
+            || output.shape(2) != n_samples) {
+            throw py::value_error("out must have shape (channels, epochs, samples)");
+        }
+        if (!output.writeable()) {
+            throw py::value_error("out must be writeable");
+        }
+    }
+
+    auto mask = py::array_t<bool>(n_epochs);
+    std::vector<long long> epoch_offsets(n_epochs);
+    std::vector<bool> valid(n_epochs);
+    {
+        auto offsets_ = offsets.unchecked<1>();
+        auto mask_ = mask.mutable_unchecked<1>();
+        for (ssize_t e = 0; e < n_epochs; ++e) {
+            epoch_offsets[e] = offsets_(e);
+            valid[e] = true;
+            for (auto channel: channels) {
+                if (epoch_offsets[e] < 0 || epoch_offsets[e] + n_samples > this->get_num_samples(channel)) {
+                    valid[e] = false;
+                }
+            }
+            mask_(e) = valid[e];
+        }
+    }
+
+    const std::vector<ssize_t> strides = {
+        output.strides(0) / static_cast<ssize_t>(sizeof(double)),
+        output.strides(1) / static_cast<ssize_t>(sizeof(double)),
+        output.strides(2) / static_cast<ssize_t>(sizeof(double)),
+    };
+    double *data = output.mutable_data();
+
+    // edflib handles keep a single file position, so every thread gets its own handle of the file
+    threads = std::max(1, std::min(threads, static_cast<int>(n_channels)));
+    std::vector<int> handles = {this->handle()};
+    for (int t = 1; t < threads; ++t) {
+        struct edf_hdr_struct extra_header;
+        if (edfopen_file_readonly(this->filename.c_str(), &extra_header, EDFLIB_DO_NOT_READ_ANNOTATIONS) != 0) {
+            break;
+        }
+        handles.push_back(extra_header.handle);
+    }
+    threads = static_cast<int>(handles.size());
+
+    std::vector<std::vector<int>> thread_channels(threads);
+    std::vector<std::vector<ssize_t>> thread_rows(threads);
+    for (ssize_t j = 0; j < n_channels; ++j) {
+        thread_channels[j % threads].push_back(channels[j]);
+        thread_rows[j % threads].push_back(j);
+    }
+
+    bool ok = true;
+    {
+        py::gil_scoped_release release;
+
+        if (threads == 1) {
+            ok = read_epochs_with_handle(handles[0], thread_channels[0], thread_rows[0], epoch_offsets,
+                                         n_samples, data, strides, valid);
+        }
+        else {
+            ThreadPool pool(threads);
+            std::vector<std::future<bool>> results;
+            for (int t = 0; t < threads; ++t) {
+                results.push_back(pool.enqueue(read_epochs_with_handle, handles[t], std::cref(thread_channels[t]),
+                                               std::cref(thread_rows[t]), std::cref(epoch_offsets), n_samples,
+                                               data, std::cref(strides), std::cref(valid)));
+            }
+            for (auto &result: results) {
+                ok = result.get() && ok;
+            }
+        }
+    }
+
+    for (int t = 1; t < threads; ++t) {
+        edfclose_file(handles[t]);
+    }
+
+    if (!ok) {
+        throw std::runtime_error("Error reading EDF samples!");
+    }
+
+    return py::make_tuple(output, mask);
+}
@@ -24,12 +24,34 @@ private:
     /// Keeps track of whether or not the file is open
     bool opened{ false };
 
+    /// Path of the file, used to open extra handles for threaded reads
+    std::string filename;
+
     inline int handle() {
         return this->header.handle;
     }
 
     void seek(int channel, long long offset);
 
+    /**
+     * Read epochs of a group of channels through one edflib handle. Does not
+     * touch any Python object, so it can run without the GIL.
+     * @param handle - edflib handle to read through
+     * @param channels - the channels to read
+     * @param rows - rows of the output that correspond to channels
+     * @param offsets - sample offsets of the epochs
+     * @param n_samples - number of samples in each epoch
+     * @param out - pointer to the first element of the output
+     * @param strides - strides (in elements) of the three output axes
+     * @param valid - whether each epoch lies within the file
+     * @return false when edflib reports an error
+     */
+    static bool read_epochs_with_handle(int handle, const std::vector<int> &channels,
+                                        const std::vector<ssize_t> &rows,
+                                        const std::vector<long long> &offsets, int n_samples,
+                                        double *out, const std::vector<ssize_t> &strides,
+                                        const std::vector<bool> &valid);
+
     /**
      * Open an EDF file.
      * @param filename
@@ -158,4 +180,22 @@ public:
      * @return data array
      */
     py::array_t<double> read_samples(std::vector<std::string> channel_names, int n_samples, long long offset);
+
+    /**
+     * Read many epochs of a list of channels in one call. The GIL is released
+     * while reading.
+     * @param channels - the channels to read from
+     * @param offsets - sample offsets at which each epoch starts
+     * @param n_samples - number of samples in each epoch
+     * @param out - optional float64 array of shape (channels, epochs, samples)
+     *     to fill. Epochs outside the file are left untouched. When None, a
+     *     NaN-filled array is allocated
+     * @param threads - number of threads; channels are split between them and
+     *     every thread reads through its own handle of the file
+     * @return tuple of the output array and a boolean mask of the epochs that
+     *     lie within the file
+     * @throws std::runtime_error when an error occurs
+     */
+    py::tuple read_epochs(std::vector<int> channels, py::array_t<long long> offsets, int n_samples,
+                          py::object out, int threads);
 };
@@ -279,7 +279,9 @@ int edfopen_file_readonly(const char *path, struct edf_hdr_struct *edfhdr, int r
   {
     if(hdrlist[i]!=NULL)
     {
-      if(!(strcmp(path, hdrlist[i]->path)))
+      /* a file may be opened more than once for reading (e.g. one handle per thread), */
+      /* but not while it is being written                                              */
+      if((!(strcmp(path, hdrlist[i]->path)))&&(hdrlist[i]->writemode))
       {
         edfhdr->filetype = EDFLIB_FILE_ALREADY_OPENED;
 
@@ -85,6 +85,36 @@ PYBIND11_MODULE(edffile, m)
              py::overload_cast<std::vector<std::string>, int, long long>(&EDFFile::read_samples),
              "Read samples from a list of channel names",
              py::arg("channels"), py::arg("samples"), py::arg("offset") = 0)
+        .def("read_epochs", &EDFFile::read_epochs, R"(
+        Read many epochs of a list of channel numbers in one call.
+
+        The GIL is released while reading.
+
+        Parameters
+        ----------
+        channels : List[int]
+            Channel numbers to read.
+        offsets : np.ndarray
+            Sample offsets at which each epoch starts.
+        samples : int
+            Number of samples in each epoch.
+        out : np.ndarray
+            Optional float64 array of shape (channels, epochs, samples) to
+            fill. Epochs that do not lie within the file are left untouched.
+            When not given, a NaN-filled array is allocated.
+        threads : int
+            Number of threads to spread the channels over. Every thread reads
+            through its own handle of the file.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The filled array and a boolean mask of the epochs that lie within
+            the file.
+
+        )",
+             py::arg("channels"), py::arg("offsets"), py::arg("samples"),
+             py::arg("out") = py::none(), py::arg("threads") = 1)
         .def("get_samplerate", &EDFFile::get_samplerate, py::arg("channel"))
     ;
 }
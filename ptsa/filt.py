@@ -7,38 +7,265 @@
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
-from scipy.signal import butter
-from numpy import asarray
-from scipy.signal import filtfilt
+from collections import deque
+from functools import lru_cache
 
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
 
-def buttfilt(dat,freq_range,sample_rate,filt_type,order,axis=-1):
-    """Wrapper for a Butterworth filter.
+from ptsa.data.common import parallel_map
+
+
+@lru_cache(maxsize=256)
+def _butter_sos(order, freq_range, sample_rate, filt_type):
+    return butter(order, np.asarray(freq_range) / (sample_rate / 2.),
+                  filt_type, output='sos')
+
+
+def butter_sos(order, freq_range, sample_rate, filt_type):
+    """Butterworth filter design as second-order sections.
+
+    Second-order sections are numerically stable even at high orders and
+    low normalized frequencies, where the transfer function (b, a) form is
+    not. Designs are memoized by (order, freq_range, sample_rate, filt_type).
+
+    Parameters
+    ----------
+    order : int
+    freq_range : float or list-like
+        Cutoff frequency or [low, high] band edges in Hz
+    sample_rate : float
+    filt_type : str
+        'lowpass', 'highpass', 'bandpass' or 'bandstop' (or 'low', 'high',
+        'pass', 'stop')
+
+    Returns
+    -------
+    sos : np.ndarray
+        (n_sections, 6) array
+
+    """
+    freq_range = tuple(float(f) for f in np.atleast_1d(freq_range))
+    # copy so that callers cannot modify the cached design
+    return _butter_sos(int(order), freq_range, float(sample_rate),
+                       filt_type).copy()
+
+
+def sosfiltfilt_bank(sos_list, dat, axis=-1, cpus=1, out=None):
+    """Zero-phase filtering of an array with several filters.
+
+    The array is split into chunks of rows along the non-time axes and the
+    (filter, chunk) pairs are processed by ``cpus`` threads. The result is
+    allocated once.
+
+    Parameters
+    ----------
+    sos_list : list of np.ndarray
+        Filters as second-order sections
+    dat : array-like
+        Data to filter
+    axis : int
+        Time axis
+    cpus : int
+        Number of threads
+    out : np.ndarray, optional
+        Array of shape ``(len(sos_list),) + dat.shape`` to store the result
+        in instead of allocating it. With a single filter, ``dat[None]``
+        filters ``dat`` in place.
+
+    Returns
+    -------
+    filtered : np.ndarray
+        Array of shape (len(sos_list),) + dat.shape
 
     """
+    dat = np.asarray(dat)
+    axis = axis % dat.ndim
+    moved = np.moveaxis(dat, axis, -1)
+    rows = moved.reshape(-1, moved.shape[-1])
+    if out is None:
+        dtype = np.result_type(dat.dtype, np.float64)
+        out = np.empty((len(sos_list),) + dat.shape, dtype=dtype)
+    elif out.shape != (len(sos_list),) + dat.shape:
+        raise ValueError("out must have shape %s" %
+                         (((len(sos_list),) + dat.shape),))
+    out_moved = np.moveaxis(out, axis + 1, -1)
+    # a view of out unless its layout requires copying
+    filtered = out_moved.reshape((len(sos_list),) + rows.shape)
+
+    chunk = -(-len(rows) // max(cpus, 1)) if len(rows) else 1
+    tasks = [(i, start) for i in range(len(sos_list))
+             for start in range(0, len(rows), chunk)]
+
+    def run(task):
+        i, start = task
+        filtered[i, start:start + chunk] = sosfiltfilt(
+            sos_list[i], rows[start:start + chunk], axis=-1)
+
+    parallel_map(run, tasks, workers=cpus)
 
-    # make sure dat is an array
-    dat = asarray(dat)
+    if not np.may_share_memory(filtered, out):
+        out_moved[...] = filtered.reshape(out_moved.shape)
+    return out
+
+
+def buttfilt(dat,freq_range,sample_rate,filt_type,order,axis=-1,cpus=1):
+    """Wrapper for a zero-phase Butterworth filter.
+
+    The filter is designed (once per set of parameters, see
+    :func:`butter_sos`) and applied as second-order sections.
+
+    """
+    sos = butter_sos(order, freq_range, sample_rate, filt_type)
+    return sosfiltfilt_bank([sos], dat, axis=axis, cpus=cpus)[0]
 
-    # reshape the data to 2D with time on the 2nd dimension
-    #origshape = dat.shape
-    #dat = reshape_to_2d(dat,axis)
 
-    # set up the filter
-    freq_range = asarray(freq_range)
+def _take(dat, start, stop, axis):
+    index = [slice(None)] * dat.ndim
+    index[axis] = slice(start, stop)
+    return dat[tuple(index)]
+
+
+def settling_samples(sos, tol=1e-9, max_samples=2 ** 24):
+    """Number of samples after which the impulse response of a filter has
+    decayed below ``tol`` times its peak.
+
+    Parameters
+    ----------
+    sos : np.ndarray
+        Filter as second-order sections
+    tol : float
+        Relative amplitude considered negligible
+    max_samples : int
+        Upper bound on the returned length
+
+    Returns
+    -------
+    int
+
+    """
+    n = 1024
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1.
+        response = np.abs(sosfilt(sos, impulse))
+        above = np.flatnonzero(response > tol * response.max())
+        last = above[-1] + 1 if len(above) else 1
+        if last < n * 3 // 4 or n >= max_samples:
+            return int(min(last, max_samples))
+        n *= 2
+
+
+def sosfilt_blocks(sos, blocks, axis=-1):
+    """Causal filtering of a signal delivered in consecutive blocks.
+
+    The filter state is carried from block to block, so the concatenated
+    output is identical to filtering the whole signal at once. The state is
+    initialized to the steady state of the first sample (as
+    :func:`scipy.signal.filtfilt` does) to avoid a start-up transient.
+
+    Parameters
+    ----------
+    sos : np.ndarray
+        Filter as second-order sections
+    blocks : iterable of array-like
+        Consecutive blocks of the signal, of equal shape except along axis
+    axis : int
+        Time axis
+
+    Yields
+    ------
+    np.ndarray
+        Filtered blocks
+
+    """
+    zi = None
+    for block in blocks:
+        block = np.asarray(block)
+        block_axis = axis % block.ndim
+        if zi is None:
+            zi_shape = [1] * block.ndim
+            zi_shape[block_axis] = 2
+            zi = (sosfilt_zi(sos).reshape((len(sos),) + tuple(zi_shape)) *
+                  _take(block, 0, 1, block_axis)[np.newaxis])
+        filtered, zi = sosfilt(sos, block, axis=block_axis, zi=zi)
+        yield filtered
+
+
+def sosfiltfilt_blocks(sos, blocks, padding=None, axis=-1):
+    """Zero-phase filtering of a signal delivered in consecutive blocks.
+
+    Each block is filtered forward and backward together with ``padding``
+    samples of the signal before and after it, which are then discarded
+    (overlap-and-discard). With padding at least as long as the impulse
+    response of the filter, the output matches
+    :func:`scipy.signal.sosfiltfilt` over the whole signal to within the
+    tolerance used to measure that length. Only the current block, the
+    padding and enough following blocks to provide it are held in memory.
+
+    Parameters
+    ----------
+    sos : np.ndarray
+        Filter as second-order sections
+    blocks : iterable of array-like
+        Consecutive blocks of the signal, of equal shape except along axis
+    padding : int or None
+        Samples of context on each side of a block. Defaults to
+        :func:`settling_samples`.
+    axis : int
+        Time axis
+
+    Yields
+    ------
+    np.ndarray
+        Filtered blocks, one per input block
+
+    """
+    if padding is None:
+        padding = settling_samples(sos)
+    # default padding of sosfiltfilt
+    edge = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(),
+                                       (sos[:, 5] == 0).sum()))
+
+    def filter_block(block, history, following):
+        parts = [] if history is None else [history]
+        parts.append(block)
+        needed = padding
+        for next_block in following:
+            if needed <= 0:
+                break
+            parts.append(_take(next_block, 0, needed, axis))
+            needed -= next_block.shape[axis]
+        segment = np.concatenate(parts, axis=axis)
+        filtered = sosfiltfilt(sos, segment, axis=axis,
+                               padlen=min(edge, segment.shape[axis] - 1))
+        start = 0 if history is None else history.shape[axis]
+        return _take(filtered, start, start + block.shape[axis], axis)
 
-    # Nyquist frequency
-    nyq=sample_rate/2.
+    def next_history(block, history):
+        context = block if history is None else np.concatenate(
+            [history, block], axis=axis)
+        return _take(context, max(context.shape[axis] - padding, 0), None,
+                     axis)
 
-    # generate the butterworth filter coefficients
-    [b,a]=butter(order,freq_range/nyq,filt_type)
+    history = None
+    # blocks not filtered yet and the number of samples that follow the first
+    pending = deque()
+    lookahead = 0
 
-    # loop over final dimension
-    #for i in range(dat.shape[0]):
-    #    dat[i] = filtfilt(b,a,dat[i])
-    #dat = filtfilt2(b,a,dat,axis=axis)
-    dat = filtfilt(b,a,dat,axis=axis)
+    for block in blocks:
+        block = np.asarray(block)
+        axis = axis % block.ndim
+        if pending:
+            lookahead += block.shape[axis]
+        pending.append(block)
+        while len(pending) > 1 and lookahead >= padding:
+            block = pending.popleft()
+            lookahead -= pending[0].shape[axis]
+            yield filter_block(block, history, pending)
+            history = next_history(block, history)
 
-    # reshape the data back
-    #dat = reshape_from_2d(dat,axis,origshape)
-    return dat
+    while pending:
+        block = pending.popleft()
+        yield filter_block(block, history, pending)
+        history = next_history(block, history)
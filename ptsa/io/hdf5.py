@@ -1,5 +1,6 @@
 import codecs
 import json
+import re
 
 import h5py
 import numpy as np
@@ -10,6 +11,94 @@ vencode = np.vectorize(codecs.encode)
 vdecode = np.vectorize(codecs.decode)
 
 
+#: Upper bound on the size of chunks derived by :func:`chunk_shape`. This is
+#: the size of HDF5's default per-dataset chunk cache: larger chunks are
+#: decompressed again on every partial read.
+CHUNK_TARGET_BYTES = 1024 ** 2
+
+
+def chunk_shape(shape, dims, itemsize, chunk_by=(),
+                target_bytes=CHUNK_TARGET_BYTES):
+    """Derive a chunk shape from the way a dataset is read back.
+
+    Each chunk spans a single index along the ``chunk_by`` dimensions and as
+    much of the other dimensions as fits in ``target_bytes``: reading e.g. all
+    time points of one channel and event with ``chunk_by=('channels',
+    'events')`` touches a single chunk. When a chunk is too large, the other
+    dimensions are halved starting from the first (slowest varying) one, so
+    that the trailing dimensions, e.g. ``time``, stay contiguous.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dataset.
+    dims : tuple
+        Dimension names.
+    itemsize : int
+        Bytes per element.
+    chunk_by : tuple
+        Dimensions along which the data is accessed one index at a time.
+    target_bytes : int
+        Maximum number of bytes in a chunk.
+
+    Returns
+    -------
+    tuple
+
+    Raises
+    ------
+    ValueError
+        When ``chunk_by`` names a dimension not in ``dims``.
+
+    """
+    unknown = set(chunk_by) - set(dims)
+    if unknown:
+        raise ValueError("Unknown dimensions in chunk_by: {}".format(
+            sorted(unknown)))
+
+    chunks = [1 if dim in chunk_by else max(size, 1)
+              for dim, size in zip(dims, shape)]
+    free = [i for i, dim in enumerate(dims) if dim not in chunk_by]
+    for i in free:
+        while chunks[i] > 1 and np.prod(chunks) * itemsize > target_bytes:
+            chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
+
+
+def filter_options(compression=None, shuffle=True):
+    """Keyword arguments for :meth:`h5py.Group.create_dataset` implementing a
+    lossless compression preset.
+
+    Parameters
+    ----------
+    compression : str or None
+        ``'lzf'`` (fast, moderate ratio), ``'gzip'`` (level 4) or
+        ``'gzip1'`` to ``'gzip9'`` for a given gzip level. None disables
+        compression.
+    shuffle : bool
+        Apply the byte shuffle filter before compressing, which usually
+        improves the compression of floating point data considerably.
+
+    Returns
+    -------
+    dict
+
+    """
+    if compression is None:
+        return {}
+    if compression == 'lzf':
+        options = {'compression': 'lzf'}
+    else:
+        match = re.match(r'^gzip([1-9]?)$', compression)
+        if match is None:
+            raise ValueError("Unknown compression preset {!r}".format(
+                compression))
+        options = {'compression': 'gzip',
+                   'compression_opts': int(match.group(1) or 4)}
+    options['shuffle'] = shuffle
+    return options
+
+
 def maxlen(a):
     """
     HDF5 requires all datatypes to be at least 1 element long,
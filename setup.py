@@ -213,6 +213,7 @@ try:
                 'ptsa/extensions/edf/edffile.cpp',
                 'ptsa/extensions/edf/wrap.cpp',
             ],
+            include_dirs=[osp.join(extensions_dir, 'ThreadPool')],
         )
     ]
 except ImportError as err:
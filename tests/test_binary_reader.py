@@ -0,0 +1,348 @@
+import os.path as osp
+from tempfile import mkdtemp
+import shutil
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from ptsa.data.readers import BinaryRawReader, EEGReader
+
+
+def write_session(path, name, seed=0):
+    """Writes a small split-channel session (one int16 file per channel plus
+    a params.txt file) to ``path``."""
+    root = osp.join(path, name)
+    rng = np.random.RandomState(seed)
+    data = rng.randint(-2000, 2000, size=(4, 5000)).astype('<i2')
+    for i, channel_data in enumerate(data):
+        channel_data.tofile(root + '.{:03d}'.format(i + 1))
+    with open(osp.join(path, 'params.txt'), 'w') as f:
+        f.write('samplerate 1000\ngain 0.5\ndataformat \'int16\'\n')
+    return root, data
+
+
+@pytest.fixture
+def tempdir():
+    path = mkdtemp()
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def dataroot(tempdir):
+    return write_session(tempdir, 'R0000X_FR1_0')
+
+
+class TestBinaryRawReader:
+    channels = np.array(['001', '002', '004'])
+
+    @pytest.mark.parametrize('use_mmap', [True, False])
+    def test_read_epochs(self, dataroot, use_mmap):
+        root, data = dataroot
+        start_offsets = np.array([0, 1000, 10, 4500])
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=start_offsets, read_size=500,
+                                 use_mmap=use_mmap, read_strategy='events')
+        eventdata, mask = reader.read()
+        assert eventdata.shape == (3, 4, 500)
+        assert mask.all()
+        for e, offset in enumerate(start_offsets):
+            assert_array_equal(eventdata.values[:, e],
+                               data[[0, 1, 3], offset:offset + 500] * 0.5)
+
+    @pytest.mark.parametrize('use_mmap', [True, False])
+    def test_bad_offsets(self, dataroot, use_mmap):
+        root, data = dataroot
+        start_offsets = np.array([-5, 100, 4800])
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=start_offsets, read_size=500,
+                                 use_mmap=use_mmap, read_strategy='events')
+        eventdata, mask = reader.read()
+        assert_array_equal(mask, [[False, True, False]] * 3)
+        assert np.isnan(eventdata.values[:, [0, 2]]).all()
+        assert_array_equal(eventdata.values[:, 1], data[[0, 1, 3], 100:600] * 0.5)
+
+    def test_mmap_matches_seek(self, dataroot):
+        root, _ = dataroot
+        start_offsets = np.arange(-100, 5000, 37)
+        results = [
+            BinaryRawReader(dataroot=root, channels=self.channels,
+                            start_offsets=start_offsets, read_size=250,
+                            use_mmap=use_mmap, read_strategy='events').read()
+            for use_mmap in (True, False)
+        ]
+        assert_array_equal(results[0][0].values, results[1][0].values)
+        assert_array_equal(results[0][1], results[1][1])
+
+    @pytest.mark.parametrize('keep_open', [False, True])
+    def test_read_strategies_match(self, dataroot, keep_open):
+        root, _ = dataroot
+        start_offsets = np.concatenate([np.arange(-100, 5000, 37), [4900, 0, 2000]])
+        results = {}
+        for strategy in ('events', 'coalesced', 'session'):
+            reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                     start_offsets=start_offsets, read_size=250,
+                                     read_strategy=strategy)
+            reader.keep_open = keep_open
+            results[strategy] = reader.read()
+            assert reader.read_plan.strategy == strategy
+            reader.close()
+
+        for strategy in ('coalesced', 'session'):
+            assert_array_equal(results[strategy][0].values, results['events'][0].values)
+            assert_array_equal(results[strategy][1], results['events'][1])
+
+    def test_read_plan(self, dataroot):
+        root, data = dataroot
+        # heavily overlapping windows are read once
+        start_offsets = np.arange(0, 4500, 10)
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=start_offsets, read_size=500)
+        eventdata, _ = reader.read()
+        assert reader.read_plan.strategy != 'events'
+        assert reader.read_plan.bytes_read <= 5000 * 2
+        assert reader.read_plan.bytes_requested == len(start_offsets) * 500 * 2
+        assert_array_equal(eventdata.values[:, -1], data[[0, 1, 3], 4490:4990] * 0.5)
+
+    def test_workers(self, dataroot):
+        root, _ = dataroot
+        start_offsets = np.arange(0, 4000, 100)
+        serial, parallel = [
+            BinaryRawReader(dataroot=root, channels=self.channels,
+                            start_offsets=start_offsets, read_size=250,
+                            workers=workers).read()
+            for workers in (1, 3)
+        ]
+        assert_array_equal(serial[0].values, parallel[0].values)
+        assert_array_equal(serial[1], parallel[1])
+
+    def test_read_into(self, dataroot):
+        root, data = dataroot
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=np.array([300, -1, 200]),
+                                 read_size=50)
+        out = reader.empty_eventdata((3, 5, 50))
+        mask = reader.read_into(out, np.array([4, 0, 2]))
+        assert_array_equal(mask, [[True, False, True]] * 3)
+        assert_array_equal(out[:, 4], data[[0, 1, 3], 300:350] * 0.5)
+        assert_array_equal(out[:, 2], data[[0, 1, 3], 200:250] * 0.5)
+        assert np.isnan(out[:, [0, 1, 3]]).all()
+
+    def test_full_session(self, dataroot):
+        root, data = dataroot
+        reader = BinaryRawReader(dataroot=root, channels=self.channels)
+        eventdata, mask = reader.read()
+        assert mask.all()
+        assert_array_equal(eventdata.values[:, 0], data[[0, 1, 3]] * 0.5)
+
+    def test_channel_file_rewritten(self, dataroot):
+        root, data = dataroot
+        reader = BinaryRawReader(dataroot=root, channels=self.channels)
+        reader.read()
+
+        # truncate and rewrite the channel files in place
+        for i in (0, 1, 3):
+            data[i, :3000].tofile(root + '.{:03d}'.format(i + 1))
+        reader = BinaryRawReader(dataroot=root, channels=self.channels)
+        eventdata, mask = reader.read()
+        assert mask.all()
+        assert_array_equal(eventdata.values[:, 0], data[[0, 1, 3], :3000] * 0.5)
+
+    def test_kept_open_file_grows(self, dataroot):
+        root, data = dataroot
+        for i in (0, 1, 3):
+            data[i, :3000].tofile(root + '.{:03d}'.format(i + 1))
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=np.array([100, 4000]), read_size=500,
+                                 read_strategy='events')
+        reader.keep_open = True
+        _, mask = reader.read()
+        assert_array_equal(mask, [[True, False]] * 3)
+
+        # the memory maps kept open are replaced once the files change
+        for i in (0, 1, 3):
+            data[i].tofile(root + '.{:03d}'.format(i + 1))
+        eventdata, mask = reader.read()
+        assert mask.all()
+        assert_array_equal(eventdata.values[:, 1], data[[0, 1, 3], 4000:4500] * 0.5)
+        reader.close()
+
+    @pytest.mark.parametrize('keep_open', [False, True])
+    @pytest.mark.parametrize('read_strategy', ['events', 'session'])
+    def test_empty_channel_file(self, dataroot, read_strategy, keep_open):
+        root, _ = dataroot
+        open(root + '.005', 'wb').close()
+        reader = BinaryRawReader(dataroot=root, channels=np.array(['005']),
+                                 read_strategy=read_strategy)
+        reader.keep_open = keep_open
+        eventdata, mask = reader.read()
+        assert eventdata.shape == (1, 1, 0)
+        assert mask.all()
+
+    @pytest.mark.parametrize('dtype,expected', [
+        ('float64', np.float64), ('float32', np.float32), ('native', np.int16)
+    ])
+    def test_dtype(self, dataroot, dtype, expected):
+        root, data = dataroot
+        reader = BinaryRawReader(dataroot=root, channels=self.channels,
+                                 start_offsets=np.array([-1, 10]), read_size=100,
+                                 dtype=dtype)
+        eventdata, mask = reader.read()
+        assert eventdata.dtype == expected
+        assert_array_equal(mask[:, 0], False)
+        if dtype == 'native':
+            assert eventdata.attrs['scale'] == 0.5
+            assert_array_equal(eventdata.values[:, 1], data[[0, 1, 3], 10:110])
+        else:
+            assert 'scale' not in eventdata.attrs
+            assert_array_equal(eventdata.values[:, 1], data[[0, 1, 3], 10:110] * 0.5)
+
+
+class TestEEGReader:
+    @pytest.mark.parametrize('dtype', ['float64', 'float32', 'native'])
+    def test_dtype(self, dataroot, dtype):
+        root, data = dataroot
+        events = np.rec.array(
+            [(root, 2000), (root, 100), (root, 4950), (root, 1000)],
+            dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+        channels = np.array(['001', '003'])
+        with pytest.warns(UserWarning):
+            eeg = EEGReader(events=events, channels=channels, start_time=0.0,
+                            end_time=0.1, dtype=dtype).read()
+        assert eeg.shape == (2, 3, 100)
+        assert_array_equal(eeg['events'].values['eegoffset'], [2000, 100, 1000])
+
+        expected = np.stack([data[[0, 2], offset:offset + 100]
+                             for offset in (2000, 100, 1000)], axis=1) * 0.5
+        assert_array_equal(eeg.scaled().values, expected)
+        assert 'scale' not in eeg.scaled().attrs
+        if dtype == 'native':
+            assert eeg.dtype == np.int16
+            assert eeg.attrs['scale'] == 0.5
+        else:
+            assert eeg.dtype == np.dtype(dtype)
+
+    def test_peak_memory(self, dataroot):
+        import tracemalloc
+        root, data = dataroot
+        offsets = np.arange(0, 4000, 10)
+        events = np.rec.array([(root, offset) for offset in offsets],
+                              dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+        reader = EEGReader(events=events, channels=np.array(['001', '002', '003', '004']),
+                           start_time=0.0, end_time=1.0)
+        output_bytes = 4 * len(offsets) * 1000 * 8
+
+        tracemalloc.start()
+        try:
+            eeg = reader.read()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert eeg.shape == (4, len(offsets), 1000)
+        assert_array_equal(eeg.values[:, 1], data[:, 10:1010] * 0.5)
+        # the samples are read straight into the output
+        assert peak < 1.25 * output_bytes
+
+    @pytest.mark.parametrize('pool', [None, ThreadPoolExecutor, ProcessPoolExecutor])
+    def test_parallel_preserves_event_order(self, tempdir, pool):
+        sessions = [write_session(tempdir, 'R0000X_FR1_{}'.format(i), seed=i)
+                    for i in range(3)]
+        rng = np.random.RandomState(42)
+        session_index = rng.randint(0, 3, 30)
+        offsets = rng.randint(0, 4800, 30)
+        events = np.rec.array(
+            [(sessions[i][0], offset) for i, offset in zip(session_index, offsets)],
+            dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+        channels = np.array(['001', '002', '003', '004'])
+
+        kwargs = dict(events=events, channels=channels, start_time=0.0, end_time=0.1)
+        if pool is None:
+            eeg = EEGReader(workers=3, **kwargs).read()
+        else:
+            with pool(max_workers=2) as executor:
+                eeg = EEGReader(executor=executor, **kwargs).read()
+
+        assert_array_equal(eeg['events'].values['eegoffset'], offsets)
+        for e, (i, offset) in enumerate(zip(session_index, offsets)):
+            assert_array_equal(eeg.values[:, e], sessions[i][1][:, offset:offset + 100] * 0.5)
+
+    @pytest.mark.parametrize('pool', [None, ProcessPoolExecutor])
+    def test_read_stats(self, tempdir, pool):
+        sessions = [write_session(tempdir, 'R0000X_FR1_{}'.format(i), seed=i)
+                    for i in range(2)]
+        events = np.rec.array(
+            [(sessions[0][0], offset) for offset in range(0, 4000, 100)] +
+            [(sessions[1][0], 100), (sessions[1][0], 3000)],
+            dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+        channels = np.array(['001', '002'])
+
+        kwargs = dict(events=events, channels=channels, start_time=0.0, end_time=1.0)
+        if pool is None:
+            reader = EEGReader(**kwargs)
+            eeg = reader.read()
+        else:
+            with pool(max_workers=2) as executor:
+                reader = EEGReader(executor=executor, **kwargs)
+                eeg = reader.read()
+
+        expected = EEGReader(read_strategy='events', **kwargs).read()
+        assert_array_equal(eeg.values, expected.values)
+
+        stats = reader.get_read_stats()
+        assert [s['dataroot'] for s in stats] == [sessions[0][0], sessions[1][0]]
+        assert stats[0]['bytes_requested'] == 40 * 1000 * 2 * 2
+        assert stats[0]['bytes_read'] < stats[0]['bytes_requested']
+        assert stats[0]['strategy'] in ('coalesced', 'session')
+
+    @pytest.fixture
+    def sessions_and_events(self, tempdir):
+        sessions = [write_session(tempdir, 'R0000X_FR1_{}'.format(i), seed=i)
+                    for i in range(2)]
+        rng = np.random.RandomState(1)
+        session_index = rng.randint(0, 2, 25)
+        offsets = rng.randint(0, 4800, 25)
+        offsets[[3, 17]] = 4950
+        events = np.rec.array(
+            [(sessions[i][0], offset) for i, offset in zip(session_index, offsets)],
+            dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+        return sessions, events
+
+    @pytest.mark.parametrize('by,batch_size', [('events', 7), ('events', 100), ('channels', 3)])
+    def test_iter_batches(self, sessions_and_events, by, batch_size):
+        _, events = sessions_and_events
+        channels = np.array(['001', '002', '003', '004'])
+        kwargs = dict(events=events, channels=channels, start_time=0.0, end_time=0.1)
+
+        with pytest.warns(UserWarning):
+            expected = EEGReader(**kwargs).read()
+
+        reader = EEGReader(**kwargs)
+        with pytest.warns(UserWarning):
+            batches = list(reader.iter_batches(batch_size, by=by))
+        assert_array_equal(reader.get_event_ok_mask(), events.eegoffset != 4950)
+
+        if by == 'events':
+            assert len(batches) == int(np.ceil(len(events) / float(batch_size)))
+            assert all(b.shape[1] <= batch_size for b in batches)
+            concat_dim = 1
+            assert_array_equal(np.concatenate([b['events'].values for b in batches]),
+                               expected['events'].values)
+        else:
+            assert [b.shape[0] for b in batches] == [3, 1]
+            concat_dim = 0
+            for b in batches:
+                assert_array_equal(b['events'].values, expected['events'].values)
+            assert_array_equal(np.concatenate([b['channels'].values for b in batches]),
+                               expected['channels'].values)
+
+        assert_array_equal(np.concatenate([b.values for b in batches], axis=concat_dim),
+                           expected.values)
+
+    def test_iter_batches_invalid(self, sessions_and_events):
+        _, events = sessions_and_events
+        reader = EEGReader(events=events, channels=np.array(['001']), end_time=0.1)
+        with pytest.raises(ValueError):
+            next(reader.iter_batches(10, by='time'))
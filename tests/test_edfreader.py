@@ -109,3 +109,229 @@ if __name__ == '__main__':
     test2.test_channels('LTP360', 3)
     test2.test_all_channels('LTP360', 3)
     test2.test_full_session('LTP342', 22)
+
+
+def test_eeg_reader_local(local_eegfile):
+    offsets = np.array([1500, 0, 700, 1200])
+    events = np.rec.array([(local_eegfile, offset) for offset in offsets],
+                          dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+    channels = np.array([0, 3, 6])
+    eeg = EEGReader(events=events, channels=channels,
+                    start_time=0.0, end_time=0.5).read()
+
+    samplerate = float(eeg['samplerate'])
+    read_size = int(np.round(0.5 * samplerate))
+    data, mask = EDFRawReader(dataroot=local_eegfile, channels=channels,
+                              start_offsets=offsets, read_size=read_size).read()
+    assert eeg.shape == (3, 4, read_size)
+    np.testing.assert_array_equal(eeg['events'].values['eegoffset'], offsets)
+    np.testing.assert_array_equal(eeg.values, data.values)
+
+
+class TestReadEpochs:
+    @pytest.fixture
+    def edf(self, local_eegfile):
+        from ptsa.extensions.edf import EDFFile
+        edf = EDFFile(local_eegfile)
+        yield edf
+        edf.close()
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    def test_matches_read_samples(self, edf, threads):
+        channels = [0, 3, 6, 10, 11]
+        offsets = np.array([1500, 0, -10, 700, 1900])
+        data, mask = edf.read_epochs(channels, offsets, 200, threads=threads)
+
+        assert data.shape == (5, 5, 200)
+        np.testing.assert_array_equal(mask, [True, True, False, True, False])
+        assert np.isnan(data[:, ~mask]).all()
+        for e in np.flatnonzero(mask):
+            np.testing.assert_array_equal(data[:, e], edf.read_samples(channels, 200, offsets[e]))
+
+    def test_open_twice(self, edf, local_eegfile):
+        # read_epochs opens one extra handle per thread, so a file must be openable more than once
+        from ptsa.extensions.edf import EDFFile
+        other = EDFFile(local_eegfile)
+        np.testing.assert_array_equal(other.read_samples([0], 10, 5), edf.read_samples([0], 10, 5))
+        expected = other.read_samples([0], 10, 5)
+        other.close()
+        # closing the second handle leaves the first one open
+        np.testing.assert_array_equal(edf.read_samples([0], 10, 5), expected)
+
+    def test_out(self, edf):
+        offsets = np.array([10, 2000, 100])
+        out = np.full((2, 4, 50), -1.0)
+        # a strided view of a larger array is filled in place
+        view = out[:, ::-1][:, :3]
+        result, mask = edf.read_epochs([1, 2], offsets, 50, out=view)
+        assert np.shares_memory(result, out)
+        np.testing.assert_array_equal(mask, [True, False, True])
+        np.testing.assert_array_equal(out[:, 3], edf.read_samples([1, 2], 50, 10))
+        np.testing.assert_array_equal(out[:, 2], -1.0)
+        np.testing.assert_array_equal(out[:, 1], edf.read_samples([1, 2], 50, 100))
+
+        with pytest.raises(ValueError):
+            edf.read_epochs([1, 2], offsets, 40, out=out)
+        with pytest.raises(TypeError):
+            edf.read_epochs([1, 2], offsets, 50, out=out[:, :3].astype(np.float32))
+        with pytest.raises(IndexError):
+            edf.read_epochs([100], offsets, 50)
+
+    def test_reader_flags_epochs_past_end(self, local_eegfile):
+        data, mask = EDFRawReader(dataroot=local_eegfile, channels=np.array([0, 3]),
+                                  start_offsets=np.array([1900, 100]), read_size=200,
+                                  dtype='float32', workers=2).read()
+        np.testing.assert_array_equal(mask, [[False, True]] * 2)
+        assert data.dtype == np.float32
+        assert np.isnan(data.values[:, 0]).all()
+        assert not np.isnan(data.values[:, 1]).any()
+
+    @pytest.mark.parametrize('channels', [[], [0, 3], ['EEG FP1', 'EEG C3']])
+    def test_output_channels(self, local_eegfile, channels):
+        reader = EDFRawReader(dataroot=local_eegfile, channels=np.array(channels), start_offsets=np.array([0]),
+                              read_size=10)
+        # known before reading
+        output_channels = reader.output_channels()
+        data, _ = reader.read()
+        np.testing.assert_array_equal(output_channels, data['channels'].values)
+
+    @pytest.mark.parametrize('backend', ['edflib', 'mmap'])
+    def test_read_into_rows(self, local_eegfile, backend):
+        offsets = np.array([1900, 100, 0, 700])
+        kwargs = dict(dataroot=local_eegfile, channels=np.array([0, 3]), start_offsets=offsets, read_size=200,
+                      backend=backend)
+        expected, expected_mask = EDFRawReader(**kwargs).read()
+        for dtype in ('float64', 'float32'):
+            reader = EDFRawReader(dtype=dtype, **kwargs)
+            out = reader.empty_eventdata((2, 6, 200), dtype=reader.output_dtype())
+            mask = reader.read_into(out, np.array([5, 1, 2, 0]))
+            np.testing.assert_array_equal(mask, expected_mask)
+            np.testing.assert_allclose(out[:, [5, 1, 2, 0]], expected.values, rtol=1e-6)
+            assert np.isnan(out[:, [3, 4]]).all()
+
+    def test_float32_peak_memory(self, local_eegfile, monkeypatch):
+        import tracemalloc
+        from ptsa.data.readers.edf import edf as edf_module
+        monkeypatch.setattr(edf_module, 'EPOCH_BLOCK_BYTES', 2 ** 20)
+        offsets = np.tile(np.arange(0, 1800, 50), 100)
+        reader = EDFRawReader(dataroot=local_eegfile, channels=np.arange(12), start_offsets=offsets,
+                              read_size=200, dtype='float32')
+        output_bytes = 12 * len(offsets) * 200 * 4
+
+        tracemalloc.start()
+        try:
+            data, mask = reader.read_file(local_eegfile, reader.channels, offsets, 200)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert data.dtype == np.float32 and mask.all()
+        # no float64 copy of the whole output is made
+        assert peak < 1.5 * output_bytes
+
+
+class TestEDFMemmapFile:
+    @pytest.fixture(params=['eeg.edf', 'ok_header.bdf'])
+    def files(self, request):
+        from ptsa.extensions.edf import EDFFile
+        from ptsa.data.readers.edf import EDFMemmapFile
+        filename = osp.join(osp.dirname(__file__), 'data', request.param)
+        edf = EDFFile(filename)
+        yield edf, EDFMemmapFile(filename)
+        edf.close()
+
+    def test_header(self, files):
+        edf, mm = files
+        assert mm.num_channels == edf.num_channels
+        assert mm.num_samples == edf.num_samples
+        for c in range(edf.num_channels):
+            assert mm.get_channel_info(c).label == edf.get_channel_info(c).label
+            assert mm.get_channel_info(c).smp_in_file == edf.get_channel_info(c).smp_in_file
+            assert mm.get_samplerate(c) == edf.get_samplerate(c)
+        with pytest.raises(IndexError):
+            mm.get_channel_info(edf.num_channels)
+
+    def test_read_samples(self, files):
+        edf, mm = files
+        channels = list(range(edf.num_channels))
+        np.testing.assert_array_equal(mm.read_samples(channels, edf.num_samples),
+                                      edf.read_samples(channels, edf.num_samples))
+        np.testing.assert_array_equal(mm.read_samples([2, 0], 30, 17),
+                                      edf.read_samples([2, 0], 30, 17))
+
+    def test_read_epochs(self, files):
+        edf, mm = files
+        channels = [0, 1, 5]
+        offsets = np.array([3, -1, edf.num_samples - 40, edf.num_samples - 10, 25])
+        for threads in (1, 2):
+            data, mask = mm.read_epochs(channels, offsets, 40, threads=threads)
+            expected, expected_mask = edf.read_epochs(channels, offsets, 40)
+            np.testing.assert_array_equal(mask, expected_mask)
+            np.testing.assert_array_equal(data, expected)
+
+    def test_reader_backend(self, local_eegfile):
+        kwargs = dict(dataroot=local_eegfile, channels=np.array(['EEG FP1', 'EEG C3']),
+                      start_offsets=np.array([1900, 100, 0]), read_size=200)
+        data, mask = EDFRawReader(backend='mmap', **kwargs).read()
+        expected, expected_mask = EDFRawReader(**kwargs).read()
+        np.testing.assert_array_equal(mask, expected_mask)
+        np.testing.assert_array_equal(data.values, expected.values)
+
+        session, _ = EDFRawReader(backend='mmap', dataroot=local_eegfile, channels=np.array([0, 3])).read()
+        expected, _ = EDFRawReader(dataroot=local_eegfile, channels=np.array([0, 3])).read()
+        np.testing.assert_array_equal(session.values, expected.values)
+
+
+class TestHeaderCache:
+    @pytest.fixture
+    def open_count(self, monkeypatch):
+        from ptsa.data.readers.cache import metadata_cache
+        metadata_cache.clear()
+        count = {'n': 0}
+        open_file = EDFRawReader.open_file
+
+        def counting_open_file(self):
+            count['n'] += 1
+            return open_file(self)
+
+        monkeypatch.setattr(EDFRawReader, 'open_file', counting_open_file)
+        yield count
+        metadata_cache.clear()
+
+    @pytest.mark.parametrize('backend', ['edflib', 'mmap'])
+    def test_header_parsed_once(self, local_eegfile, open_count, backend):
+        readers = [EDFRawReader(dataroot=local_eegfile, channels=np.array(['EEG FP1', 'EEG C3']),
+                                start_offsets=np.array([0, 100]), read_size=50, backend=backend)
+                   for _ in range(3)]
+        assert open_count['n'] == 1
+        assert readers[0].params_dict['samplerate'] == pytest.approx(200.0)
+
+        reader = readers[0]
+        reader.keep_open = True
+        reader.read()
+        reader.start_offsets = np.array([500])
+        kept_open, _ = reader.read()
+        assert open_count['n'] == 2
+        reader.close()
+
+        # without keep_open the file is closed after every read
+        readers[1].start_offsets = np.array([500])
+        expected, _ = readers[1].read()
+        readers[1].read()
+        assert open_count['n'] == 4
+        np.testing.assert_array_equal(kept_open.values, expected.values)
+
+    def test_channel_errors(self, local_eegfile):
+        with pytest.raises(RuntimeError):
+            EDFRawReader(dataroot=local_eegfile, channels=np.array(['NOT A CHANNEL']))
+        with pytest.raises(IndexError):
+            EDFRawReader(dataroot=local_eegfile, channels=np.array([100]))
+
+    def test_pickle(self, local_eegfile):
+        import pickle
+        reader = EDFRawReader(dataroot=local_eegfile, channels=np.array([0, 1]),
+                              start_offsets=np.array([0]), read_size=10)
+        reader.keep_open = True
+        data, _ = reader.read()
+        clone = pickle.loads(pickle.dumps(reader))
+        np.testing.assert_array_equal(clone.read()[0].values, data.values)
+        reader.close()
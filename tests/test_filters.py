@@ -1,16 +1,19 @@
+import tracemalloc
 import unittest
 import os.path as osp
 import pytest
 import xarray as xr
 
 import numpy as np
-from numpy.testing import assert_array_equal, assert_array_almost_equal
+from numpy.testing import assert_allclose, assert_array_equal, assert_array_almost_equal
 
 from ptsa.data import timeseries
 from ptsa.data.filters import (
-    BaseFilter, ButterworthFilter, DataChopper, MonopolarToBipolarMapper,
-    MorletWaveletFilter, ResampleFilter
+    BaseFilter, ButterworthFilter, DataChopper, LineNoiseFilter,
+    MonopolarToBipolarMapper, MorletWaveletFilter, Pipeline, RereferenceFilter,
+    ResampleFilter, StreamingFilter
 )
+from ptsa.data.filters.rereference import _montage_matrix, montage_matrix
 from ptsa.data.readers import BaseEventReader, EEGReader
 from ptsa.data.readers.tal import TalReader
 from ptsa.test.utils import get_rhino_root, skip_without_rhino
@@ -159,6 +162,39 @@ def test_monopolar_to_bipolar_filter_norhino():
                               ts.sel(channels=range(1,10)).values))
 
 
+def _baseline_bipolar(ts, bipolar_pairs, channels_dim='channels', chan_names=('ch0', 'ch1')):
+    """MonopolarToBipolarMapper output as computed before it used bipolar_array"""
+    channel_axis = ts[channels_dim]
+    ts0 = ts.loc[{channels_dim: channel_axis.loc[bipolar_pairs[chan_names[0]]]}]
+    ts1 = ts.loc[{channels_dim: channel_axis.loc[bipolar_pairs[chan_names[1]]]}]
+    return ts0.values - ts1.values
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.int16])
+def test_monopolar_to_bipolar_matches_baseline(dtype):
+    rng = np.random.RandomState(3)
+    labels = np.array(['{:03d}'.format(c) for c in rng.permutation(12) + 1])
+    ts = timeseries.TimeSeries.create(
+        (rng.randn(4, 12, 30) * 100).astype(dtype), 100.,
+        dims=('events', 'channels', 'time'),
+        coords={'channels': labels, 'events': np.arange(4), 'time': np.arange(30) / 100.})
+
+    # pairs in a different order than the channels, with channels used more than once
+    pairs = np.rec.array([('012', '001'), ('003', '004'), ('001', '007'), ('010', '003'), ('004', '012')],
+                         dtype=[('ch0', 'U3'), ('ch1', 'U3')])
+    bipolar = MonopolarToBipolarMapper(timeseries=ts, bipolar_pairs=pairs).filter()
+    # the input is converted to float64 like any filter input
+    assert bipolar.dtype == np.float64
+    assert_array_equal(bipolar.values, _baseline_bipolar(ts.astype(np.float64), pairs))
+    assert_array_equal(bipolar['channels'].values, pairs)
+
+    missing = np.rec.array([('001', '002'), ('013', '003')], dtype=[('ch0', 'U3'), ('ch1', 'U3')])
+    with pytest.raises(KeyError):
+        _baseline_bipolar(ts, missing)
+    with pytest.raises(KeyError):
+        MonopolarToBipolarMapper(timeseries=ts, bipolar_pairs=missing).filter()
+
+
 @pytest.mark.filters
 @skip_without_rhino
 class TestFilters(unittest.TestCase):
@@ -351,6 +387,432 @@ class TestFiltersExecute:
         assert new_ts.samplerate == 50.
 
 
+class TestButterworthFilter:
+    @pytest.fixture
+    def timeseries(self):
+        rng = np.random.RandomState(0)
+        return timeseries.TimeSeries(
+            rng.standard_normal((3, 4, 2000)), dims=('channels', 'events', 'time'),
+            coords={'channels': ['a', 'b', 'c'], 'events': np.arange(4),
+                    'time': np.arange(2000) / 1000., 'samplerate': 1000.})
+
+    def test_design_cache(self):
+        from ptsa.filt import butter_sos, _butter_sos
+
+        _butter_sos.cache_clear()
+        sos = butter_sos(4, [58, 62], 1000, 'stop')
+        assert sos.shape == (4, 6)
+        sos[:] = 0
+        assert_array_equal(butter_sos(4, np.array([58., 62.]), 1000., 'stop'),
+                           _butter_sos(4, (58., 62.), 1000., 'stop'))
+        assert _butter_sos.cache_info().hits == 2
+        assert _butter_sos.cache_info().misses == 1
+
+    def test_stable_at_low_frequencies(self, timeseries):
+        # the (b, a) design of this filter is unstable
+        filtered = ButterworthFilter(timeseries, [0.5, 2.], order=8,
+                                     filt_type='pass').filter()
+        assert np.isfinite(filtered.values).all()
+        assert filtered.values.std() < timeseries.values.std()
+
+    @pytest.mark.parametrize('cpus', [1, 3])
+    def test_matches_filtfilt(self, timeseries, cpus):
+        from scipy.signal import butter, sosfiltfilt
+
+        filtered = ButterworthFilter(timeseries.transpose('time', 'events', 'channels'),
+                                     [58., 62.], cpus=cpus).filter()
+        assert filtered.dims == ('time', 'events', 'channels')
+        expected = sosfiltfilt(butter(4, [58. / 500, 62. / 500], 'stop', output='sos'),
+                               timeseries.values, axis=-1)
+        assert_array_almost_equal(filtered.transpose('channels', 'events', 'time').values,
+                                  expected, decimal=12)
+        assert_array_equal(filtered.events, timeseries.events)
+        assert filtered.samplerate == 1000.
+
+    def test_bank(self, timeseries):
+        bands = [[4., 8.], [8., 12.], [30., 80.]]
+        bank = ButterworthFilter(timeseries, bands, filt_type='pass',
+                                 cpus=2).filter()
+        assert bank.dims == ('band', 'channels', 'events', 'time')
+        assert bank.shape == (3, 3, 4, 2000)
+        assert_array_equal(bank.band.values['low'], [4., 8., 30.])
+        assert_array_equal(bank.band.values['high'], [8., 12., 80.])
+        for i, band in enumerate(bands):
+            single = ButterworthFilter(timeseries, band, filt_type='pass').filter()
+            assert_array_equal(bank.values[i], single.values)
+
+        with pytest.raises(ValueError):
+            ButterworthFilter(timeseries, [1., 2., 3.])
+        with pytest.raises(ValueError):
+            ButterworthFilter(timeseries, [[1., 2., 3.]])
+
+
+class TestLineNoiseFilter:
+    @pytest.fixture
+    def timeseries(self):
+        rng = np.random.RandomState(0)
+        samplerate = 500.
+        time = np.arange(10000) / samplerate
+        signal = np.sin(2 * np.pi * 10 * time)
+        noise = sum(np.sin(2 * np.pi * f * time) for f in (60., 120., 180.))
+        data = signal + noise + 0.1 * rng.standard_normal((3, len(time)))
+        return timeseries.TimeSeries(
+            data, dims=('channels', 'time'),
+            coords={'channels': ['a', 'b', 'c'], 'time': time,
+                    'samplerate': samplerate},
+            name='eeg', attrs={'subject': 'R1'})
+
+    @pytest.mark.parametrize('cpus', [1, 2])
+    def test_matches_chained_butterworth(self, timeseries, cpus):
+        filtered = LineNoiseFilter(timeseries, harmonics=2, cpus=cpus).filter()
+        assert isinstance(filtered, timeseries.__class__)
+        assert filtered.name == 'eeg'
+        assert filtered.attrs == {'subject': 'R1'}
+        assert_array_equal(filtered.channels, timeseries.channels)
+
+        chained = timeseries
+        for band in ([58., 62.], [118., 122.], [178., 182.]):
+            chained = ButterworthFilter(chained, band, order=4,
+                                        filt_type='stop').filter()
+        # identical away from the edges, where the padding of each pass differs
+        assert_array_almost_equal(filtered.values[:, 2000:-2000],
+                                  chained.values[:, 2000:-2000], decimal=6)
+
+        spectrum = np.abs(np.fft.rfft(filtered.values[:, 2000:-2000], axis=-1))
+        freqs = np.fft.rfftfreq(filtered.shape[-1] - 4000, 1 / 500.)
+        for f in (60., 120., 180.):
+            line = np.argmin(np.abs(freqs - f))
+            signal = np.argmin(np.abs(freqs - 10.))
+            assert (spectrum[:, line] < 1e-2 * spectrum[:, signal]).all()
+
+    def test_nyquist(self, timeseries):
+        lnf = LineNoiseFilter(timeseries, harmonics=5)
+        assert lnf.stop_bands(500.) == [[58., 62.], [118., 122.], [178., 182.],
+                                        [238., 242.]]
+        assert lnf.design(500.).shape == (16, 6)
+        with pytest.raises(ValueError):
+            LineNoiseFilter(timeseries, freq=300.).filter()
+
+
+class TestPipeline:
+    @pytest.fixture
+    def timeseries(self):
+        rng = np.random.RandomState(0)
+        samplerate = 500.
+        events = np.rec.fromarrays([np.arange(4), np.array(['a', 'b'] * 2)],
+                                   names='eegoffset,type')
+        time = np.arange(1000) / samplerate - 0.5
+        data = rng.standard_normal((4, 3, len(time))).astype(np.float32)
+        return timeseries.TimeSeries(
+            data, dims=('events', 'channels', 'time'),
+            coords={'events': events, 'channels': ['1', '2', '3'],
+                    'time': time, 'samplerate': samplerate},
+            name='eeg', attrs={'subject': 'R1'})
+
+    @pytest.mark.parametrize('output', ['power', ['power', 'phase']])
+    def test_matches_chained_filters(self, timeseries, output):
+        pairs = np.rec.fromarrays([['1', '2'], ['2', '3']], names='ch0,ch1')
+        freqs = np.array([5., 10., 20.])
+        stages = [
+            (MonopolarToBipolarMapper, {'bipolar_pairs': pairs}),
+            (ButterworthFilter, {'freq_range': [58., 62.]}),
+            ('line_noise', {'freq': 50., 'harmonics': 1}),
+            (ResampleFilter, {'resamplerate': 250.}),
+            (MorletWaveletFilter, {'freqs': freqs, 'output': output}),
+            ('remove_buffer', {'duration': 0.2}),
+        ]
+        original = timeseries.copy(deep=True)
+        pipeline = Pipeline(stages)
+        fused = pipeline.run(timeseries)
+
+        chained = MonopolarToBipolarMapper(timeseries.copy(deep=True),
+                                           pairs).filter()
+        chained = ButterworthFilter(chained, [58., 62.]).filter()
+        chained = LineNoiseFilter(chained, freq=50., harmonics=1).filter()
+        chained = ResampleFilter(chained, 250.).filter()
+        chained = MorletWaveletFilter(chained, freqs, output=output,
+                                      verbose=False).filter()
+        chained = chained.remove_buffer(0.2)
+
+        assert fused.dims == chained.dims
+        assert_array_almost_equal(fused.values, chained.values)
+        for dim in fused.dims:
+            assert_array_equal(fused[dim].values, chained[dim].values)
+        assert float(fused['samplerate']) == 250.
+        assert fused.name == 'eeg'
+        assert fused.attrs == {'subject': 'R1'}
+
+        # the input is left untouched
+        assert timeseries.data.dtype == np.float32
+        assert_array_equal(timeseries.values, original.values)
+
+        assert [stage.name for stage in pipeline.report] == [
+            'bipolar', 'butterworth', 'line_noise', 'resample', 'morlet',
+            'remove_buffer', 'coords']
+        assert pipeline.report[0].shape == (4, 2, 1000)
+        assert pipeline.report[-1].shape == fused.shape
+        assert all(stage.seconds >= 0 for stage in pipeline.report)
+        # filtering in place saves allocating the output of the filter
+        bipolar = MonopolarToBipolarMapper(timeseries.copy(deep=True),
+                                           pairs).filter()
+        tracemalloc.start()
+        ButterworthFilter(bipolar, [58., 62.]).filter()
+        filter_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert pipeline.report[1].peak_bytes < filter_peak
+        assert 'remove_buffer' in pipeline.format_report()
+
+    def test_in_place_and_bank(self, timeseries):
+        pipeline = Pipeline([('butterworth', {'freq_range': [[1., 10.], [10., 40.]],
+                                              'filt_type': 'pass'})],
+                            dtype=None, track_memory=False)
+        fused = pipeline.run(timeseries)
+        chained = ButterworthFilter(timeseries.copy(deep=True),
+                                    [[1., 10.], [10., 40.]],
+                                    filt_type='pass').filter()
+        assert fused.dims == chained.dims
+        assert_array_almost_equal(fused.values, chained.values, decimal=5)
+        assert_array_equal(fused.band.values, chained.band.values)
+        assert_array_equal(fused.events.values, timeseries.events.values)
+        assert pipeline.report[0].peak_bytes is None
+
+        pipeline = Pipeline([('butterworth', {'freq_range': [58., 62.]})],
+                            dtype=None)
+        fused = pipeline.run(timeseries)
+        assert fused.data.dtype == np.float32
+
+    @pytest.mark.skipif(not hasattr(tracemalloc, 'reset_peak'), reason='requires Python 3.9+')
+    def test_memory_tracked_by_default(self, timeseries):
+        pipeline = Pipeline([('butterworth', {'freq_range': [58., 62.]}),
+                             ('resample', {'resamplerate': 250.})])
+        pipeline.run(timeseries)
+        data_bytes = timeseries.size * 8
+        for stage in pipeline.report[:2]:
+            assert 0 < stage.peak_bytes < 8 * data_bytes
+        assert not tracemalloc.is_tracing()
+
+    def test_memory_without_reset_peak(self, timeseries, monkeypatch):
+        # tracemalloc.reset_peak only exists on Python 3.9+
+        monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+        pipeline = Pipeline([('butterworth', {'freq_range': [58., 62.]})])
+        pipeline.run(timeseries)
+        assert pipeline.report[0].peak_bytes is None
+        assert not tracemalloc.is_tracing()
+
+    def test_invalid_stages(self):
+        with pytest.raises(ValueError):
+            Pipeline([('wavelets', {})])
+        with pytest.raises(TypeError):
+            Pipeline([(ButterworthFilter, {'freq_rnge': [58., 62.]})])
+
+
+class TestRereferenceFilter:
+    @pytest.fixture
+    def timeseries(self):
+        rng = np.random.RandomState(0)
+        events = np.rec.fromarrays([np.arange(5)], names='eegoffset')
+        return timeseries.TimeSeries(
+            rng.randint(-100, 100, (4, 5, 50)).astype(np.int16),
+            dims=('channels', 'events', 'time'),
+            coords={'channels': np.array([b'001', b'002', b'003', b'004']),
+                    'events': events, 'time': np.arange(50) / 100.,
+                    'samplerate': 100.},
+            name='eeg', attrs={'subject': 'R1'})
+
+    @pytest.mark.parametrize('chunk_size', [0, 2])
+    def test_bipolar(self, timeseries, chunk_size):
+        pairs = np.rec.fromarrays([[b'001', b'002', b'004'],
+                                   [b'002', b'003', b'001']],
+                                  names='ch0,ch1')
+        original = timeseries.values.copy()
+        expected = MonopolarToBipolarMapper(timeseries, pairs).filter()
+        rereferenced = RereferenceFilter(timeseries, 'bipolar',
+                                         bipolar_pairs=pairs,
+                                         chunk_size=chunk_size).filter()
+        assert rereferenced.dims == expected.dims
+        assert_array_equal(rereferenced.values, expected.values)
+        assert_array_equal(rereferenced.channels.values, pairs)
+        assert_array_equal(rereferenced.events.values,
+                           timeseries.events.values)
+        assert rereferenced.name == 'eeg'
+        assert rereferenced.attrs == {'subject': 'R1'}
+        assert_array_equal(timeseries.values, original)
+        assert timeseries.data.dtype == np.int16
+
+        with pytest.raises(KeyError):
+            RereferenceFilter(timeseries, 'bipolar',
+                              bipolar_pairs=[[b'001'], [b'005']]).filter()
+
+    @pytest.mark.parametrize('chunk_size', [0, 3])
+    def test_average(self, timeseries, chunk_size):
+        # channels need not be the first dimension
+        ts = timeseries.transpose('events', 'time', 'channels')
+        rereferenced = RereferenceFilter(ts, chunk_size=chunk_size).filter()
+        expected = ts.values - ts.values.mean(axis=-1, keepdims=True)
+        assert_array_almost_equal(rereferenced.values, expected)
+        assert rereferenced.dims == ts.dims
+        assert_array_equal(rereferenced.channels, ts.channels)
+
+    def test_laplacian_and_custom(self, timeseries):
+        neighbors = {b'002': [b'001', b'003'], b'003': [b'002', b'004']}
+        rereferenced = RereferenceFilter(timeseries, 'laplacian',
+                                         neighbors=neighbors).filter()
+        data = timeseries.values.astype(float)
+        assert_array_almost_equal(rereferenced.values, [
+            data[1] - (data[0] + data[2]) / 2,
+            data[2] - (data[1] + data[3]) / 2])
+        assert_array_equal(rereferenced.channels, [b'002', b'003'])
+
+        weights = np.array([[1., 1., 0., 0.], [0., 0., .5, .5]])
+        out = np.empty((2, 5, 50))
+        rereferenced = RereferenceFilter(timeseries, 'custom', weights=weights,
+                                         out_channels=['a', 'b'],
+                                         out=out).filter()
+        assert np.shares_memory(rereferenced.data, out)
+        assert_array_almost_equal(rereferenced.values,
+                                  np.tensordot(weights, data, axes=1))
+        assert_array_equal(rereferenced.channels, ['a', 'b'])
+
+        with pytest.raises(ValueError):
+            RereferenceFilter(timeseries, 'custom', weights=weights[:, :2],
+                              out_channels=['a', 'b'])
+        with pytest.raises(ValueError):
+            RereferenceFilter(timeseries, 'laplacian')
+
+    def test_matrix_cache(self, timeseries):
+        pairs = [[b'001', b'002'], [b'002', b'003']]
+        matrix = montage_matrix('bipolar', timeseries.channels.values,
+                                bipolar_pairs=pairs)
+        assert_array_equal(matrix.toarray(), [[1., -1., 0., 0.],
+                                              [0., 1., -1., 0.]])
+        matrix.data[:] = 0
+        hits = _montage_matrix.cache_info().hits
+        matrix = RereferenceFilter(timeseries, 'bipolar',
+                                   bipolar_pairs=pairs).matrix()
+        assert _montage_matrix.cache_info().hits == hits + 1
+        assert_array_equal(matrix.toarray(), [[1., -1., 0., 0.],
+                                              [0., 1., -1., 0.]])
+
+    def test_pipeline(self, timeseries):
+        pipeline = Pipeline([(RereferenceFilter, {'montage': 'average',
+                                                  'chunk_size': 2}),
+                             ('butterworth', {'freq_range': [20., 30.]})])
+        fused = pipeline.run(timeseries)
+        chained = ButterworthFilter(RereferenceFilter(timeseries).filter(),
+                                    [20., 30.]).filter()
+        assert_array_almost_equal(fused.values, chained.values)
+        assert_array_equal(fused.channels, chained.channels)
+
+
+class TestStreamingFilter:
+    @pytest.fixture
+    def session(self):
+        rng = np.random.RandomState(0)
+        return timeseries.TimeSeries(
+            rng.standard_normal((2, 20000)) + 5., dims=('channels', 'time'),
+            coords={'channels': ['a', 'b'], 'time': np.arange(20000) / 1000.,
+                    'samplerate': 1000.},
+            attrs={'subject': 'R1'})
+
+    @staticmethod
+    def chunks(session, sizes=(1, 500, 3000, 7, 2000, 4000, 1492, 9000)):
+        start = 0
+        for size in sizes:
+            yield session.isel(time=slice(start, start + size))
+            start += size
+
+    def test_zero_phase(self, session):
+        from scipy.signal import sosfiltfilt
+        from ptsa.filt import butter_sos
+
+        expected = sosfiltfilt(butter_sos(4, [58., 62.], 1000., 'stop'),
+                               session.values, axis=-1)
+        filtered = list(StreamingFilter([58., 62.]).filter(self.chunks(session)))
+
+        assert [len(chunk.time) for chunk in filtered] == [
+            len(chunk.time) for chunk in self.chunks(session)]
+        for chunk, original in zip(filtered, self.chunks(session)):
+            assert isinstance(chunk, timeseries.TimeSeries)
+            assert_array_equal(chunk.time, original.time)
+            assert chunk.attrs == {'subject': 'R1'}
+        combined = np.concatenate([chunk.values for chunk in filtered], axis=-1)
+        assert_array_almost_equal(combined, expected, decimal=7)
+
+        # shorter padding trades accuracy for memory
+        short = StreamingFilter([58., 62.], padding=0.2).filter(self.chunks(session))
+        combined = np.concatenate([chunk.values for chunk in short], axis=-1)
+        assert np.abs(combined - expected).max() > 1e-7
+
+    def test_causal(self, session):
+        from scipy.signal import sosfilt, sosfilt_zi
+        from ptsa.filt import butter_sos
+
+        sos = butter_sos(2, [1., 40.], 1000., 'pass')
+        zi = sosfilt_zi(sos)[:, None, :] * session.values[None, :, :1]
+        expected, _ = sosfilt(sos, session.values, axis=-1, zi=zi)
+
+        streaming = StreamingFilter(mode='causal', sos=sos)
+        chunks = self.chunks(session.transpose('time', 'channels'))
+        filtered = [chunk.values for chunk in streaming.filter(chunks)]
+        assert_array_equal(np.concatenate(filtered, axis=0).T, expected)
+
+    def test_constant_memory(self, session):
+        from itertools import islice
+
+        def endless():
+            while True:
+                yield session
+
+        # chunks are yielded without waiting for the end of the stream
+        filtered = list(islice(StreamingFilter([58., 62.]).filter(endless()), 3))
+        assert len(filtered) == 3
+        assert list(StreamingFilter([58., 62.]).filter([])) == []
+
+
+class TestResampleFilter:
+    @pytest.fixture
+    def timeseries(self):
+        samplerate = 1000.
+        times = np.arange(3001) / samplerate
+        data = np.sin(2 * np.pi * np.array([[7.], [3.]]) * times)
+        return timeseries.TimeSeries(data, dims=('channels', 'time'),
+                                     coords={'channels': ['a', 'b'],
+                                             'time': times,
+                                             'samplerate': samplerate})
+
+    @pytest.mark.parametrize('resamplerate', [256., 500., 100., 2000.])
+    @pytest.mark.parametrize('round_to_original_timepoints', [False, True])
+    def test_polyphase(self, timeseries, resamplerate,
+                       round_to_original_timepoints):
+        fft = ResampleFilter(timeseries, resamplerate,
+                             round_to_original_timepoints).filter()
+        poly = ResampleFilter(timeseries, resamplerate,
+                              round_to_original_timepoints,
+                              method='polyphase').filter()
+        chunked = ResampleFilter(timeseries, resamplerate,
+                                 round_to_original_timepoints,
+                                 method='polyphase', chunk_size=500).filter()
+
+        assert poly.shape == fft.shape
+        assert poly.samplerate == resamplerate
+        # time coordinates are the same whatever the method
+        assert_array_equal(poly.time, fft.time)
+        assert_array_equal(chunked.time, fft.time)
+        assert_array_equal(chunked.values, poly.values)
+
+        # away from the edges the methods agree on slow signals
+        edge = int(0.2 * resamplerate)
+        assert_array_almost_equal(poly.values[:, edge:-edge],
+                                  fft.values[:, edge:-edge], decimal=1)
+
+    def test_errors(self, timeseries):
+        with pytest.raises(ValueError):
+            ResampleFilter(timeseries, 1000. / np.pi,
+                           method='polyphase').filter()
+        with pytest.raises(ValueError):
+            ResampleFilter(timeseries, 500., chunk_size=100).filter()
+
+
 class TestFilterShapes:
     """Filter behavior should not depend on shape of input array."""
     @classmethod
@@ -426,6 +888,90 @@ class TestBaseFilter:
             filt = BaseFilter(self.dummy_ts)
             filt.filter()
 
+    def test_input_not_modified(self):
+        ts = self.dummy_ts
+        filt = BaseFilter(ts)
+        # no copy when the dtype already matches
+        assert filt.timeseries.data is ts.data
+
+        ts = ts.copy(data=ts.data.astype(np.float32))
+        filt = BaseFilter(ts)
+        assert filt.timeseries.data.dtype == np.float64
+        assert ts.data.dtype == np.float32
+
+    def test_out_and_inplace(self):
+        with pytest.raises(ValueError):
+            BaseFilter(self.dummy_ts, out=np.empty(10), inplace=True)
+        with pytest.raises(ValueError):
+            BaseFilter(self.dummy_ts, out=np.empty(5)).output_buffer((10,))
+        with pytest.raises(TypeError):
+            BaseFilter(self.dummy_ts, out=np.empty(10, dtype=int)).output_buffer((10,))
+
+
+class TestFilterOutput:
+    @pytest.fixture
+    def timeseries(self):
+        rng = np.random.RandomState(0)
+        return timeseries.TimeSeries(
+            rng.standard_normal((3, 500)), dims=('channels', 'time'),
+            coords={'channels': ['1', '2', '3'],
+                    'time': np.arange(500) / 250., 'samplerate': 250.})
+
+    @pytest.mark.parametrize('filter_class,kwargs', [
+        (ButterworthFilter, {'freq_range': [58., 62.]}),
+        (LineNoiseFilter, {'harmonics': 1}),
+    ])
+    def test_inplace(self, timeseries, filter_class, kwargs):
+        expected = filter_class(timeseries, **kwargs).filter()
+        data = timeseries.data
+        filtered = filter_class(timeseries, inplace=True, **kwargs).filter()
+        assert np.shares_memory(filtered.data, data)
+        assert_array_equal(timeseries.values, expected.values)
+
+    @pytest.mark.parametrize('filter_class,kwargs', [
+        (ButterworthFilter, {'freq_range': [58., 62.]}),
+        (ButterworthFilter, {'freq_range': [[1., 4.], [4., 8.]],
+                             'filt_type': 'pass'}),
+        (LineNoiseFilter, {'harmonics': 1}),
+        (ResampleFilter, {'resamplerate': 100.}),
+        (ResampleFilter, {'resamplerate': 100., 'method': 'polyphase',
+                          'chunk_size': 128}),
+        (MonopolarToBipolarMapper, {'bipolar_pairs': [['1', '2'],
+                                                      ['2', '3']]}),
+        (MorletWaveletFilter, {'freqs': [5., 10.], 'output': 'power',
+                               'verbose': False}),
+        (MorletWaveletFilter, {'freqs': [5., 10.], 'verbose': False}),
+    ])
+    def test_out(self, timeseries, filter_class, kwargs):
+        original = timeseries.values.copy()
+        expected = filter_class(timeseries, **kwargs).filter()
+        out = np.empty(expected.shape)
+        filtered = filter_class(timeseries, out=out, **kwargs).filter()
+        assert np.shares_memory(filtered.data, out)
+        assert filtered.dims == expected.dims
+        assert_array_almost_equal(filtered.values, expected.values)
+        assert_array_equal(timeseries.values, original)
+
+        # the data of a previous result can be reused as out
+        filtered = filter_class(timeseries, out=filtered, **kwargs).filter()
+        assert np.shares_memory(filtered.data, out)
+        assert_array_almost_equal(filtered.values, expected.values)
+
+        with pytest.raises(ValueError):
+            filter_class(timeseries, out=np.empty(3), **kwargs).filter()
+
+    @pytest.mark.parametrize('output', ['power', ['power', 'phase']])
+    def test_morlet_float32_out(self, timeseries, output):
+        kwargs = {'freqs': [5., 10.], 'output': output, 'verbose': False}
+        expected = MorletWaveletFilter(timeseries, **kwargs).filter()
+        # laid out like the computed output, but single precision
+        out = np.moveaxis(np.empty(expected.shape[:-3] + (3, 2, 500),
+                                   np.float32), -2, -3)
+        filtered = MorletWaveletFilter(timeseries, out=out, **kwargs).filter()
+        assert np.shares_memory(filtered.data, out)
+        assert filtered.dtype == np.float32
+        assert_allclose(filtered.values, expected.values, rtol=1e-5, atol=1e-6)
+
 
 class TestMorletFilter:
     def test_non_double(self):
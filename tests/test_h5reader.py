@@ -1,3 +1,4 @@
+import os
 import os.path as osp
 import time
 import unittest
@@ -7,6 +8,7 @@ import h5py
 import numpy as np
 
 from ptsa.data.readers.hdf5 import H5RawReader
+from ptsa.data.readers.h5pool import H5FilePool, h5_file_pool
 from ptsa.data.readers.binary import BinaryRawReader
 from ptsa.data.readers.events import CMLEventReader
 from ptsa.data.readers import EEGReader
@@ -166,4 +168,144 @@ class TestH5Reader:
 if __name__ == '__main__':
     test = TestH5Reader()
     test.setup_class()
-    test.test_h5reader_empty_channels()
\ No newline at end of file
+    test.test_h5reader_empty_channels()
+
+class TestH5Epochs:
+    @pytest.fixture(params=[('col', None), ('col', (4, 64)), ('row', (64, 4))])
+    def h5file(self, request, tmpdir):
+        orient, chunks = request.param
+        rng = np.random.RandomState(0)
+        data = rng.randint(-2000, 2000, size=(12, 3000)).astype(np.int16)
+        ports = np.arange(1, 13)
+        filename = str(tmpdir.join('eeg_timeseries.h5'))
+        with h5py.File(filename, 'w') as hfile:
+            stored = data.T if orient == 'row' else data
+            timeseries = hfile.create_dataset('timeseries', data=stored, chunks=chunks)
+            timeseries.attrs['orient'] = orient.encode()
+            hfile.create_dataset('ports', data=ports)
+        return filename, data
+
+    @pytest.mark.parametrize('channels', [
+        ['002', '003', '005'],
+        ['001', '012'],
+    ])
+    def test_read_epochs(self, h5file, channels):
+        filename, data = h5file
+        offsets = np.array([2900, 0, 100, 130, -5, 1000, 2500, 40])
+        channels = np.array(channels)
+        channel_indices = channels.astype(int) - 1
+        with h5py.File(filename, 'r') as hfile:
+            eventdata, mask = H5RawReader.read_h5file(hfile, channels, offsets, 200)
+
+        expected_ok = (offsets >= 0) & (offsets + 200 <= 3000)
+        assert eventdata.shape == (len(channels), len(offsets), 200)
+        assert (mask == expected_ok).all()
+        assert np.isnan(eventdata[:, ~expected_ok]).all()
+        for e in np.flatnonzero(expected_ok):
+            offset = offsets[e]
+            assert (eventdata[:, e] == data[channel_indices, offset:offset + 200]).all()
+
+    def test_full_read(self, h5file):
+        filename, data = h5file
+        with h5py.File(filename, 'r') as hfile:
+            eventdata, mask = H5RawReader.read_h5file(hfile, np.array(['004', '007']))
+        assert mask.all()
+        assert (eventdata[:, 0] == data[[3, 6]]).all()
+
+    def test_merges_nearby_epochs(self, h5file):
+        filename, data = h5file
+
+        class CountingDataset(object):
+            def __init__(self, dataset):
+                self.dataset = dataset
+                self.shape, self.chunks, self.dtype = dataset.shape, dataset.chunks, dataset.dtype
+                self.reads = 0
+
+            def __getitem__(self, item):
+                self.reads += 1
+                return self.dataset[item]
+
+        offsets = np.array([0, 300, 1000, 2000])
+        with h5py.File(filename, 'r') as hfile:
+            timeseries = CountingDataset(hfile['timeseries'])
+            row_orient = H5RawReader.is_row_oriented(hfile['timeseries'])
+            out = np.empty((2, len(offsets), 100))
+            H5RawReader.read_h5epochs(timeseries, np.array([1, 2]), offsets, 100, out, np.arange(len(offsets)),
+                                      row_orient=row_orient)
+        for e, offset in enumerate(offsets):
+            assert (out[:, e] == data[[1, 2], offset:offset + 100]).all()
+        # a few kB between epochs is cheaper to read than to seek over
+        if timeseries.chunks is None:
+            assert timeseries.reads == 1
+
+
+class TestH5FilePool:
+    @pytest.fixture
+    def filenames(self, tmpdir):
+        filenames = []
+        for i in range(3):
+            filename = str(tmpdir.join('{}.h5'.format(i)))
+            with h5py.File(filename, 'w') as hfile:
+                hfile.create_dataset('data', data=np.arange(10) + i)
+            filenames.append(filename)
+        return filenames
+
+    def test_reuse_and_eviction(self, filenames):
+        pool = H5FilePool(max_files=2)
+        with pool.open(filenames[0]) as first:
+            assert first['data'][0] == 0
+        with pool.open(filenames[0]) as again:
+            assert again is first
+
+        with pool.open(filenames[1]), pool.open(filenames[2]):
+            # handles in use are never closed
+            assert len(pool) == 3
+        assert filenames[0] not in pool
+        assert not first.id.valid
+        assert filenames[1] in pool and filenames[2] in pool
+
+        pool.close_all()
+        assert len(pool) == 0
+
+    def test_reopen_modified_file(self, filenames):
+        pool = H5FilePool()
+        with pool.open(filenames[0]) as h5file:
+            pass
+        stat = os.stat(filenames[0])
+        os.utime(filenames[0], (stat.st_atime, stat.st_mtime + 10))
+        with pool.open(filenames[0]) as reopened:
+            assert reopened is not h5file
+            assert not h5file.id.valid
+        pool.close_all()
+
+    def test_fork_safety(self, filenames):
+        pool = H5FilePool()
+        with pool.open(filenames[0]) as h5file:
+            pass
+        # pretend we are running in a forked child
+        pool._pid = -1
+        with pool.open(filenames[0]) as child_file:
+            assert child_file is not h5file
+        pool.close_all()
+        h5file.close()
+
+    def test_rdcc_nbytes(self, filenames):
+        pool = H5FilePool(rdcc_nbytes=4 * 2 ** 20)
+        with pool.open(filenames[0]) as h5file:
+            assert h5file.id.get_access_plist().get_cache()[2] == 4 * 2 ** 20
+        pool.close_all()
+
+    def test_reader_uses_pool(self, tmpdir):
+        filename = str(tmpdir.join('eeg_timeseries.h5'))
+        with h5py.File(filename, 'w') as hfile:
+            hfile.create_dataset('timeseries', data=np.ones((2, 100), dtype=np.int16))
+            hfile.create_dataset('ports', data=[1, 2])
+        with open(str(tmpdir.join('params.txt')), 'w') as f:
+            f.write('samplerate 1000\ngain 1\n')
+
+        reader = H5RawReader(dataroot=filename, channels=np.array(['001']),
+                             start_offsets=np.array([0, 10]), read_size=50)
+        eventdata, mask = reader.read()
+        assert mask.all()
+        assert filename in h5_file_pool
+        h5_file_pool.close_all()
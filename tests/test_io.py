@@ -64,3 +64,37 @@ class TestHDF5IO:
                 assert set(data_in.dtype.names) == set(data_out.dtype.names)
                 for name in data_in.dtype.names:
                     assert all(data_in[name] == data_out[name])
+
+    @pytest.mark.parametrize("chunk_by,expected", [
+        ((), (4, 8, 16, 500)),
+        (("channels", "events"), (4, 1, 1, 500)),
+        (("frequency", "channels", "events"), (1, 1, 1, 500)),
+        (("time",), (4, 8, 16, 1)),
+    ])
+    def test_chunk_shape(self, chunk_by, expected):
+        dims = ("frequency", "channels", "events", "time")
+        shape = (4, 8, 16, 500)
+        assert hdf5.chunk_shape(shape, dims, 8, chunk_by,
+                                target_bytes=2 ** 30) == expected
+
+    def test_chunk_shape_target(self):
+        dims = ("frequency", "channels", "events", "time")
+        chunks = hdf5.chunk_shape((8, 100, 300, 1000), dims, 8,
+                                  ("channels",))
+        assert chunks[1] == 1
+        assert np.prod(chunks) * 8 <= hdf5.CHUNK_TARGET_BYTES
+        assert chunks == (1, 1, 75, 1000)
+
+        with pytest.raises(ValueError):
+            hdf5.chunk_shape((1, 2), ("a", "b"), 8, ("c",))
+
+    def test_filter_options(self):
+        assert hdf5.filter_options(None) == {}
+        assert hdf5.filter_options("lzf") == {"compression": "lzf",
+                                              "shuffle": True}
+        assert hdf5.filter_options("gzip", shuffle=False) == {
+            "compression": "gzip", "compression_opts": 4, "shuffle": False}
+        assert hdf5.filter_options("gzip9")["compression_opts"] == 9
+
+        with pytest.raises(ValueError):
+            hdf5.filter_options("zstd")
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path as osp
+from tempfile import mkdtemp
+import shutil
+import threading
+import time
+
+import pytest
+
+from ptsa.data.readers import MetadataCache, ParamsReader, metadata_cache
+
+
+@pytest.fixture
+def tempdir():
+    path = mkdtemp()
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class TestMetadataCache:
+    def test_get(self):
+        cache = MetadataCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 'value'
+
+        assert cache.get('key', compute) == 'value'
+        assert cache.get('key', compute) == 'value'
+        assert len(calls) == 1
+        assert 'key' in cache
+        assert len(cache) == 1
+
+        cache.clear()
+        assert 'key' not in cache
+        assert cache.get('key', compute) == 'value'
+        assert len(calls) == 2
+
+    def test_stamp_path(self, tempdir):
+        cache = MetadataCache()
+        path = osp.join(tempdir, 'stamp')
+        with open(path, 'w') as f:
+            f.write('1')
+
+        assert cache.get('key', lambda: 1, stamp_path=path) == 1
+        assert cache.get('key', lambda: 2, stamp_path=path) == 1
+
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        assert cache.get('key', lambda: 2, stamp_path=path) == 2
+        assert len(cache) == 1
+
+        # a rewrite that keeps the modification time but changes the size
+        stat = os.stat(path)
+        with open(path, 'w') as f:
+            f.write('12')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert cache.get('key', lambda: 3, stamp_path=path) == 3
+
+    def test_exceptions_not_cached(self):
+        cache = MetadataCache()
+
+        def fail():
+            raise IOError('no file')
+
+        with pytest.raises(IOError):
+            cache.get('key', fail)
+        assert 'key' not in cache
+        assert not cache._key_locks
+
+    def test_computed_once_across_threads(self):
+        cache = MetadataCache()
+        calls = []
+        lock = threading.Lock()
+
+        def compute():
+            with lock:
+                calls.append(1)
+            time.sleep(0.05)
+            return 42
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: cache.get('key', compute), range(16)))
+
+        assert results == [42] * 16
+        assert len(calls) == 1
+
+
+def test_params_reader_cache(tempdir):
+    dataroot = osp.join(tempdir, 'R0000X_FR1_0')
+    params_file = osp.join(tempdir, 'params.txt')
+    with open(params_file, 'w') as f:
+        f.write('samplerate 1000\ngain 0.5\n')
+
+    metadata_cache.clear()
+    params = ParamsReader(dataroot=dataroot).read()
+    assert params == {'samplerate': 1000.0, 'gain': 0.5}
+
+    # callers get copies
+    params['gain'] = 2
+    assert ParamsReader(dataroot=dataroot).read()['gain'] == 0.5
+
+    with open(params_file, 'w') as f:
+        f.write('samplerate 500\ngain 0.5\n')
+    stat = os.stat(params_file)
+    os.utime(params_file, (stat.st_atime, stat.st_mtime + 10))
+    assert ParamsReader(dataroot=dataroot).read()['samplerate'] == 500.0
+    metadata_cache.clear()
+
+
+def test_params_file_added_later(tempdir):
+    dataroot = osp.join(tempdir, 'R0000X_FR1_0')
+    with open(osp.join(tempdir, 'params.txt'), 'w') as f:
+        f.write('samplerate 1000\ngain 0.5\n')
+
+    metadata_cache.clear()
+    assert ParamsReader(dataroot=dataroot).filename == osp.join(tempdir, 'params.txt')
+
+    # a dataroot-specific params file takes precedence once it exists
+    time.sleep(0.01)
+    with open(dataroot + '.params', 'w') as f:
+        f.write('{}')
+    assert ParamsReader(dataroot=dataroot).filename == dataroot + '.params'
+    metadata_cache.clear()
+
+
+def test_params_file_in_parent_removed(tempdir):
+    data_dir = osp.join(tempdir, 'eeg')
+    os.mkdir(data_dir)
+    dataroot = osp.join(data_dir, 'R0000X_FR1_0')
+    sources = osp.join(tempdir, 'sources.json')
+    with open(sources, 'w') as f:
+        f.write('{}')
+
+    metadata_cache.clear()
+    assert osp.abspath(ParamsReader.find_params_file(dataroot)) == sources
+
+    time.sleep(0.01)
+    os.remove(sources)
+    with pytest.raises(IOError):
+        ParamsReader.find_params_file(dataroot)
+    metadata_cache.clear()
@@ -0,0 +1,140 @@
+import os
+import os.path as osp
+from tempfile import mkdtemp
+import shutil
+import time
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from ptsa.data.readers import EEGReader, ReadCache
+from ptsa.test.utils import assert_timeseries_equal
+
+
+@pytest.fixture
+def tempdir():
+    path = mkdtemp()
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def events(tempdir):
+    session_dir = osp.join(tempdir, 'session')
+    os.makedirs(session_dir)
+    root = osp.join(session_dir, 'R0000X_FR1_0')
+    data = np.random.RandomState(0).randint(-2000, 2000, size=(3, 5000)).astype('<i2')
+    for i, channel_data in enumerate(data):
+        channel_data.tofile(root + '.{:03d}'.format(i + 1))
+    with open(osp.join(session_dir, 'params.txt'), 'w') as f:
+        f.write('samplerate 1000\ngain 0.5\ndataformat int16\n')
+
+    return np.rec.array([(root, offset, i) for i, offset in enumerate([100, 4950, 2000, 300])],
+                        dtype=[('eegfile', 'U256'), ('eegoffset', int), ('serialpos', int)])
+
+
+def read(events, cache, **kwargs):
+    reader = EEGReader(events=events, channels=np.array(['001', '003']),
+                       start_time=0.0, end_time=0.1, cache=cache, **kwargs)
+    with pytest.warns(UserWarning):
+        eeg = reader.read()
+    return reader, eeg
+
+
+class TestReadCache:
+    def test_hit(self, tempdir, events):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        _, uncached = read(events, None)
+
+        _, cold = read(events, cache)
+        assert len(cache.entries()) == 1
+        assert_timeseries_equal(cold, uncached)
+
+        reader, warm = read(events, cache)
+        assert len(cache.entries()) == 1
+        assert_timeseries_equal(warm, uncached)
+        assert warm.attrs == uncached.attrs
+        assert_array_equal(reader.get_event_ok_mask(), [True, False, True, True])
+
+    def test_key(self, tempdir, events):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        reader = EEGReader(events=events, channels=np.array(['001']), end_time=0.1)
+        key = cache.key(reader)
+
+        # fields other than eegfile/eegoffset are not part of the key
+        other_events = events.copy()
+        other_events.serialpos += 10
+        assert cache.key(EEGReader(events=other_events, channels=np.array(['001']), end_time=0.1)) == key
+
+        assert cache.key(EEGReader(events=events, channels=np.array(['002']), end_time=0.1)) != key
+        assert cache.key(EEGReader(events=events, channels=np.array(['001']), end_time=0.2)) != key
+        assert cache.key(EEGReader(events=events, channels=np.array(['001']), end_time=0.1,
+                                   dtype='float32')) != key
+
+        params_file = osp.join(osp.dirname(events[0].eegfile), 'params.txt')
+        stat = os.stat(params_file)
+        os.utime(params_file, (stat.st_atime, stat.st_mtime + 10))
+        assert cache.key(reader) != key
+
+    def test_channel_file_rewritten(self, tempdir, events):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        _, cold = read(events, cache)
+
+        channel_file = events[0].eegfile + '.003'
+        with open(channel_file, 'wb'):
+            pass
+        np.full(5000, 7, dtype='<i2').tofile(channel_file)
+
+        _, warm = read(events, cache)
+        assert len(cache.entries()) == 2
+        assert_array_equal(warm.sel(channels='003').values, 3.5)
+        assert_array_equal(warm.sel(channels='001').values, cold.sel(channels='001').values)
+
+    def test_channel_labels(self):
+        assert ReadCache.channel_labels(np.array([b'001', b'002'])) == ['001', '002']
+        assert ReadCache.channel_labels(np.array([1, 12])) == ['001', '012']
+        pairs = np.rec.array([('001', '002')], dtype=[('channel_1', 'U3'), ('channel_2', 'U3')])
+        assert ReadCache.channel_labels(pairs) == ['001', '002']
+
+    def test_other_fields_come_from_current_events(self, tempdir, events):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        read(events, cache)
+        other_events = events.copy()
+        other_events.serialpos += 10
+        _, eeg = read(other_events, cache)
+        assert_array_equal(eeg['events'].values['serialpos'], [10, 12, 13])
+
+    def test_eviction(self, tempdir, events):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        for end_time in (0.1, 0.2, 0.3):
+            reader = EEGReader(events=events, channels=np.array(['001']), end_time=end_time, cache=cache)
+            with pytest.warns(UserWarning):
+                reader.read()
+            path = cache.path(cache.key(reader))
+            os.utime(path, (time.time(), time.time() - 100 + end_time * 100))
+
+        entries = cache.entries()
+        assert len(entries) == 3
+        cache.max_size = cache.size() - 1
+        cache.evict()
+        assert [entry[0] for entry in cache.entries()] == [entry[0] for entry in entries[1:]]
+
+        cache.clear()
+        assert cache.size() == 0
+
+    def test_stale_lock(self, tempdir):
+        cache = ReadCache(osp.join(tempdir, 'cache'), max_size=0, stale_lock_timeout=0.0)
+        with open(cache.path('abc'), 'wb') as f:
+            f.write(b'x')
+        os.mkdir(osp.join(cache.directory, 'evict.lock'))
+        cache.evict()
+        assert cache.size() == 0
+        assert not osp.exists(osp.join(cache.directory, 'evict.lock'))
+
+    def test_corrupt_entry(self, tempdir):
+        cache = ReadCache(osp.join(tempdir, 'cache'))
+        with open(cache.path('abc'), 'wb') as f:
+            f.write(b'not a pickle')
+        assert cache.load('abc') is None
+        assert not osp.exists(cache.path('abc'))
@@ -0,0 +1,50 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from ptsa.data.readers.planner import merge_ranges, plan_reads
+
+
+def test_merge_ranges():
+    ranges = merge_ranges(np.array([50, 0, 300, 120, 1000]), 100)
+    assert_array_equal(ranges, [[0, 220], [300, 400], [1000, 1100]])
+
+    ranges = merge_ranges(np.array([50, 0, 300, 120, 1000]), 100, max_gap=80)
+    assert_array_equal(ranges, [[0, 400], [1000, 1100]])
+
+    # a window contained in an earlier one does not shorten the range
+    assert_array_equal(merge_ranges(np.array([0, 10, 500]), 1000), [[0, 1500]])
+    assert merge_ranges(np.array([], dtype=int), 100).shape == (0, 2)
+
+
+@pytest.mark.parametrize('start_offsets,read_size,expected', [
+    # sparse windows in a long file
+    (np.arange(0, 10 ** 8, 10 ** 6), 1000, 'events'),
+    # 1.6 s windows at 1 s intervals over part of the file
+    (np.arange(0, 10 ** 6, 1000), 1600, 'coalesced'),
+    # overlapping windows covering most of the file
+    (np.arange(0, 9 * 10 ** 6, 1000), 2000, 'session'),
+])
+def test_plan_reads(start_offsets, read_size, expected):
+    num_samples = 10 ** 8 if expected == 'events' else 10 ** 7
+    plan = plan_reads(start_offsets, read_size, num_samples, itemsize=2)
+    assert plan.strategy == expected
+    assert plan.bytes_requested == len(start_offsets) * read_size * 2
+
+    if expected == 'events':
+        assert plan.bytes_read == plan.bytes_requested
+        assert len(plan.ranges) == len(start_offsets)
+    elif expected == 'coalesced':
+        assert len(plan.ranges) == 1
+        assert plan.bytes_read == (start_offsets[-1] + read_size) * 2
+    else:
+        assert_array_equal(plan.ranges, [[0, num_samples]])
+
+
+def test_plan_reads_forced():
+    start_offsets = np.array([0, 10 ** 6])
+    for strategy in ('events', 'coalesced', 'session'):
+        assert plan_reads(start_offsets, 100, 10 ** 7, 2, strategy=strategy).strategy == strategy
+
+    with pytest.raises(ValueError):
+        plan_reads(start_offsets, 100, 10 ** 7, 2, strategy='bogus')
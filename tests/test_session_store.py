@@ -0,0 +1,147 @@
+import os
+import os.path as osp
+from tempfile import mkdtemp
+import shutil
+
+import h5py
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from ptsa.data.readers import (BinaryRawReader, EDFRawReader, EEGReader, SessionStoreReader,
+                               transcode, verify_store)
+from ptsa.data.readers.store import main
+
+
+@pytest.fixture
+def tempdir():
+    path = mkdtemp()
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def dataroot(tempdir):
+    root = osp.join(tempdir, 'R0000X_FR1_0')
+    data = np.random.RandomState(0).randint(-2000, 2000, size=(5, 3000)).astype('<i2')
+    for i, channel_data in enumerate(data):
+        channel_data.tofile(root + '.{:03d}'.format(i + 1))
+    with open(osp.join(tempdir, 'params.txt'), 'w') as f:
+        f.write('samplerate 500\ngain 0.25\ndataformat int16\n')
+    return root, data
+
+
+@pytest.mark.parametrize('compression,workers', [(None, 1), ('gzip', 2), ('lzf', 3)])
+def test_binary_roundtrip(tempdir, dataroot, compression, workers):
+    root, data = dataroot
+    store = transcode(root, osp.join(tempdir, 'session.ptsa'), chunk_channels=2,
+                      compression=compression, workers=workers)
+
+    with h5py.File(store, 'r') as f:
+        assert f['data'].chunks == (2, 512)
+        assert f['data'].dtype == np.int16
+        assert f['data'].compression == compression
+        assert f.attrs['samplerate'] == 500
+        assert f.attrs['gain'] == 0.25
+        assert_array_equal(f['data'][()], data)
+    assert verify_store(store, workers=workers) == []
+
+    offsets = np.array([100, 2900, 0, 1500])
+    events = np.rec.array([(root, offset) for offset in offsets],
+                          dtype=[('eegfile', 'U256'), ('eegoffset', int)])
+    store_events = events.copy()
+    store_events.eegfile = store
+    channels = np.array(['004', '001', '002'])
+    with pytest.warns(UserWarning):
+        expected = EEGReader(events=events, channels=channels, end_time=0.5).read()
+    with pytest.warns(UserWarning):
+        eeg = EEGReader(events=store_events, channels=channels, end_time=0.5).read()
+    assert_array_equal(eeg.values, expected.values)
+    assert_array_equal(eeg['channels'].values, channels)
+
+
+def test_reader(tempdir, dataroot):
+    root, data = dataroot
+    store = transcode(root, osp.join(tempdir, 'session.ptsa'))
+
+    session, mask = SessionStoreReader(dataroot=store, channels=np.array([])).read()
+    assert mask.all()
+    assert_array_equal(session.values[:, 0], data * 0.25)
+    assert_array_equal(session['channels'].values, ['001', '002', '003', '004', '005'])
+
+    eventdata, mask = SessionStoreReader(dataroot=store, channels=np.array([b'005', b'002']),
+                                         start_offsets=np.array([-1, 10]), read_size=20,
+                                         dtype='native').read()
+    assert eventdata.dtype == np.int16
+    assert eventdata.attrs['scale'] == 0.25
+    assert_array_equal(mask, [[False, True]] * 2)
+    assert_array_equal(eventdata.values[:, 1], data[[4, 1], 10:30])
+
+    with pytest.raises(IndexError):
+        SessionStoreReader(dataroot=store, channels=np.array(['009'])).read()
+
+
+def test_read_into_unsorted_channels(tempdir, dataroot):
+    root, data = dataroot
+    store = transcode(root, osp.join(tempdir, 'session.ptsa'), chunk_channels=2)
+    reader = SessionStoreReader(dataroot=store, channels=np.array(['005', '001', '003']),
+                                start_offsets=np.array([10, 2990, 500]), read_size=20)
+    out = reader.empty_eventdata((3, 5, 20), dtype=reader.output_dtype())
+    mask = reader.read_into(out, np.array([4, 0, 2]))
+    assert_array_equal(mask, [[True, False, True]] * 3)
+    assert_array_equal(out[:, 4], data[[4, 0, 2], 10:30] * 0.25)
+    assert_array_equal(out[:, 2], data[[4, 0, 2], 500:520] * 0.25)
+    assert np.isnan(out[:, [0, 1, 3]]).all()
+
+
+def test_failed_transcode_removes_temporary_file(tempdir, dataroot, monkeypatch):
+    import ptsa.data.readers.store as store_module
+    root, _ = dataroot
+    destination = osp.join(tempdir, 'session.ptsa')
+    # a file with the name of an older fixed temporary file is left alone
+    with open(destination + '.tmp', 'w') as f:
+        f.write('unrelated')
+    before = sorted(os.listdir(tempdir))
+
+    def fail(samples):
+        raise RuntimeError('checksum failed')
+
+    monkeypatch.setattr(store_module, '_checksum', fail)
+    with pytest.raises(RuntimeError):
+        transcode(root, destination)
+    assert sorted(os.listdir(tempdir)) == before
+    with open(destination + '.tmp') as f:
+        assert f.read() == 'unrelated'
+
+
+def test_verify_detects_corruption(tempdir, dataroot):
+    root, _ = dataroot
+    store = transcode(root, osp.join(tempdir, 'session.ptsa'), channels=['001', '003'])
+    with h5py.File(store, 'a') as f:
+        f['data'][1, 100] += 1
+    assert verify_store(store) == ['003']
+
+
+def test_edf(tempdir):
+    source = osp.join(osp.dirname(__file__), 'data', 'eeg.edf')
+    store = transcode(source, osp.join(tempdir, 'eeg.ptsa'), channels=['EEG FP1', 'EEG C3'])
+    assert verify_store(store) == []
+
+    expected, _ = EDFRawReader(dataroot=source, channels=np.array(['EEG FP1', 'EEG C3']),
+                               start_offsets=np.array([0, 700]), read_size=100).read()
+    eventdata, _ = SessionStoreReader(dataroot=store, channels=np.array(['EEG FP1', 'EEG C3']),
+                                      start_offsets=np.array([0, 700]), read_size=100).read()
+    assert_array_equal(eventdata.values, expected.values)
+    with h5py.File(store, 'r') as f:
+        # physical values are stored
+        assert f['data'].dtype == np.float64
+    assert float(eventdata['samplerate']) == pytest.approx(float(expected['samplerate']))
+
+
+def test_command_line(tempdir, dataroot):
+    root, data = dataroot
+    store = osp.join(tempdir, 'cli.ptsa')
+    main([root, store, '--compression', 'gzip', '--chunk-samples', '256', '--verify'])
+    with h5py.File(store, 'r') as f:
+        assert f['data'].chunks == (5, 256)
+        assert_array_equal(f['data'][()], data)
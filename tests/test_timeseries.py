@@ -103,6 +103,120 @@ def test_hdf(tempdir):
     assert loaded.name == "test"
 
 
+@pytest.mark.parametrize("compression", [None, "lzf", "gzip1"])
+@pytest.mark.parametrize("dtype", [None, "float32", "float16"])
+def test_hdf_storage_options(tempdir, compression, dtype):
+    data = np.random.random((3, 4, 5, 100))
+    dims = ('frequency', 'channels', 'events', 'time')
+    ts = TimeSeries.create(data, 100, dims=dims)
+
+    filename = osp.join(tempdir, "timeseries.h5")
+    ts.to_hdf(filename, chunk_by=('channels', 'events'),
+              compression=compression, dtype=dtype)
+
+    with h5py.File(filename, 'r') as hfile:
+        assert hfile['data'].chunks == (3, 1, 1, 100)
+        assert hfile['data'].compression == (compression and compression[:4])
+        assert hfile['data'].shuffle == (compression is not None)
+        assert hfile['data'].dtype == np.dtype(dtype or data.dtype)
+
+    loaded = TimeSeries.from_hdf(filename)
+    tolerance = {None: 0, 'float32': 1e-7, 'float16': 1e-3}[dtype]
+    np.testing.assert_allclose(loaded.values, data, atol=tolerance)
+
+    ts.to_hdf(filename, chunk_by=('time',), data_kwargs={'chunks': None})
+    with h5py.File(filename, 'r') as hfile:
+        assert hfile['data'].chunks is None
+
+
+class TestHDFSelection:
+    @pytest.fixture
+    def ts(self):
+        data = np.random.random((4, 6, 5, 8))
+        dims = ('channels', 'events', 'frequency', 'time')
+        coords = {
+            'channels': ['LA1', 'LA2', 'LA3', 'LA4'],
+            'frequency': [3., 5., 8., 13., 21.],
+            'time': np.arange(8) / 10.,
+        }
+        return TimeSeries.create(data, 10, coords=coords, dims=dims,
+                                 name="power")
+
+    @pytest.mark.parametrize('chunks', [True, None])
+    @pytest.mark.parametrize('lazy', [False, True])
+    def test_selection(self, ts, tempdir, chunks, lazy):
+        filename = osp.join(tempdir, "timeseries.h5")
+        ts.to_hdf(filename, data_kwargs={'chunks': chunks})
+
+        selection = {
+            'channels': ['LA4', 'LA2'],
+            'events': [5, 0, 2],
+            'frequency': slice(4, 14),
+        }
+        loaded = TimeSeries.from_hdf(filename, selection=selection, lazy=lazy)
+        expected = ts.isel(events=[5, 0, 2]).sel(
+            channels=['LA4', 'LA2'], frequency=slice(4, 14))
+
+        assert isinstance(loaded, TimeSeries)
+        assert loaded.shape == (2, 3, 3, 8)
+        assert_timeseries_equal(loaded, expected)
+        assert loaded.samplerate == 10
+
+    def test_eager(self, ts, tempdir):
+        filename = osp.join(tempdir, "timeseries.h5")
+        ts.to_hdf(filename)
+
+        loaded = TimeSeries.from_hdf(filename, selection={'channels': 'LA3'})
+        assert isinstance(loaded.variable._data, np.ndarray)
+        assert 'channels' not in loaded.dims
+        np.testing.assert_array_equal(loaded.values, ts.values[2])
+
+    def test_lazy(self, ts, tempdir):
+        filename = osp.join(tempdir, "timeseries.h5")
+        ts.to_hdf(filename)
+
+        loaded = TimeSeries.from_hdf(filename, lazy=True)
+        assert not isinstance(loaded.variable._data, np.ndarray)
+        assert loaded.name == "power"
+
+        # indexing stays lazy until the values are accessed
+        subset = loaded.sel(frequency=8.)[:, ::2]
+        assert not isinstance(subset.variable._data, np.ndarray)
+        np.testing.assert_array_equal(subset.values, ts.values[:, ::2, 2])
+
+        np.testing.assert_array_equal(loaded.mean('time'), ts.mean('time'))
+        assert_timeseries_equal(loaded.load(), ts)
+
+    def test_lazy_memmap(self, ts, tempdir):
+        filename = osp.join(tempdir, "timeseries.h5")
+        ts.to_hdf(filename, data_kwargs={'chunks': None})
+
+        loaded = TimeSeries.from_hdf(filename, lazy=True)
+        assert isinstance(loaded.data.base, np.memmap)
+        assert not loaded.data.flags.writeable
+        assert_timeseries_equal(loaded, ts)
+
+    @pytest.mark.parametrize('chunks', [True, None])
+    def test_lazy_close(self, ts, tempdir, chunks):
+        filename = osp.join(tempdir, "timeseries.h5")
+        ts.to_hdf(filename, data_kwargs={'chunks': chunks})
+
+        with TimeSeries.from_hdf(filename, lazy=True) as loaded:
+            np.testing.assert_array_equal(loaded.sel(frequency=8.).values,
+                                          ts.values[:, :, 2])
+        # the file is released, so it can be overwritten
+        doubled = ts.copy(data=ts.values * 2)
+        doubled.to_hdf(filename, data_kwargs={'chunks': chunks})
+        assert_timeseries_equal(TimeSeries.from_hdf(filename), doubled)
+
+        loaded = TimeSeries.from_hdf(filename, selection={'channels': 'LA1'},
+                                     lazy=True)
+        np.testing.assert_array_equal(loaded[0].values, doubled.values[0, 0])
+        loaded.close()
+        ts.to_hdf(filename, data_kwargs={'chunks': chunks})
+        assert_timeseries_equal(TimeSeries.from_hdf(filename), ts)
+
+
 @pytest.mark.skipif(sys.version_info[0] < 3,
                     reason="cmlreaders doesn't support legacy Python")
 class TestCMLReaders:
@@ -240,6 +354,15 @@ def test_resampled():
     assert resampled.data.shape == (50,)
     assert resampled['samplerate'] == 5
 
+    for method, chunk_size in [('polyphase', 0), ('polyphase', 16)]:
+        poly = ts.resampled(5, method=method, chunk_size=chunk_size)
+        assert poly.data.shape == (50,)
+        assert poly['samplerate'] == 5
+        assert (poly.time.values == resampled.time.values).all()
+        # no wrap-around: away from the zero padded edges the ramp is kept
+        np.testing.assert_allclose(poly.data[10:-10], ts.data[20:-20:2],
+                                   atol=0.1)
+
 
 def test_remove_buffer():
     length = 100
@@ -513,3 +636,165 @@ def test_append_recarray():
     # incompatible other dimensions (measurement)
     with pytest.raises(ConcatenationError):
         ts1.append(ts4)
+
+
+def test_scaled():
+    data = np.arange(20, dtype=np.int16).reshape(2, 10)
+    ts = TimeSeries.create(data, 10, dims=('channels', 'time'),
+                           coords={'time': np.arange(10) / 10.},
+                           attrs={'scale': 0.25, 'gain': 0.25})
+    scaled = ts.scaled()
+    assert isinstance(scaled, TimeSeries)
+    assert scaled.dtype == np.float64
+    assert np.all(scaled.data == data * 0.25)
+    assert 'scale' not in scaled.attrs
+    assert scaled.attrs['gain'] == 0.25
+    assert ts.attrs['scale'] == 0.25
+    assert ts.dtype == np.int16
+
+    unscaled = TimeSeries.create(data, 10, dims=('channels', 'time'))
+    assert unscaled.scaled(np.float32).dtype == np.float32
+    assert np.all(unscaled.scaled().data == data)
+
+
+def _mean_over_time(ts):
+    if ts.name == "fail":
+        raise ValueError("failed")
+    return ts.mean('time')
+
+
+class TestSharedMemory:
+    @pytest.fixture
+    def ts(self):
+        events = np.rec.array([(1, 'WORD', 100), (2, 'REC', 200),
+                               (3, 'WORD', 300)],
+                              dtype=[('serialpos', int), ('type', 'U8'),
+                                     ('eegoffset', int)])
+        data = np.random.random((2, 3, 50))
+        return TimeSeries.create(data, 100, dims=('channels', 'events', 'time'),
+                                 coords={'channels': ['LA1', 'LA2'],
+                                         'events': events,
+                                         'time': np.arange(50) / 100.},
+                                 name='eeg', attrs={'a': 1})
+
+    def test_roundtrip(self, ts):
+        handle = ts.to_shared_memory()
+        try:
+            loaded = TimeSeries.from_shared_memory(handle)
+            assert_timeseries_equal(loaded, ts)
+            assert loaded.name == 'eeg'
+            assert loaded.attrs == {'a': 1}
+            assert loaded.events.values.dtype == ts.events.values.dtype
+
+            # both loads view the same buffer
+            other = TimeSeries.from_shared_memory(handle)
+            other[0, 0, 0] = -1.
+            assert loaded[0, 0, 0] == -1.
+        finally:
+            handle.unlink()
+
+        # loaded data stays valid once the block is unlinked
+        assert loaded.values[1].sum() == ts.values[1].sum()
+        with pytest.raises(FileNotFoundError):
+            TimeSeries.from_shared_memory(handle)
+        handle.unlink()
+
+    def test_object_data(self):
+        ts = TimeSeries.create(np.array(['a', None]), 1, dims=('x',))
+        with pytest.raises(TypeError):
+            ts.to_shared_memory()
+
+    def test_map(self, ts):
+        from ptsa.data.common import shared_memory_map
+
+        items = [ts, ts * 2]
+        results = shared_memory_map(_mean_over_time, items, workers=2)
+        for item, result in zip(items, results):
+            assert isinstance(result, TimeSeries)
+            assert_timeseries_equal(result, item.mean('time'))
+
+        failing = ts.copy()
+        failing.name = 'fail'
+        with pytest.raises(ValueError):
+            shared_memory_map(_mean_over_time, [ts, failing], workers=2)
+
+    def test_import_without_shared_memory(self):
+        # multiprocessing.shared_memory only exists on Python 3.8+; it must
+        # only be imported when shared memory is used
+        import subprocess
+
+        code = "\n".join([
+            "import sys",
+            "sys.modules['multiprocessing.shared_memory'] = None",
+            "import ptsa.data.timeseries, ptsa.data.common, ptsa.data.filters",
+            "assert 'ptsa.data.common.shared_memory_utils' not in sys.modules",
+        ])
+        subprocess.check_call([sys.executable, "-c", code])
+
+
+class TestConcat:
+    @staticmethod
+    def make(n_events, offset=0, typelen=8, **coords):
+        events = np.rec.array(
+            [(offset + i, 'WORD') for i in range(n_events)],
+            dtype=[('eegoffset', int), ('type', 'U{}'.format(typelen))])
+        coords.setdefault('channels', ['LA1', 'LA2'])
+        coords.setdefault('time', np.arange(5) / 10.)
+        data = np.random.random((len(coords['channels']), n_events, 5))
+        return TimeSeries.create(data, 10, dims=('channels', 'events', 'time'),
+                                 coords=dict(events=events, **coords),
+                                 name='eeg', attrs={'offset': offset})
+
+    def test_events(self):
+        pieces = [self.make(3), self.make(1, 100, typelen=12), self.make(2, 200)]
+        combined = TimeSeries.concat(pieces, dim='events')
+
+        assert isinstance(combined, TimeSeries)
+        assert combined.shape == (2, 6, 5)
+        assert combined.name == 'eeg'
+        assert combined.samplerate == 10
+        assert combined.attrs == {'offset': 200}
+        np.testing.assert_array_equal(
+            combined.values, np.concatenate([p.values for p in pieces], axis=1))
+        events = combined.events.values
+        assert events.dtype['type'] == np.dtype('U12')
+        np.testing.assert_array_equal(events['eegoffset'],
+                                      [0, 1, 2, 100, 200, 201])
+        assert (events['type'] == 'WORD').all()
+
+        # matches xarray and pairwise appends
+        expected = pieces[0].append(pieces[1], dim='events').append(
+            pieces[2], dim='events')
+        np.testing.assert_array_equal(combined.values, expected.values)
+
+        # first dimension by default
+        combined = TimeSeries.concat(
+            [pieces[0], self.make(3, channels=['LA3'])])
+        assert combined.shape == (3, 3, 5)
+        np.testing.assert_array_equal(combined.channels,
+                                      ['LA1', 'LA2', 'LA3'])
+
+    def test_new_dim(self):
+        pieces = [self.make(2), self.make(2), self.make(2)]
+        pieces[1].name = 'other'
+        combined = TimeSeries.concat(pieces, dim='session', name='all')
+        assert combined.dims == ('session', 'channels', 'events', 'time')
+        assert combined.name == 'all'
+        np.testing.assert_array_equal(combined.session, [0, 1, 2])
+        np.testing.assert_array_equal(combined.values,
+                                      np.stack([p.values for p in pieces]))
+        assert TimeSeries.concat(pieces, dim='session').name is None
+
+    def test_errors(self):
+        ts = self.make(2)
+        with pytest.raises(ValueError):
+            TimeSeries.concat([])
+        with pytest.raises(ConcatenationError):
+            TimeSeries.concat([ts, ts.transpose('time', 'channels', 'events')])
+        with pytest.raises(ConcatenationError):
+            TimeSeries.concat([ts, self.make(2, time=np.arange(5))],
+                              dim='events')
+        other_rate = self.make(2)
+        other_rate['samplerate'] = 20.
+        with pytest.raises(ConcatenationError):
+            TimeSeries.concat([ts, other_rate], dim='events')